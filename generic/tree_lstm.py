@@ -1,12 +1,62 @@
+import bisect
+import collections
+import copy
+import struct
 import torch
 import torch.nn as nn
 import typing
+import weakref
 import xxhash
 
 
+# Structural hashing schemes:
+#
+# 1: xxh64 over `str(value)` followed by the child digests.
+# 2: xxh3 over a flags byte, the value packed as an int64 (or the digest of a
+#    BVT value) and the fixed-width child digests.
+#
+# Hashes are pickled along with the BVTs and the scheme they were computed
+# with. Hashes pickled with another scheme (or before schemes were recorded)
+# are discarded on load and lazily recomputed, `prooftrace_rehash` rewrites
+# datasets so that they load without recomputation.
+HASH_VERSION = 2
+
+_hash_version = HASH_VERSION
+
+_HASH_LEFT = 0x01
+_HASH_RIGHT = 0x02
+_HASH_BVT = 0x04
+_HASH_STR = 0x08
+
+_HASH_INT = struct.Struct('<Bq')
+
+
+def hash_version() -> int:
+    return _hash_version
+
+
+def hash_version_set(
+        version: int,
+) -> None:
+    """ Sets the process-wide structural hashing scheme.
+
+    Only meant to be called at startup, before any BVT is hashed.
+    """
+    global _hash_version
+    assert version in [1, HASH_VERSION]
+    _hash_version = version
+
+
 class BVT():
     """ BVT stands for BinaryValuedTree
+
+    BVTs are allocated by the millions when loading datasets so they use
+    `__slots__` instead of a per-instance `__dict__`.
     """
+    __slots__ = (
+        'value', 'left', 'right', '_hash', '_depth', '__weakref__',
+    )
+
     def __init__(
             self,
             value,
@@ -20,20 +70,100 @@ class BVT():
         self._hash = None
         self._depth = None
 
-    def hash(
+    def __getstate__(
             self,
     ):
-        if self._hash is None:
-            h = xxhash.xxh64()
-            if isinstance(self.value, BVT):
-                h.update(self.value.hash())
+        # We pickle attributes as a plain dict, the format used by BVTs before
+        # they had `__slots__`.
+        state = {}
+        for cls in type(self).__mro__:
+            for s in getattr(cls, '__slots__', ()):
+                if s != '__weakref__':
+                    state[s] = getattr(self, s)
+        if state['_hash'] is not None:
+            state['_hash_version'] = _hash_version
+        return state
+
+    def __setstate__(
+            self,
+            state,
+    ):
+        # Migrates both legacy `__dict__` based pickles and the (dict, slots)
+        # state tuples produced by default for slotted objects.
+        if isinstance(state, tuple):
+            dict_state, slots_state = state
+            state = dict(dict_state or {})
+            state.update(slots_state or {})
+
+        version = state.pop('_hash_version', None)
+
+        self._hash = None
+        self._depth = None
+        for k in state:
+            setattr(self, k, state[k])
+
+        if version != _hash_version:
+            self._hash = None
+
+    def hash_children(
+            self,
+    ) -> typing.List:
+        """ BVTs whose hashes are required by `hash_node`.
+        """
+        children = []
+        if isinstance(self.value, BVT):
+            children.append(self.value)
+        if self.left is not None:
+            children.append(self.left)
+        if self.right is not None:
+            children.append(self.right)
+        return children
+
+    def hash_node(
+            self,
+    ) -> bytes:
+        """ Computes the node hash, assuming `hash_children` are hashed.
+        """
+        if _hash_version > 1:
+            flags = 0
+            if self.left is not None:
+                flags |= _HASH_LEFT
+            if self.right is not None:
+                flags |= _HASH_RIGHT
+
+            value = self.value
+            if isinstance(value, BVT):
+                data = bytes((flags | _HASH_BVT,)) + value._hash
+            elif type(value) is int and -(1 << 63) <= value < (1 << 63):
+                data = _HASH_INT.pack(flags, value)
             else:
-                h.update(str(self.value))
+                data = bytes((flags | _HASH_STR,)) + \
+                    str(value).encode('utf-8')
+
+            # Child digests are fixed-width and trail the data, their presence
+            # is recorded in the flags.
             if self.left is not None:
-                h.update(self.left.hash())
+                data += self.left._hash
             if self.right is not None:
-                h.update(self.right.hash())
-            self._hash = h.digest()
+                data += self.right._hash
+            return xxhash.xxh3_64_digest(data)
+
+        h = xxhash.xxh64()
+        if isinstance(self.value, BVT):
+            h.update(self.value._hash)
+        else:
+            h.update(str(self.value))
+        if self.left is not None:
+            h.update(self.left._hash)
+        if self.right is not None:
+            h.update(self.right._hash)
+        return h.digest()
+
+    def hash(
+            self,
+    ):
+        if self._hash is None:
+            hash_all([self])
 
         return self._hash
 
@@ -41,18 +171,45 @@ class BVT():
             self,
     ):
         if self._depth is None:
-            if self.left is not None:
-                ld = self.left.depth()
-            else:
-                ld = -1
-            if self.right is not None:
-                rd = self.right.depth()
-            else:
-                rd = -1
-            self._depth = 1 + max(ld, rd)
+            stack = [self]
+            while len(stack) > 0:
+                node = stack[-1]
+                if node._depth is not None:
+                    stack.pop()
+                    continue
+
+                pending = False
+                if node.left is not None and node.left._depth is None:
+                    stack.append(node.left)
+                    pending = True
+                if node.right is not None and node.right._depth is None:
+                    stack.append(node.right)
+                    pending = True
+                if pending:
+                    continue
+
+                stack.pop()
+                ld = node.left._depth if node.left is not None else -1
+                rd = node.right._depth if node.right is not None else -1
+                node._depth = 1 + max(ld, rd)
 
         return self._depth
 
+    def key(
+            self,
+    ):
+        """ Structural key used by BVTTable for hash-consing.
+
+        Children (and BVT values) are keyed by identity, which is sound as long
+        as they have been interned before their parent. Returning None marks
+        the node as non-internable.
+        """
+        if isinstance(self.value, BVT):
+            value = id(self.value)
+        else:
+            value = self.value
+        return (type(self), value, id(self.left), id(self.right))
+
     def string(
             self,
     ):
@@ -70,6 +227,771 @@ class BVT():
         return string
 
 
+def hash_all(
+        trees: typing.List[BVT],
+) -> None:
+    """ Fills `_hash` for all the nodes of `trees` in one post-order sweep.
+
+    Uses an explicit stack so that hashing is not bound by the recursion limit.
+    """
+    stack = [t for t in trees if t is not None]
+    while len(stack) > 0:
+        node = stack[-1]
+        if node._hash is not None:
+            stack.pop()
+            continue
+
+        pending = False
+        for c in node.hash_children():
+            if c._hash is None:
+                stack.append(c)
+                pending = True
+        if pending:
+            continue
+
+        stack.pop()
+        node._hash = node.hash_node()
+
+
+def rehash_all(
+        trees: typing.List[BVT],
+) -> None:
+    """ Discards the hashes of all the nodes of `trees` and recomputes them
+    with the current hashing scheme.
+    """
+    seen = set()
+    stack = [t for t in trees if t is not None]
+    while len(stack) > 0:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        node._hash = None
+        for c in (node.value, node.left, node.right):
+            if isinstance(c, BVT):
+                stack.append(c)
+
+    hash_all(trees)
+
+
+def flatten(
+        trees: typing.List[BVT],
+) -> typing.Tuple[typing.Dict, typing.List[int]]:
+    """ Flat node table of `trees`, used to pickle forests without recursing
+
+    Pickle recurses once per tree level, so deep trees are pickled as columns
+    over their nodes in post-order: the class, one column per remaining
+    `__getstate__` key (those of the class in `keys`) and the BVT value and
+    children, as distances back to their position in the table (0 if none,
+    the value being in `values` otherwise). Distances are mostly small and
+    compress well. Shared nodes are stored once and the hashing scheme is
+    recorded once for the whole table, with the hashes joined in one string
+    when all nodes are hashed. Returns the table and the positions of the
+    roots (-1 for None).
+    """
+    table = {
+        'classes': [],
+        'keys': [],
+        'hash_version': _hash_version,
+        'kinds': [],
+        'states': {},
+        'values': [],
+        'value_refs': [],
+        'lefts': [],
+        'rights': [],
+    }
+    kinds = {}
+    positions = {}
+
+    def position(node):
+        if node is None:
+            return -1
+        return positions[id(node)]
+
+    def distance(node):
+        if node is None:
+            return 0
+        return len(table['kinds']) - positions[id(node)]
+
+    for tree in trees:
+        if tree is None or id(tree) in positions:
+            continue
+        stack = [(tree, False)]
+        while len(stack) > 0:
+            node, expanded = stack.pop()
+            if id(node) in positions:
+                continue
+
+            if not expanded:
+                stack.append((node, True))
+                for c in (node.right, node.left, node.value):
+                    if isinstance(c, BVT) and id(c) not in positions:
+                        stack.append((c, False))
+                continue
+
+            state = node.__getstate__()
+            for k in ['value', 'left', 'right', '_hash_version']:
+                state.pop(k, None)
+
+            cls = type(node)
+            if cls not in kinds:
+                kinds[cls] = len(table['classes'])
+                table['classes'].append(cls)
+                table['keys'].append(tuple(state.keys()))
+            kind = kinds[cls]
+
+            if isinstance(node.value, BVT):
+                table['values'].append(None)
+                table['value_refs'].append(distance(node.value))
+            else:
+                table['values'].append(node.value)
+                table['value_refs'].append(0)
+            table['lefts'].append(distance(node.left))
+            table['rights'].append(distance(node.right))
+
+            for k in state:
+                if k not in table['states']:
+                    table['states'][k] = [None] * len(table['kinds'])
+            for k in table['states']:
+                table['states'][k].append(state.get(k))
+
+            positions[id(node)] = len(table['kinds'])
+            table['kinds'].append(kind)
+
+    hashes = table['states'].get('_hash')
+    if hashes is not None and \
+            all(h is not None and len(h) == 8 for h in hashes):
+        table['states']['_hash'] = b''.join(hashes)
+
+    return table, [position(t) for t in trees]
+
+
+def unflatten(
+        table: typing.Dict,
+) -> typing.List[BVT]:
+    """ Rebuilds the nodes of a table produced by `flatten`
+    """
+    states = dict(table['states'])
+    hashes = states.get('_hash')
+    if isinstance(hashes, bytes):
+        states['_hash'] = [
+            hashes[i:i + 8] for i in range(0, len(hashes), 8)
+        ]
+
+    classes, keys = table['classes'], table['keys']
+    values, value_refs = table['values'], table['value_refs']
+    lefts, rights = table['lefts'], table['rights']
+    columns = [[(k, states[k]) for k in ks] for ks in keys]
+    version = table['hash_version']
+
+    nodes = []
+    for i, kind in enumerate(table['kinds']):
+        state = {k: column[i] for k, column in columns[kind]}
+        if state.get('_hash') is not None:
+            state['_hash_version'] = version
+
+        ref = value_refs[i]
+        state['value'] = nodes[i - ref] if ref != 0 else values[i]
+        state['left'] = nodes[i - lefts[i]] if lefts[i] != 0 else None
+        state['right'] = nodes[i - rights[i]] if rights[i] != 0 else None
+
+        node = classes[kind].__new__(classes[kind])
+        node.__setstate__(state)
+        nodes.append(node)
+
+    return nodes
+
+
+class BVTTable():
+    """ Hash-consing table for BVT nodes.
+
+    Interning nodes bottom-up guarantees that structurally equal trees are
+    represented by one shared object: equality becomes identity and hashes are
+    computed once per distinct node. In `weak` mode the table only holds weak
+    references to its nodes so that entries get evicted as soon as a node is
+    not used anymore (long-running workers). An interned node keeps its
+    children alive, so identity based keys can't be reused while the entry
+    exists.
+    """
+    def __init__(
+            self,
+            weak: bool = False,
+    ):
+        self._weak = weak
+
+        if weak:
+            self._nodes = weakref.WeakValueDictionary()
+        else:
+            self._nodes = {}
+
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(
+            self,
+    ) -> int:
+        return len(self._nodes)
+
+    def stats(
+            self,
+    ) -> typing.Dict[str, typing.Any]:
+        return {
+            'weak': self._weak,
+            'size': len(self._nodes),
+            'hits': self._hits,
+            'misses': self._misses,
+        }
+
+    def intern(
+            self,
+            node: BVT,
+    ) -> BVT:
+        """ Returns the shared node structurally equal to `node`.
+
+        `node`'s children must have been interned already.
+        """
+        if node is None:
+            return None
+
+        key = node.key()
+        if key is None:
+            return node
+
+        shared = self._nodes.get(key)
+        if shared is not None:
+            self._hits += 1
+            return shared
+
+        self._misses += 1
+        self._nodes[key] = node
+        return node
+
+    def intern_tree(
+            self,
+            tree: BVT,
+            memo: typing.Dict[int, typing.Tuple[BVT, BVT]] = None,
+    ) -> BVT:
+        """ Interns a whole tree built without interning (eg. unpickled).
+
+        Children links are rewritten in place to point to shared nodes. Nodes
+        are visited once (post-order, iteratively) even when they are shared
+        within the tree. `memo` maps the `id` of visited nodes to the node and
+        its interned counterpart, it can be shared across calls on trees with
+        common nodes.
+        """
+        if tree is None:
+            return None
+        if memo is None:
+            memo = {}
+
+        def resolve(node):
+            if node is None:
+                return None
+            return memo[id(node)][1]
+
+        stack = [(tree, False)]
+        while len(stack) > 0:
+            node, expanded = stack.pop()
+            if node is None or id(node) in memo:
+                continue
+
+            if not expanded:
+                stack.append((node, True))
+                stack.append((node.right, False))
+                stack.append((node.left, False))
+                if isinstance(node.value, BVT):
+                    stack.append((node.value, False))
+                continue
+
+            if isinstance(node.value, BVT):
+                node.value = resolve(node.value)
+            node.left = resolve(node.left)
+            node.right = resolve(node.right)
+
+            # The original node is kept in the memo so that its `id` can't be
+            # reused while the memo is alive.
+            memo[id(node)] = (node, self.intern(node))
+
+        return resolve(tree)
+
+
+# Process-wide interning table, disabled (None) by default.
+_intern_table = None
+
+
+def intern_enable(
+        weak: bool = False,
+) -> BVTTable:
+    global _intern_table
+    _intern_table = BVTTable(weak)
+    return _intern_table
+
+
+def intern_disable(
+) -> None:
+    global _intern_table
+    _intern_table = None
+
+
+def intern_table(
+) -> typing.Optional[BVTTable]:
+    return _intern_table
+
+
+def intern(
+        node: BVT,
+) -> BVT:
+    """ Interns `node` in the process-wide table if enabled.
+    """
+    if _intern_table is None:
+        return node
+    return _intern_table.intern(node)
+
+
+def intern_tree(
+        tree: BVT,
+        memo: typing.Dict[int, typing.Tuple[BVT, BVT]] = None,
+) -> BVT:
+    if _intern_table is None:
+        return tree
+    return _intern_table.intern_tree(tree, memo)
+
+
+class BatchPlan():
+    """ Compiled schedule of the TreeLSTM evaluation of an array of BVT
+
+    Nodes are scheduled by height (leaves first) so that each distinct
+    subtree is computed exactly once, wherever it appears in the trees. `V`
+    holds the values, `K` the hashes and `L`, `R` the children positions of
+    the nodes to compute at each height, `pos` the positions of the roots.
+    Positions are `(height, index)` pairs, missing children have index -1.
+
+    Plans only depend on the structure of the trees. They can be cached by
+    `key` and merged, reusing the nodes already scheduled.
+
+    If `known` is provided (the hashes of nodes whose states are cached, see
+    TreeLSTMCache) known nodes are not walked but listed in `P` and their
+    positions are `(-1, index)` in that list. Such plans depend on the cache
+    and are not meant to be cached themselves.
+    """
+    def __init__(
+            self,
+            trees: typing.List[BVT] = (),
+            known: typing.Container = None,
+    ) -> None:
+        self.V = []
+        self.K = []
+        self.L = []
+        self.R = []
+        self.P = []
+        self.pos = []
+
+        self.counters = {
+            'cache_hits': 0,
+            'compute_steps': 0,
+        }
+
+        self._roots = []
+        self._positions = {}
+        self._known = known
+        self._index = None
+        self._routes = None
+
+        self.extend(trees)
+
+    def len(
+            self,
+    ) -> int:
+        return len(self._roots)
+
+    def roots(
+            self,
+    ) -> typing.List[BVT]:
+        return self._roots
+
+    def key(
+            self,
+    ) -> typing.Tuple:
+        return tuple(t.hash() for t in self._roots)
+
+    def schedule(
+            self,
+            height: int,
+            key,
+            value,
+            left: typing.Tuple[int, int],
+            right: typing.Tuple[int, int],
+    ) -> typing.Tuple[int, int]:
+        while height >= len(self.V):
+            self.V.append([])
+            self.K.append([])
+            self.L.append([])
+            self.R.append([])
+
+        position = (height, len(self.V[height]))
+        self._positions[key] = position
+
+        self.V[height].append(value)
+        self.K[height].append(key)
+        self.L[height].append(left)
+        self.R[height].append(right)
+
+        self.counters['compute_steps'] += 1
+
+        return position
+
+    def precompute(
+            self,
+            key,
+    ) -> typing.Tuple[int, int]:
+        position = (-1, len(self.P))
+        self._positions[key] = position
+
+        self.P.append(key)
+
+        return position
+
+    def extend(
+            self,
+            trees: typing.List[BVT],
+    ):
+        """ Appends `trees` to the roots, scheduling their unseen subtrees
+        """
+        def position(tree):
+            if tree is None:
+                return (0, -1)
+            return self._positions[tree.hash()]
+
+        def visit(tree):
+            stack = [(tree, False)]
+            while len(stack) > 0:
+                node, expanded = stack.pop()
+
+                if not expanded:
+                    if node.hash() in self._positions:
+                        self.counters['cache_hits'] += 1
+                        continue
+                    if self._known is not None and node.hash() in self._known:
+                        self.precompute(node.hash())
+                        continue
+                    stack.append((node, True))
+                    if node.right is not None:
+                        stack.append((node.right, False))
+                    if node.left is not None:
+                        stack.append((node.left, False))
+                    continue
+
+                left = position(node.left)
+                right = position(node.right)
+
+                height = 0
+                if left[1] > -1:
+                    height = max(height, left[0] + 1)
+                if right[1] > -1:
+                    height = max(height, right[0] + 1)
+
+                self.schedule(height, node.hash(), node.value, left, right)
+
+            return self._positions[tree.hash()]
+
+        for t in trees:
+            self.pos.append(visit(t))
+            self._roots.append(t)
+
+        self._index = None
+        self._routes = None
+
+        return self
+
+    def absorb(
+            self,
+            other,
+    ):
+        """ Appends the roots of `other` in place, from its schedule
+
+        Heights only depend on the subtrees, so the nodes of `other` keep
+        their level and are only remapped, without walking the trees again.
+        """
+        remap = {}
+        for i, key in enumerate(other.P):
+            if key in self._positions:
+                remap[(-1, i)] = self._positions[key]
+            else:
+                remap[(-1, i)] = self.precompute(key)
+        for height in range(len(other.V)):
+            for i, key in enumerate(other.K[height]):
+                if key in self._positions:
+                    self.counters['cache_hits'] += 1
+                    remap[(height, i)] = self._positions[key]
+                    continue
+                remap[(height, i)] = self.schedule(
+                    height, key, other.V[height][i],
+                    remap.get(other.L[height][i], (0, -1)),
+                    remap.get(other.R[height][i], (0, -1)),
+                )
+
+        self.pos += [remap[p] for p in other.pos]
+        self._roots += other._roots
+
+        self._index = None
+        self._routes = None
+
+        return self
+
+    def merge(
+            self,
+            other,
+    ):
+        """ Plan of the roots of `self` followed by the roots of `other`
+        """
+        return self.copy().absorb(other)
+
+    def copy(
+            self,
+    ):
+        plan = copy.copy(self)
+
+        plan.V = [list(level) for level in self.V]
+        plan.K = [list(level) for level in self.K]
+        plan.L = [list(level) for level in self.L]
+        plan.R = [list(level) for level in self.R]
+        plan.P = list(self.P)
+        plan.pos = list(self.pos)
+        plan.counters = dict(self.counters)
+
+        plan._roots = list(self._roots)
+        plan._positions = dict(self._positions)
+
+        return plan
+
+    def index(
+            self,
+    ) -> typing.Tuple[typing.List[int], int, typing.List[int]]:
+        """ Rows of the levels in the evaluation buffer and gather indices
+
+        Row 0 of the buffer is the zero state shared by all missing children,
+        the precomputed states follow, then the levels from the leaves up.
+        The gather indices are laid out
+        level after level (left children, then right children) followed by
+        the roots.
+        """
+        if self._index is not None:
+            return self._index
+
+        offsets = [0] * len(self.V)
+        size = 1 + len(self.P)
+        for d in range(len(self.V)):
+            offsets[d] = size
+            size += len(self.V[d])
+
+        def row(p):
+            if p[1] == -1:
+                return 0
+            if p[0] == -1:
+                return 1 + p[1]
+            return offsets[p[0]] + p[1]
+
+        index = []
+        for d in range(len(self.V)):
+            index += [row(p) for p in self.L[d]]
+            index += [row(p) for p in self.R[d]]
+        index += [row(p) for p in self.pos]
+
+        self._index = (offsets, size, index)
+
+        return self._index
+
+    def routes(
+            self,
+    ) -> typing.Tuple[
+        typing.List[typing.List[int]],
+        typing.List[typing.List[int]],
+        typing.List[typing.List[int]],
+    ]:
+        """ Gather schedule of `batch` when gradients are required
+
+        Sources are the zero state (0), the precomputed states (1) and the
+        levels (2 + height). Consumers are the levels, gathering their left
+        then right children, followed by the roots. Each source is gathered
+        once, in consumer order, and split between its consumers: `gathers`
+        holds the rows of each source, `counts` the number of those rows
+        going to each consumer. Consumers concatenate their rows by source and
+        `perms` reorders them as the gather indices of `index`.
+        """
+        if self._routes is not None:
+            return self._routes
+
+        offsets, size, index = self.index()
+
+        def source(row):
+            if row == 0:
+                return 0, 0
+            if row < 1 + len(self.P):
+                return 1, row - 1
+            d = bisect.bisect_right(offsets, row) - 1
+            return 2 + d, row - offsets[d]
+
+        consumers = []
+        start = 0
+        for d in range(len(self.V)):
+            consumers.append(index[start:start + 2 * len(self.V[d])])
+            start += 2 * len(self.V[d])
+        consumers.append(index[start:])
+
+        gathers = [[] for _ in range(2 + len(self.V))]
+        counts = [[0] * len(consumers) for _ in range(2 + len(self.V))]
+        perms = []
+        for c, rows in enumerate(consumers):
+            buckets = {}
+            for j, row in enumerate(rows):
+                k, local = source(row)
+                buckets.setdefault(k, []).append((j, local))
+
+            perm = [0] * len(rows)
+            t = 0
+            for k in sorted(buckets.keys()):
+                for j, local in buckets[k]:
+                    gathers[k].append(local)
+                    perm[j] = t
+                    t += 1
+                counts[k][c] = len(buckets[k])
+            perms.append(perm)
+
+        self._routes = (gathers, counts, perms)
+
+        return self._routes
+
+
+class TreeLSTMCache():
+    """ LRU cache of the (hidden, cell) states of BVT nodes
+
+    States are only valid for a given version of the parameters. Entries are
+    keyed by node hash under the current `version` and `invalidate` drops
+    them all when the parameters change. Memory is capped at `max_bytes`.
+    """
+    def __init__(
+            self,
+            max_bytes: int,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.version = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        self._bytes = 0
+        self._entries = collections.OrderedDict()
+
+    def __contains__(
+            self,
+            key,
+    ) -> bool:
+        return key in self._entries
+
+    def __getitem__(
+            self,
+            key,
+    ):
+        return self._entries[key]
+
+    def __iter__(
+            self,
+    ):
+        return iter(self._entries)
+
+    def __len__(
+            self,
+    ) -> int:
+        return len(self._entries)
+
+    def get(
+            self,
+            keys: typing.List,
+    ) -> typing.List[torch.Tensor]:
+        states = []
+        for key in keys:
+            self._entries.move_to_end(key)
+            states.append(self._entries[key])
+        self.hits += len(keys)
+
+        return states
+
+    def put(
+            self,
+            keys: typing.List,
+            states: torch.Tensor,
+    ) -> None:
+        assert states.size(0) == len(keys)
+        self.misses += len(keys)
+
+        for i, key in enumerate(keys):
+            # Rows are cloned so that entries do not retain the whole batch.
+            state = states[i].clone()
+            if key in self._entries:
+                self._bytes -= self.size(self._entries.pop(key))
+            self._entries[key] = state
+            self._bytes += self.size(state)
+
+        while self._bytes > self.max_bytes and len(self._entries) > 0:
+            _, state = self._entries.popitem(last=False)
+            self._bytes -= self.size(state)
+
+    @staticmethod
+    def size(
+            state: torch.Tensor,
+    ) -> int:
+        return state.numel() * state.element_size()
+
+    def invalidate(
+            self,
+    ) -> None:
+        self.version += 1
+        self._bytes = 0
+        self._entries = collections.OrderedDict()
+
+    def stats(
+            self,
+            reset: bool = False,
+    ) -> typing.Dict[str, int]:
+        stats = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'version': self.version,
+        }
+        if reset:
+            self.hits = 0
+            self.misses = 0
+
+        return stats
+
+
+# Whether `BinaryTreeLSTM.batch` gathers children with per-level index
+# tensors. Only meant to be disabled for benchmarking.
+_batch_vectorized = True
+
+
+def batch_vectorize_enable(
+        enabled: bool = True,
+) -> None:
+    global _batch_vectorized
+    _batch_vectorized = enabled
+
+
+# Whether `BinaryTreeLSTM.batch` uses `batch_routed` when gradients are
+# required. Until its gradients are validated against `batch_legacy` (see
+# `prooftrace_bench_tree_lstm`) training goes through `batch_legacy`.
+_batch_routed = False
+
+
+def batch_routed_enable(
+        enabled: bool = True,
+) -> None:
+    global _batch_routed
+    _batch_routed = enabled
+
+
 class BinaryTreeLSTM(nn.Module):
     """ Binary TreeLSTM with node values.
 
@@ -86,6 +1008,15 @@ class BinaryTreeLSTM(nn.Module):
 
         self.hidden_size = hidden_size
 
+        # Scheduling counters of the plan of the last batch.
+        self.counters = {
+            'cache_hits': 0,
+            'compute_steps': 0,
+        }
+
+        # States cache used in eval mode (see `cache_enable`).
+        self.cache = None
+
         self.wx = nn.Linear(hidden_size, 5 * hidden_size)
         self.wh = nn.Linear(2 * hidden_size, 5 * hidden_size)
 
@@ -99,66 +1030,230 @@ class BinaryTreeLSTM(nn.Module):
 
         return super(BinaryTreeLSTM, self).to(*args, **kwargs)
 
+    def train(
+            self,
+            mode: bool = True,
+    ):
+        # Parameters are about to change.
+        if mode and self.cache is not None:
+            self.cache.invalidate()
+
+        return super(BinaryTreeLSTM, self).train(mode)
+
+    def _load_from_state_dict(
+            self,
+            *args,
+            **kwargs,
+    ):
+        # Called for each submodule by `load_state_dict`, in particular when
+        # IOTA fetches a new broadcast.
+        if self.cache is not None:
+            self.cache.invalidate()
+
+        return super(BinaryTreeLSTM, self)._load_from_state_dict(
+            *args, **kwargs,
+        )
+
+    def cache_enable(
+            self,
+            max_bytes: int,
+    ) -> None:
+        """ Enables the eval-mode cache of node states, capped at `max_bytes`
+        """
+        self.cache = None
+        if max_bytes > 0:
+            self.cache = TreeLSTMCache(max_bytes)
+
+    def known(
+            self,
+    ):
+        """ States cache to plan and evaluate with, None in training mode
+        """
+        if self.training:
+            return None
+        return self.cache
+
     def batch(
             self,
-            trees: typing.List[BVT],
+            trees: typing.Union[typing.List[BVT], BatchPlan],
             embedder,
     ):
-        """ Dynamic batching on an array of BVT
+        """ Dynamic batching on an array of BVT (or its compiled BatchPlan)
+
+        The plan is evaluated level by level, from the leaves up, over a
+        single buffer of concatenated hidden and cell states. Row 0 of the
+        buffer is the zero state shared by all missing children, so that each
+        level is one `index_select` of its children followed by one cell call.
 
-        Caching will perform better if the trees are sorted by depth. We can't
-        easily do so here so it's just easier if callers ensure it.
+        When gradients are required the shared buffer is not used, the plan
+        is evaluated by `batch_legacy` (or `batch_routed` if enabled).
         """
-        V = []
-        L = []
-        R = []
+        if not _batch_vectorized:
+            return self.batch_legacy(trees, embedder)
 
-        cache = {}
-        counters = {
-            'cache_hits': 0,
-            'compute_steps': 0,
-        }
+        if torch.is_grad_enabled() and not _batch_routed:
+            plan = trees
+            if isinstance(plan, BatchPlan) and len(plan.P) > 0:
+                # `batch_legacy` does not read cached states.
+                plan = BatchPlan(plan.roots())
+            return self.batch_legacy(plan, embedder)
 
-        def dfs(tree, depth):
-            if tree.hash() in cache and cache[tree.hash()][0] >= depth:
-                counters['cache_hits'] += 1
-                return cache[tree.hash()]
-            counters['compute_steps'] += 1
+        cache = self.known()
 
-            while depth >= len(V):
-                V.append([])
-                L.append([])
-                R.append([])
+        plan = trees
+        if not isinstance(plan, BatchPlan):
+            plan = BatchPlan(trees, cache)
+        self.counters = dict(plan.counters)
 
-            idx = len(V[depth])
-            V[depth].append(tree.value)
+        if torch.is_grad_enabled():
+            return self.batch_routed(plan, cache, embedder)
 
-            if tree.left is not None:
-                L[depth].append(dfs(tree.left, depth+1))
-            else:
-                L[depth].append((depth+1, -1))
-            if tree.right is not None:
-                R[depth].append(dfs(tree.right, depth+1))
-            else:
-                R[depth].append((depth+1, -1))
+        V = plan.V
+        offsets, size, index = plan.index()
+
+        # All the gather indices are moved to the device at once.
+        index = torch.tensor(index, dtype=torch.int64).to(self.device)
+
+        HC = torch.zeros(
+            size, 2 * self.hidden_size,
+        ).to(self.device)
+
+        if len(plan.P) > 0:
+            assert cache is not None
+            HC[1:1 + len(plan.P)] = torch.stack(cache.get(plan.P), dim=0)
+
+        start = 0
+        for d in range(len(V)):
+            n = len(V[d])
+            children = HC.index_select(0, index[start:start + 2 * n])
+            start += 2 * n
+
+            h, c = self.forward(
+                embedder(V[d]),
+                children[:n, :self.hidden_size],
+                children[:n, self.hidden_size:],
+                children[n:, :self.hidden_size],
+                children[n:, self.hidden_size:],
+            )
+
+            HC[offsets[d]:offsets[d] + n] = torch.cat([h, c], dim=-1)
+
+        # At this stage everything is computed we just need to return the
+        # top-level vectors for each tree.
+        roots = HC.index_select(0, index[start:])
+
+        assert roots.size(0) == plan.len()
+
+        if cache is not None:
+            keys = []
+            for d in range(len(V)):
+                keys += plan.K[d]
+            cache.put(keys, HC[1 + len(plan.P):].detach())
+
+        return roots[:, :self.hidden_size], roots[:, self.hidden_size:]
+
+    def batch_routed(
+            self,
+            plan: BatchPlan,
+            cache,
+            embedder,
+    ):
+        """ Evaluation of `plan` for `batch` when gradients are required
+
+        Each in-place write to a shared buffer is recorded by autograd as a
+        copy of the whole buffer, and the backward of each level's
+        `index_select` is as large as the buffer, which makes the backward
+        pass O(levels * buffer). Instead, each level is gathered once, right
+        after it is computed, and split between the levels (and roots) using
+        it (see `BatchPlan.routes`), keeping the backward pass linear.
+        """
+        V = plan.V
+        gathers, counts, perms = plan.routes()
+
+        # All the gather indices are moved to the device at once.
+        flat = []
+        for rows in gathers + perms:
+            flat += rows
+        flat = torch.tensor(flat, dtype=torch.int64).to(self.device)
+
+        parts = []
+        start = 0
+        for rows in gathers + perms:
+            parts.append(flat[start:start + len(rows)])
+            start += len(rows)
+        gathers, perms = parts[:len(gathers)], parts[len(gathers):]
+
+        # Rows handed to each consumer, by source.
+        routed = [[] for _ in perms]
+
+        def route(k, states):
+            if gathers[k].size(0) == 0:
+                return
+            rows = states.index_select(0, gathers[k])
+            for c, part in enumerate(rows.split(counts[k])):
+                if counts[k][c] > 0:
+                    routed[c].append(part)
+
+        def consume(c):
+            if len(routed[c]) == 0:
+                return torch.zeros(0, 2 * self.hidden_size).to(self.device)
+            return torch.cat(routed[c], dim=0).index_select(0, perms[c])
+
+        route(0, torch.zeros(1, 2 * self.hidden_size).to(self.device))
+        if len(plan.P) > 0:
+            assert cache is not None
+            route(1, torch.stack(cache.get(plan.P), dim=0))
+
+        levels = []
+        for d in range(len(V)):
+            n = len(V[d])
+            children = consume(d)
 
-            cache[tree.hash()] = (depth, idx)
+            h, c = self.forward(
+                embedder(V[d]),
+                children[:n, :self.hidden_size],
+                children[:n, self.hidden_size:],
+                children[n:, :self.hidden_size],
+                children[n:, self.hidden_size:],
+            )
 
-            return (depth, idx)
+            levels.append(torch.cat([h, c], dim=-1))
+            route(2 + d, levels[-1])
+
+        roots = consume(len(V))
+
+        assert roots.size(0) == plan.len()
+
+        if cache is not None and len(levels) > 0:
+            keys = []
+            for d in range(len(V)):
+                keys += plan.K[d]
+            cache.put(keys, torch.cat(levels, dim=0).detach())
+
+        return roots[:, :self.hidden_size], roots[:, self.hidden_size:]
+
+    def batch_legacy(
+            self,
+            trees: typing.Union[typing.List[BVT], BatchPlan],
+            embedder,
+    ):
+        """ Reference implementation of `batch` gathering children one by one
+
+        Only kept for benchmarking and testing `batch` against.
+        """
+        plan = trees
+        if not isinstance(plan, BatchPlan):
+            plan = BatchPlan(trees)
+        self.counters = dict(plan.counters)
 
-        # Consturct the folded computation graph.
-        pos = [dfs(t, 0) for t in trees]
+        assert len(plan.P) == 0
 
-        # Log.out("TreeLSTM dynamic batching", {
-        #     "batch_size": len(trees),
-        #     "compute_steps": counters['compute_steps'],
-        #     "cache_hits": counters['cache_hits'],
-        # })
+        V, L, R, pos = plan.V, plan.L, plan.R, plan.pos
 
         H = [[]] * len(V)
         C = [[]] * len(V)
 
-        for d in reversed(range(len(V))):
+        for d in range(len(V)):
             v = embedder(V[d])
 
             lh = []
@@ -214,7 +1309,7 @@ class BinaryTreeLSTM(nn.Module):
         Ht = torch.cat(Ht, dim=0)
         Ct = torch.cat(Ct, dim=0)
 
-        assert Ht.size(0) == len(trees)
+        assert Ht.size(0) == plan.len()
 
         return Ht, Ct
 
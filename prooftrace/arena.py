@@ -0,0 +1,1050 @@
+import collections.abc
+import json
+import mmap
+import numpy as np
+import os
+import struct
+import typing
+import uuid
+import zlib
+
+from generic.tree_lstm import BVT, hash_version
+
+from prooftrace.prooftrace import \
+    Type, Term, Action, ProofTraceActions, TraceHeader, TRACE_HEADER_SIZE
+
+from utils.log import Log
+
+
+""" TreeArena
+
+A TreeArena encodes a forest of Action/Term/Type BVTs as parallel integer
+arrays, one entry per structurally distinct node. Children and BVT values are
+referenced by their position in the arrays, which are laid out in post-order
+(children always come before their parents) so that bottom-up passes are
+simple forward sweeps.
+
+Arenas back the serialization of traces (columnar files and the Term/Type
+store). The embedders do not run on them: they evaluate a BatchPlan (see
+`generic.tree_lstm`), which already flattens a batch into per-level arrays
+built in a single iterative pass over the BVTs the collate function hands
+over. Going through an arena there would add a conversion without saving a
+walk. `Action.__iter__` only serves JSON dumps for the viewer.
+
+    kind:       KINDS index of the node class
+    value:      integer value, or arena index of the BVT value if `ref`
+    ref:        whether `value` is an arena index
+    left:       arena index of the left child (-1 if None)
+    right:      arena index of the right child (-1 if None)
+    depth:      BVT.depth() of the node
+    hash:       BVT.hash() of the node as a little-endian uint64
+    token:      index in `tokens` of the Term/Type string token (-1 if None)
+    index:      Action._index (-1 if None)
+
+An arena can be backed by a `store` arena holding the Term and Type nodes (see
+`build_store`). It then only holds Action nodes and references store nodes
+with negative indices (see `store_ref`).
+"""
+
+KINDS = [Type, Term, Action]
+KIND_IDS = {k: i for i, k in enumerate(KINDS)}
+
+COLUMNS = {
+    'kind': np.uint8,
+    'value': np.int64,
+    'ref': np.bool_,
+    'left': np.int32,
+    'right': np.int32,
+    'depth': np.int32,
+    'hash': np.uint64,
+    'token': np.int32,
+    'index': np.int64,
+}
+
+
+def store_ref(
+        idx: int,
+) -> int:
+    """ Encodes a store index as an arena reference (-1 is None).
+    """
+    return -(idx + 2)
+
+
+class TreeArena():
+    def __init__(
+            self,
+            store=None,
+    ) -> None:
+        self._columns = {c: [] for c in COLUMNS}
+        self._frozen = False
+
+        self._store = store
+        # Identifier of the arena when used as a store and memo shared by all
+        # the trees materialized from it.
+        self._id = None
+        self._shared = {}
+
+        # Hashing scheme of the `hash` column. Hashes are only restored on
+        # materialized nodes if it matches the current scheme.
+        self._hash_version = hash_version()
+
+        self._tokens = []
+        self._token_ids = {}
+
+        # Deduplication index from the structural key of nodes (see `add`) to
+        # arena index.
+        self._nodes = {}
+
+    def __len__(
+            self,
+    ) -> int:
+        return len(self._columns['kind'])
+
+    def column(
+            self,
+            name: str,
+    ) -> np.ndarray:
+        assert self._frozen
+        return self._columns[name]
+
+    def tokens(
+            self,
+    ) -> typing.List[str]:
+        return self._tokens
+
+    def freeze(
+            self,
+    ):
+        """ Converts the columns to contiguous NumPy arrays.
+
+        No node can be added to a frozen arena.
+        """
+        if not self._frozen:
+            for c in COLUMNS:
+                self._columns[c] = np.array(
+                    self._columns[c], dtype=COLUMNS[c],
+                )
+            self._frozen = True
+
+        return self
+
+    def token_index(
+            self,
+            token: str,
+    ) -> int:
+        if token is None:
+            return -1
+        if token not in self._token_ids:
+            self._token_ids[token] = len(self._tokens)
+            self._tokens.append(token)
+        return self._token_ids[token]
+
+    def max_depth(
+            self,
+    ) -> int:
+        if len(self) == 0:
+            return -1
+        return int(np.max(self._columns['depth']))
+
+    def depth_of(
+            self,
+            idx: int,
+    ) -> int:
+        if idx == -1:
+            return -1
+        if idx < -1:
+            return self._store.depth_of(store_ref(idx))
+        return int(self._columns['depth'][idx])
+
+    def add(
+            self,
+            tree: BVT,
+            memo: typing.Dict[int, int] = None,
+            store_memo: typing.Dict[int, int] = None,
+    ) -> int:
+        """ Adds a tree to the arena and returns the index of its root.
+
+        Walks the tree iteratively in post-order so that arbitrarily deep trees
+        can be added. Nodes already present in the arena are reused if they
+        are structurally equal (same kind, value, token, Action index and
+        children), hashes alone being order-insensitive for HYPOTHESIS
+        chains. `memo` (and `store_memo` for the store) map node ids to arena
+        indices and can be shared across calls on trees with common nodes.
+        """
+        assert not self._frozen
+
+        if tree is None:
+            return -1
+
+        if memo is None:
+            memo = {}
+        if store_memo is None:
+            store_memo = {}
+
+        def lookup(node):
+            if node is None:
+                return -1
+            return memo[id(node)]
+
+        stack = [(tree, False)]
+        while len(stack) > 0:
+            node, expanded = stack.pop()
+            if id(node) in memo:
+                continue
+
+            if self._store is not None and type(node) is not Action:
+                memo[id(node)] = store_ref(self._store.add(node, store_memo))
+                continue
+
+            if not expanded:
+                stack.append((node, True))
+                if node.right is not None:
+                    stack.append((node.right, False))
+                if node.left is not None:
+                    stack.append((node.left, False))
+                if isinstance(node.value, BVT):
+                    stack.append((node.value, False))
+                continue
+
+            ref = isinstance(node.value, BVT)
+            if ref:
+                value = lookup(node.value)
+            else:
+                value = node.value
+
+            if type(node) is Action:
+                token = -1
+            else:
+                token = self.token_index(node.token())
+
+            index = -1
+            if type(node) is Action and node.index() is not None:
+                index = node.index()
+
+            key = (
+                KIND_IDS[type(node)], ref, value,
+                lookup(node.left), lookup(node.right),
+                token, index, node.hash(),
+            )
+            if key in self._nodes:
+                memo[id(node)] = self._nodes[key]
+                continue
+
+            idx = len(self)
+
+            c = self._columns
+            c['kind'].append(key[0])
+            c['value'].append(value)
+            c['ref'].append(ref)
+            c['left'].append(key[3])
+            c['right'].append(key[4])
+            c['depth'].append(max(
+                self.depth_of(key[3]),
+                self.depth_of(key[4]),
+            ) + 1)
+            c['hash'].append(int.from_bytes(key[7], 'little'))
+            c['token'].append(token)
+            c['index'].append(index)
+
+            self._nodes[key] = idx
+            memo[id(node)] = idx
+
+        return memo[id(tree)]
+
+    def add_all(
+            self,
+            trees: typing.List[BVT],
+    ) -> typing.List[int]:
+        memo = {}
+        store_memo = {}
+        return [self.add(t, memo, store_memo) for t in trees]
+
+    def tree(
+            self,
+            idx: int,
+            memo: typing.Dict[int, BVT] = None,
+    ) -> BVT:
+        """ Materializes the BVT rooted at `idx`.
+
+        Shared subtrees are materialized once per `memo`, which can be passed
+        across calls to share nodes between materialized trees.
+        """
+        if idx < 0:
+            return None
+        if memo is None:
+            memo = {}
+
+        c = self._columns
+
+        def get(i):
+            if i == -1:
+                return None
+            if i < -1:
+                return self._store.tree(store_ref(i), self._store._shared)
+            return memo[i]
+
+        stack = [(idx, False)]
+        while len(stack) > 0:
+            i, expanded = stack.pop()
+            if i in memo:
+                continue
+
+            if not expanded:
+                stack.append((i, True))
+                for j in (c['right'][i], c['left'][i]):
+                    if j >= 0:
+                        stack.append((int(j), False))
+                if c['ref'][i] and c['value'][i] >= 0:
+                    stack.append((int(c['value'][i]), False))
+                continue
+
+            kind = KINDS[c['kind'][i]]
+            if c['ref'][i]:
+                value = get(int(c['value'][i]))
+            else:
+                value = int(c['value'][i])
+            left = get(int(c['left'][i]))
+            right = get(int(c['right'][i]))
+
+            if kind is Action:
+                index = int(c['index'][i])
+                node = Action(
+                    value, left, right, None if index == -1 else index,
+                )
+            else:
+                token = int(c['token'][i])
+                node = kind(
+                    value, left, right,
+                    None if token == -1 else self._tokens[token],
+                )
+
+            if self._hash_version == hash_version():
+                node._hash = int(c['hash'][i]).to_bytes(8, 'little')
+            node._depth = int(c['depth'][i])
+
+            memo[i] = node
+
+        return memo[idx]
+
+    def trees(
+            self,
+            indices: typing.List[int],
+    ) -> typing.List[BVT]:
+        memo = {}
+        return [self.tree(i, memo) for i in indices]
+
+    def save(
+            self,
+            f,
+            **extra,
+    ) -> None:
+        """ Writes the arena columns (and `extra` arrays) with np.savez.
+        """
+        self.freeze()
+        np.savez_compressed(
+            f,
+            tokens=np.array(self._tokens, dtype=np.str_),
+            hash_version=np.array(self._hash_version),
+            **self._columns,
+            **extra,
+        )
+
+    @staticmethod
+    def load(
+            f,
+    ) -> typing.Tuple[typing.Any, typing.Dict[str, np.ndarray]]:
+        """ Reads an arena written by `save`, returns it with the extra arrays.
+        """
+        data = np.load(f)
+
+        arena = TreeArena()
+        arena._frozen = True
+        for c in COLUMNS:
+            arena._columns[c] = data[c]
+        arena._tokens = [str(t) for t in data['tokens']]
+        arena._token_ids = {t: i for i, t in enumerate(arena._tokens)}
+        arena._hash_version = 1
+        if 'hash_version' in data.files:
+            arena._hash_version = int(data['hash_version'])
+
+        extra = {
+            k: data[k] for k in data.files
+            if k not in COLUMNS and k not in ['tokens', 'hash_version']
+        }
+
+        return arena, extra
+
+
+def ptra_to_arena(
+        ptra: ProofTraceActions,
+        store: TreeArena = None,
+) -> typing.Tuple[TreeArena, np.ndarray, np.ndarray]:
+    """ Encodes a ProofTraceActions as an arena and its sequences of roots.
+    """
+    arena = TreeArena(store)
+    actions = np.array(arena.add_all(ptra.actions()), dtype=np.int32)
+    arguments = np.array(arena.add_all(ptra.arguments()), dtype=np.int32)
+
+    return arena.freeze(), actions, arguments
+
+
+def ptra_from_arena(
+        name: str,
+        arena: TreeArena,
+        actions: np.ndarray,
+        arguments: np.ndarray,
+) -> ProofTraceActions:
+    memo = {}
+    return ProofTraceActions(
+        name,
+        [arena.tree(int(i), memo) for i in actions],
+        [arena.tree(int(i), memo) for i in arguments],
+    )
+
+
+def save_ptra(
+        ptra: ProofTraceActions,
+        f,
+) -> None:
+    arena, actions, arguments = ptra_to_arena(ptra)
+    arena.save(
+        f,
+        name=np.array(ptra.name(), dtype=np.str_),
+        actions=actions,
+        arguments=arguments,
+    )
+
+
+def load_ptra(
+        f,
+) -> ProofTraceActions:
+    arena, extra = TreeArena.load(f)
+    return ptra_from_arena(
+        str(extra['name']),
+        arena,
+        extra['actions'],
+        extra['arguments'],
+    )
+
+
+""" Columnar ProofTraceActions format
+
+An uncompressed single-file layout of `ptra_to_arena` meant to be read through
+`mmap` without deserialization:
+
+    trace:      TraceHeader (TRACE_HEADER_SIZE bytes)
+    magic:      COLUMNAR_MAGIC (8 bytes)
+    header:     uint32 length followed by a zlib compressed JSON object (name,
+                len, prepare_len, hash_version, tokens, store and, for each
+                column, its dtype, offset and count)
+    columns:    the arena COLUMNS followed by the `actions` and `arguments`
+                root indices, each aligned on 8 bytes
+
+Integer columns are written with the smallest dtype holding their values (see
+`narrow`) and columns holding a single repeated value are not written, their
+header entry records the value in place of the offset.
+
+Files use the `.actions` extension like the gzip pickles they replace and are
+told apart by their magic (see `ProofTraceActions.load`). Files written with
+COLUMNAR_MAGIC_V1 have an uncompressed JSON header and no constant columns.
+
+Traces written against a store record its id and its path relative to the
+trace. Stores use the same layout without TraceHeader nor root indices.
+"""
+
+COLUMNAR_MAGIC = b'PTRACOL2'
+COLUMNAR_MAGIC_V1 = b'PTRACOL1'
+NARROW_DTYPES = [
+    np.dtype(d) for d in [
+        np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32,
+    ]
+]
+
+# Memory-mapped stores by path, shared by all the traces of the process.
+_stores = {}
+
+
+def is_columnar(
+        path: str,
+) -> bool:
+    header = TraceHeader.read(path)
+    if header is not None:
+        return header.columnar
+
+    with open(path, 'rb') as f:
+        return f.read(len(COLUMNAR_MAGIC)) in \
+            [COLUMNAR_MAGIC, COLUMNAR_MAGIC_V1]
+
+
+def narrow(
+        array: np.ndarray,
+) -> np.ndarray:
+    """ Casts an integer array to the smallest dtype holding its values.
+    """
+    if array.dtype.kind not in 'iu' or len(array) == 0:
+        return array
+
+    low, high = int(array.min()), int(array.max())
+    for dtype in NARROW_DTYPES:
+        if dtype.itemsize >= array.dtype.itemsize:
+            break
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return array.astype(dtype)
+
+    return array
+
+
+def write_columns(
+        f,
+        meta: typing.Dict[str, typing.Any],
+        arrays: typing.Dict[str, np.ndarray],
+) -> None:
+    """ Writes the columnar magic, `meta` header and `arrays` at the current
+    position of `f`.
+    """
+    # Offsets are relative to the start of the columns section. Constant
+    # columns get their value instead of an offset and are not written.
+    columns = {}
+    offset = 0
+    for c in arrays:
+        a = arrays[c]
+        if len(a) > 1 and a.dtype.kind in 'iub' and np.all(a == a[0]):
+            columns[c] = [a.dtype.str, None, len(a), a[0].item()]
+            continue
+        offset += -offset % 8
+        columns[c] = [a.dtype.str, offset, len(a)]
+        offset += a.nbytes
+
+    header = zlib.compress(
+        json.dumps(dict(meta, columns=columns)).encode('utf-8'),
+    )
+
+    base = f.tell() + len(COLUMNAR_MAGIC) + 4 + len(header)
+    base += -base % 8
+
+    f.write(COLUMNAR_MAGIC)
+    f.write(struct.pack('<I', len(header)))
+    f.write(header)
+    for c in columns:
+        if columns[c][1] is None:
+            continue
+        f.write(b'\0' * (base + columns[c][1] - f.tell()))
+        f.write(arrays[c].tobytes())
+
+
+def read_columnar_header(
+        f,
+) -> typing.Tuple[typing.Dict[str, typing.Any], int]:
+    """ Reads the header of a columnar file, returns it with the offset of the
+    columns section.
+    """
+    if TraceHeader.unpack(f.read(TRACE_HEADER_SIZE)) is None:
+        f.seek(0)
+    magic = f.read(len(COLUMNAR_MAGIC))
+    assert magic in [COLUMNAR_MAGIC, COLUMNAR_MAGIC_V1]
+    size = struct.unpack('<I', f.read(4))[0]
+    header = f.read(size)
+    if magic == COLUMNAR_MAGIC:
+        header = zlib.decompress(header)
+    header = json.loads(header.decode('utf-8'))
+
+    base = f.tell()
+    base += -base % 8
+
+    return header, base
+
+
+def map_columns(
+        path: str,
+) -> typing.Tuple[
+    typing.Dict[str, typing.Any],
+    typing.Dict[str, np.ndarray],
+]:
+    """ Memory-maps a columnar file, returns its header and column views.
+    """
+    with open(path, 'rb') as f:
+        header, base = read_columnar_header(f)
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    columns = {}
+    for c in header['columns']:
+        dtype, offset, count = header['columns'][c][:3]
+        if offset is None:
+            # Constant column, a read-only view of its single value.
+            columns[c] = np.broadcast_to(
+                np.array(header['columns'][c][3], dtype=np.dtype(dtype)),
+                (count,),
+            )
+            continue
+        columns[c] = np.frombuffer(
+            mapping, dtype=np.dtype(dtype),
+            count=count, offset=base + offset,
+        )
+
+    return header, columns
+
+
+def mapped_arena(
+        header: typing.Dict[str, typing.Any],
+        columns: typing.Dict[str, np.ndarray],
+        store: TreeArena = None,
+) -> TreeArena:
+    arena = TreeArena(store)
+    arena._frozen = True
+    for c in COLUMNS:
+        arena._columns[c] = columns[c]
+    arena._tokens = header['tokens']
+    arena._token_ids = {t: i for i, t in enumerate(arena._tokens)}
+    arena._hash_version = header['hash_version']
+
+    return arena
+
+
+def save_columnar(
+        ptra: ProofTraceActions,
+        path: str,
+        store: TreeArena = None,
+        store_path: str = None,
+) -> None:
+    """ Writes `ptra` in the columnar format, atomically.
+
+    If `store` is provided its Terms and Types are added to it instead, the
+    store is expected to be saved at `store_path`.
+    """
+    arena, actions, arguments = ptra_to_arena(ptra, store)
+
+    arrays = {c: narrow(arena._columns[c]) for c in arena._columns}
+    arrays['actions'] = narrow(actions)
+    arrays['arguments'] = narrow(arguments)
+
+    meta = {
+        'name': ptra.name(),
+        'len': ptra.len(),
+        'prepare_len': ptra.prepare_len(),
+        'hash_version': arena._hash_version,
+        'tokens': arena.tokens(),
+        'store': None,
+    }
+    if store is not None:
+        meta['store'] = {
+            'id': store._id,
+            'path': os.path.relpath(store_path, os.path.dirname(path)),
+        }
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(TraceHeader.from_ptra(ptra, True).pack())
+        write_columns(f, meta, arrays)
+    os.rename(tmp_path, path)
+
+
+def save_store(
+        store: TreeArena,
+        path: str,
+) -> None:
+    store.freeze()
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write_columns(f, {
+            'id': store._id,
+            'hash_version': store._hash_version,
+            'tokens': store.tokens(),
+        }, {c: narrow(store._columns[c]) for c in store._columns})
+    os.rename(tmp_path, path)
+
+
+def load_store(
+        path: str,
+) -> TreeArena:
+    """ Memory-maps a store, once per process.
+    """
+    path = os.path.realpath(path)
+    if path not in _stores:
+        header, columns = map_columns(path)
+        store = mapped_arena(header, columns)
+        store._id = header['id']
+        _stores[path] = store
+
+    return _stores[path]
+
+
+def build_store(
+        paths: typing.List[str],
+        store_path: str,
+) -> None:
+    """ Rewrites the traces at `paths` as columnar files backed by one store of
+    all their Terms and Types, deduplicated, written at `store_path`.
+
+    Rewritten traces only replace the original ones once the store is written.
+    """
+    store = TreeArena()
+    store._id = uuid.uuid4().hex
+
+    src_size = 0
+    dst_size = 0
+
+    for i, p in enumerate(paths):
+        src_size += os.path.getsize(p)
+
+        ptra = ProofTraceActions.load(p)
+        save_columnar(ptra, p + '.stored', store, store_path)
+        dst_size += os.path.getsize(p + '.stored')
+
+        if (i + 1) % 1000 == 0:
+            Log.out("Store building", {
+                'progress': "{}/{}".format(i + 1, len(paths)),
+                'store_nodes': len(store),
+            })
+
+    save_store(store, store_path)
+    store_size = os.path.getsize(store_path)
+
+    for p in paths:
+        os.rename(p + '.stored', p)
+
+    Log.out("Store built", {
+        'path': store_path,
+        'trace_count': len(paths),
+        'store_nodes': len(store),
+        'store_size': store_size,
+        'src_size': src_size,
+        'dst_size': dst_size + store_size,
+    })
+
+
+class ArenaSequence(collections.abc.Sequence):
+    """ Read-only sequence of trees materialized lazily from an arena.
+
+    Materialized trees are memoized (and share their subtrees) so that repeated
+    accesses return the same objects.
+    """
+    def __init__(
+            self,
+            arena: TreeArena,
+            roots: np.ndarray,
+            memo: typing.Dict[int, BVT],
+    ) -> None:
+        self._arena = arena
+        self._roots = roots
+        self._memo = memo
+
+    def __len__(
+            self,
+    ) -> int:
+        return len(self._roots)
+
+    def __getitem__(
+            self,
+            i,
+    ):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self._arena.tree(int(self._roots[i]), self._memo)
+
+    def __add__(
+            self,
+            other,
+    ) -> typing.List[BVT]:
+        return list(self) + list(other)
+
+    def __radd__(
+            self,
+            other,
+    ) -> typing.List[BVT]:
+        return list(other) + list(self)
+
+    def copy(
+            self,
+    ) -> typing.List[BVT]:
+        return list(self)
+
+
+class MappedProofTraceActions(ProofTraceActions):
+    """ ProofTraceActions backed by a memory-mapped columnar file.
+
+    Columns are views over the mapping and Actions are only materialized when
+    accessed. Mutations and pickling operate on a regular ProofTraceActions.
+    """
+    def __init__(
+            self,
+            path: str,
+    ) -> None:
+        header, columns = map_columns(path)
+
+        store = None
+        if header.get('store') is not None:
+            store = load_store(os.path.join(
+                os.path.dirname(path), header['store']['path'],
+            ))
+            assert store._id == header['store']['id']
+
+        arena = mapped_arena(header, columns, store)
+
+        memo = {}
+        super(MappedProofTraceActions, self).__init__(
+            header['name'],
+            ArenaSequence(arena, columns['actions'], memo),
+            ArenaSequence(arena, columns['arguments'], memo),
+        )
+
+        self._arena = arena
+        self._len = header['len']
+        self._prepare_len = header['prepare_len']
+
+    def __reduce__(
+            self,
+    ):
+        # Actions are passed through the state of the regular
+        # ProofTraceActions, as a flat node table, rather than as constructor
+        # arguments.
+        return (
+            ProofTraceActions,
+            (self._name, [], []),
+            ProofTraceActions(
+                self._name, list(self._actions), list(self._arguments),
+            ).__getstate__(),
+        )
+
+    def len(
+            self,
+    ) -> int:
+        if self._len is None:
+            return super(MappedProofTraceActions, self).len()
+        return self._len
+
+    def append(
+            self,
+            action: Action,
+            argument: Action,
+    ) -> None:
+        self._actions = list(self._actions)
+        self._arguments = list(self._arguments)
+        self._len = None
+
+        super(MappedProofTraceActions, self).append(action, argument)
+
+
+""" Kernel cache
+
+Binary indexed copy of the `prooftrace.theorems`, `prooftrace.proofs` and
+`prooftrace.names` JSONL dumps of a dataset, written once by
+`build_kernel_cache` and memory-mapped by ProofTraceKernel.
+
+It uses the columnar layout (without TraceHeader) with, for each section,
+the sorted record ids, an offsets column (one more entry than ids) and a
+shared `records` column of packed records (see `pack_record`).
+"""
+
+KERNEL_CACHE_FILE = 'prooftrace.kernel'
+KERNEL_CACHE_SECTIONS = {
+    'theorems': ('prooftrace.theorems', 'th'),
+    'proofs': ('prooftrace.proofs', 'pr'),
+    'names': ('prooftrace.names', 'nm'),
+}
+
+_RECORD_INT = struct.Struct('<q')
+_RECORD_LEN = struct.Struct('<I')
+
+
+def pack_record(
+        value,
+        out: bytearray,
+) -> None:
+    """ Packs a JSON value made of ints, strings, lists and dicts as a tag
+    byte followed by the int64 value, or the uint32 length and content.
+    """
+    if isinstance(value, int):
+        out += b'i'
+        out += _RECORD_INT.pack(value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        out += b's'
+        out += _RECORD_LEN.pack(len(data))
+        out += data
+    elif isinstance(value, list):
+        out += b'l'
+        out += _RECORD_LEN.pack(len(value))
+        for v in value:
+            pack_record(v, out)
+    elif isinstance(value, dict):
+        out += b'd'
+        out += _RECORD_LEN.pack(len(value))
+        for k in value:
+            pack_record(k, out)
+            pack_record(value[k], out)
+    else:
+        assert False
+
+
+def unpack_record(
+        data,
+        offset: int,
+) -> typing.Tuple[typing.Any, int]:
+    """ Unpacks the record packed at `offset` of `data`, returns it with the
+    offset following it.
+    """
+    tag = data[offset:offset+1]
+    offset += 1
+
+    if tag == b'i':
+        return _RECORD_INT.unpack_from(data, offset)[0], offset + 8
+
+    size = _RECORD_LEN.unpack_from(data, offset)[0]
+    offset += 4
+
+    if tag == b's':
+        return str(data[offset:offset+size], 'utf-8'), offset + size
+    if tag == b'l':
+        value = []
+        for _ in range(size):
+            v, offset = unpack_record(data, offset)
+            value.append(v)
+        return value, offset
+    if tag == b'd':
+        value = {}
+        for _ in range(size):
+            k, offset = unpack_record(data, offset)
+            value[k], offset = unpack_record(data, offset)
+        return value, offset
+
+    assert False
+
+
+def build_kernel_cache(
+        dataset_dir: str,
+) -> str:
+    """ Converts the JSONL kernel dumps of `dataset_dir` into a kernel cache
+    written next to them, returns its path.
+    """
+    records = bytearray()
+    arrays = {}
+
+    for section in KERNEL_CACHE_SECTIONS:
+        name, field = KERNEL_CACHE_SECTIONS[section]
+
+        ids = []
+        offsets = []
+        with open(os.path.join(dataset_dir, name), 'r') as f:
+            for line in f:
+                data = json.loads(line)
+                ids.append(data['id'])
+                offsets.append(len(records))
+                pack_record(data[field], records)
+
+        order = sorted(range(len(ids)), key=lambda i: ids[i])
+        arrays[section + '_ids'] = np.array(
+            [ids[i] for i in order], dtype=np.int64,
+        )
+        arrays[section + '_offsets'] = np.array(
+            [offsets[i] for i in order] + [len(records)], dtype=np.uint64,
+        )
+
+        Log.out("Kernel cache section", {
+            'section': section,
+            'count': len(ids),
+        })
+
+    arrays['records'] = np.frombuffer(records, dtype=np.uint8)
+
+    path = os.path.join(dataset_dir, KERNEL_CACHE_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write_columns(f, {
+            'sections': list(KERNEL_CACHE_SECTIONS.keys()),
+        }, arrays)
+    os.rename(tmp_path, path)
+
+    Log.out("Kernel cache built", {
+        'path': path,
+        'size': os.path.getsize(path),
+    })
+
+    return path
+
+
+def kernel_cache_path(
+        dataset_dir: str,
+) -> typing.Optional[str]:
+    """ Path of the kernel cache of `dataset_dir` if it exists and is not
+    older than the JSONL dumps it was built from.
+    """
+    path = os.path.join(dataset_dir, KERNEL_CACHE_FILE)
+    if not os.path.isfile(path):
+        return None
+
+    for section in KERNEL_CACHE_SECTIONS:
+        src = os.path.join(dataset_dir, KERNEL_CACHE_SECTIONS[section][0])
+        if os.path.isfile(src) and \
+                os.path.getmtime(src) > os.path.getmtime(path):
+            return None
+
+    return path
+
+
+class KernelRecords(collections.abc.Mapping):
+    """ Read-only id to record mapping over a memory-mapped kernel cache
+    section, records are unpacked on access.
+    """
+    def __init__(
+            self,
+            ids: np.ndarray,
+            offsets: np.ndarray,
+            records: np.ndarray,
+    ) -> None:
+        self._ids = ids
+        self._offsets = offsets
+        self._records = memoryview(records)
+
+    def position(
+            self,
+            key,
+    ) -> int:
+        i = int(np.searchsorted(self._ids, key))
+        if i >= len(self._ids) or self._ids[i] != key:
+            return -1
+        return i
+
+    def __getitem__(
+            self,
+            key,
+    ):
+        i = self.position(key)
+        if i < 0:
+            raise KeyError(key)
+        value, _ = unpack_record(self._records, int(self._offsets[i]))
+        return value
+
+    def __contains__(
+            self,
+            key,
+    ) -> bool:
+        return self.position(key) >= 0
+
+    def __iter__(
+            self,
+    ):
+        for i in self._ids:
+            yield int(i)
+
+    def __len__(
+            self,
+    ) -> int:
+        return len(self._ids)
+
+
+def map_kernel_cache(
+        path: str,
+) -> typing.Dict[str, KernelRecords]:
+    """ Memory-maps a kernel cache, returns its sections by name.
+    """
+    header, columns = map_columns(path)
+
+    return {
+        section: KernelRecords(
+            columns[section + '_ids'],
+            columns[section + '_offsets'],
+            columns['records'],
+        ) for section in header['sections']
+    }
@@ -1,10 +1,10 @@
-import gzip
 import os
-import pickle
 import re
 import typing
 
-from prooftrace.prooftrace import PREPARE_TOKENS, Action, ProofTraceTokenizer
+from prooftrace.prooftrace import \
+    PREPARE_TOKENS, Action, ProofTraceTokenizer, TraceAliases
+from prooftrace.rollout import Rollout
 
 from torch.utils.data import Dataset
 
@@ -45,14 +45,21 @@ def trh_extract(
         trh_actions += [[]]
         trh_lefts += [[]]
         trh_rights += [[]]
+
+        # Position index of the (padded) arguments, equivalent to
+        # `arg[b].index` without the quadratic scans.
+        positions = {}
+        for i, a in enumerate(arg[b]):
+            positions.setdefault(id(a), i)
+
         for i in range(len(trh[b])):
             trh_actions[b] += [trh[b][i].value - len(PREPARE_TOKENS)]
             if trh[b][i].value == 0 or trh[b][i].value == 21:
                 trh_lefts[b] += [1]
                 trh_rights[b] += [1]
             else:
-                trh_lefts[b] += [arg[b].index(trh[b][i].left)]
-                trh_rights[b] += [arg[b].index(trh[b][i].right)]
+                trh_lefts[b] += [positions[id(trh[b][i].left)]]
+                trh_rights[b] += [positions[id(trh[b][i].right)]]
 
     return trh_actions, trh_lefts, trh_rights
 
@@ -63,22 +70,30 @@ class ProofTraceLMDataset(Dataset):
             rollout_dir: str,
             sequence_length: int,
             tokenizer: ProofTraceTokenizer,
+            aliases: TraceAliases = None,
     ) -> None:
         self._sequence_length = sequence_length
         self._tokenizer = tokenizer
 
+        if aliases is None:
+            aliases = TraceAliases()
+
         self._rdirs = []
 
+        # Rollout directories are named after their trace, those of aliased
+        # traces (bootstrapped before deduplication) are skipped.
         assert os.path.isdir(rollout_dir)
         self._rdirs = [
             os.path.join(rollout_dir, f)
             for f in os.listdir(rollout_dir)
-            if os.path.isdir(os.path.join(rollout_dir, f))
+            if os.path.isdir(os.path.join(rollout_dir, f)) and
+            not aliases.is_alias(f)
         ]
 
         Log.out(
             "Loaded extracted ProofTraces Rollout Dataset", {
                 'cases': len(self._rdirs),
+                'aliases': aliases.len(),
             })
 
     def __len__(
@@ -102,8 +117,7 @@ class ProofTraceLMDataset(Dataset):
             for f in os.listdir(rdir) if re.search(".rollout$", f)
         ], reverse=True)
 
-        with gzip.open(rfiles[0], 'rb') as f:
-            rollout = pickle.load(f)
+        rollout = Rollout.load(rfiles[0])
 
         # `actions/arguemnts` are going from 0 to `ptra.len()-1` padded with
         # EXTRACT (removing final QED). `truth` is going from 1 to `ptra.len()`
@@ -190,8 +190,7 @@ def extract():
             Log.out("Loading ProofTraceActions", {
                 'path': p,
             })
-            with gzip.open(p, 'rb') as f:
-                ptra = pickle.load(f)
+            ptra = ProofTraceActions.load(p)
             Log.out("Embedding ProofTraceActions", {
                 'name': ptra.name(),
             })
@@ -11,6 +11,8 @@ from flask import render_template, jsonify
 
 from eventlet.green import threading
 
+from prooftrace.prooftrace import ProofTraceActions
+
 from utils.config import Config
 from utils.log import Log
 from utils.str2bool import str2bool
@@ -113,19 +115,18 @@ def run():
         Log.out("Loading ProofTraceActions", {
             'path': p,
         })
-        with gzip.open(p, 'rb') as f:
-            ptra = pickle.load(f)
-            _traces[ptra.name()] = {'actions': []}
-            for i in range(ptra.len()):
-                action = dict(ptra.actions()[i])
-                argument = dict(ptra.arguments()[i])
-
-                if 'hyp' in argument:
-                    action['hyp'] = argument['hyp']
-                    action['ccl'] = argument['ccl']
-                action['hash'] = argument['hash']
-
-                _traces[ptra.name()]['actions'].append(action)
+        ptra = ProofTraceActions.load(p)
+        _traces[ptra.name()] = {'actions': []}
+        for i in range(ptra.len()):
+            action = dict(ptra.actions()[i])
+            argument = dict(ptra.arguments()[i])
+
+            if 'hyp' in argument:
+                action['hyp'] = argument['hyp']
+                action['ccl'] = argument['ccl']
+            action['hash'] = argument['hash']
+
+            _traces[ptra.name()]['actions'].append(action)
 
     t = threading.Thread(target=run_server)
     t.start()
@@ -9,9 +9,11 @@ import torch.nn as nn
 import torch.optim as optim
 
 from generic.iota import IOTAAck, IOTASyn
+from generic.tree_lstm import hash_version_set
 
 from prooftrace.dataset import ProofTraceLMDataset, lm_collate, trh_extract
 from prooftrace.models.model import LModel
+from prooftrace.prooftrace import TraceAliases
 
 from tensorboardX import SummaryWriter
 
@@ -545,6 +547,8 @@ def ack_run():
     if config.get('device') != 'cpu':
         torch.cuda.set_device(torch.device(config.get('device')))
 
+    hash_version_set(config.get('prooftrace_hash_version'))
+
     with gzip.open(
             os.path.join(
                 os.path.expanduser(config.get('prooftrace_dataset_dir')),
@@ -561,6 +565,10 @@ def ack_run():
         ),
         config.get('prooftrace_sequence_length'),
         tokenizer,
+        TraceAliases.load(os.path.join(
+            os.path.expanduser(config.get('prooftrace_dataset_dir')),
+            config.get('prooftrace_dataset_size'),
+        )),
     )
 
     ack = ACK(config, train_dataset)
@@ -621,6 +629,8 @@ def tst_run():
     if config.get('device') != 'cpu':
         torch.cuda.set_device(torch.device(config.get('device')))
 
+    hash_version_set(config.get('prooftrace_hash_version'))
+
     with gzip.open(
             os.path.join(
                 os.path.expanduser(config.get('prooftrace_dataset_dir')),
@@ -637,6 +647,10 @@ def tst_run():
         ),
         config.get('prooftrace_sequence_length'),
         tokenizer,
+        TraceAliases.load(os.path.join(
+            os.path.expanduser(config.get('prooftrace_dataset_dir')),
+            config.get('prooftrace_dataset_size'),
+        )),
     )
 
     tst = TST(config, test_dataset)
@@ -707,6 +721,8 @@ def syn_run():
     if config.get('device') != 'cpu':
         torch.cuda.set_device(torch.device(config.get('device')))
 
+    hash_version_set(config.get('prooftrace_hash_version'))
+
     syn = SYN(config).load(True)
 
     while True:
@@ -9,6 +9,8 @@ import time
 import torch
 
 from generic.iota import IOTACtl, IOTAWrk
+from generic.tree_lstm import \
+    intern_enable, intern_table, hash_version_set
 
 from prooftrace.models.model import LModel
 from prooftrace.prooftrace import ProofTraceActions, INV_PREPARE_TOKENS
@@ -57,6 +59,10 @@ class WRK():
 
         self._type = config.get('prooftrace_search_type')
 
+        if config.get('prooftrace_intern_table') is not None:
+            intern_enable(config.get('prooftrace_intern_table') == 'weak')
+        hash_version_set(config.get('prooftrace_hash_version'))
+
         Log.out('WRK initialization', {})
 
     def update(
@@ -100,10 +106,9 @@ class WRK():
             return
 
         path = rfiles[0]
-        with gzip.open(path, 'rb') as f:
-            base = pickle.load(f)
+        base = Rollout.load(path)
 
-        ground = base.positive()
+        ground = base.positive().intern()
         name = base.name()
 
         ptra = ProofTraceActions(
@@ -155,11 +160,14 @@ class WRK():
             step_start = time.time()
             done, ptra, proved = search.step()
             step_end = time.time()
+            cache = self._model.modules()['pE'].cache_stats(True)
             Log.out('STEP', {
                 'i': i,
                 'done': done,
                 'proved': proved,
                 'time': "{:.2f}".format(step_end - step_start),
+                'cache_hits': cache['hits'],
+                'cache_misses': cache['misses'],
             })
             if done:
                 break
@@ -182,6 +190,9 @@ class WRK():
             'demo_delta': demo_delta
         })
 
+        if intern_table() is not None:
+            Log.out("INTERN", intern_table().stats())
+
         if proved:
             Log.out("PTRA", {
                 'name': name,
@@ -210,10 +221,7 @@ class WRK():
             tmp_path = os.path.join(rdir, "{}_{}.tmp".format(now, rnd))
             fnl_path = os.path.join(rdir, "{}_{}.rollout".format(now, rnd))
 
-            with gzip.open(tmp_path, 'wb') as f:
-                pickle.dump(
-                    base, f, protocol=pickle.HIGHEST_PROTOCOL
-                )
+            base.dump(tmp_path)
             os.rename(tmp_path, fnl_path)
 
             del base
@@ -1,12 +1,20 @@
+import argparse
+import collections
+import os
+import time
 import torch
 import torch.nn as nn
 import typing
 
 from prooftrace.prooftrace import \
-    Term, Type, Action, \
+    Term, Type, Action, ProofTraceActions, TraceAliases, \
     PROOFTRACE_TOKENS
 
-from generic.tree_lstm import BinaryTreeLSTM
+from generic.tree_lstm import \
+    BatchPlan, BinaryTreeLSTM, batch_vectorize_enable, batch_routed_enable
+
+from utils.config import Config
+from utils.log import Log
 
 
 class TypeEmbedder(nn.Module):
@@ -37,7 +45,7 @@ class TypeEmbedder(nn.Module):
 
     def forward(
             self,
-            types: typing.List[Type],
+            types: typing.Union[typing.List[Type], BatchPlan],
     ):
         def embedder(values):
             return self.type_token_embedder(
@@ -71,11 +79,20 @@ class TermEmbedder(nn.Module):
         self.tree_lstm = BinaryTreeLSTM(self.hidden_size)
         self.tree_lstm.to(self.device)
 
+        # Eval-mode caches of the term and type states, each given a third of
+        # the embedder cache budget (the last third goes to E).
+        cache_bytes = \
+            config.get('prooftrace_embedder_cache_mb') * 1024 * 1024 // 3
+        self.tree_lstm.cache_enable(cache_bytes)
+        self.type_embedder.tree_lstm.cache_enable(cache_bytes)
+
+    @staticmethod
     def extract_values(
-            self,
             terms: typing.List[Term],
-    ) -> typing.List[Type]:
-        seen = {}
+            seen: typing.Dict = None,
+    ) -> typing.Tuple[typing.List[Type], typing.List[int]]:
+        if seen is None:
+            seen = {}
 
         def dfs(term):
             if term.hash() in seen:
@@ -119,22 +136,41 @@ class TermEmbedder(nn.Module):
 
     def forward(
             self,
-            terms: typing.List[Term],
+            terms: typing.Union[typing.List[Term], 'TermPlan'],
+            type_embeds: typing.Dict = None,
     ):
-        cache = {}
+        """ Embeds terms (or the roots of a TermPlan)
+
+        The embeddings of the types of the plan are also stored by hash in
+        `type_embeds` if provided.
+        """
+        plan = terms
+        if not isinstance(plan, TermPlan):
+            plan = TermPlan(
+                terms,
+                self.tree_lstm.known(),
+                self.type_embedder.tree_lstm.known(),
+            )
 
-        types, tokens = self.extract_values(terms)
+        cache = {}
 
-        if len(types) > 0:
-            types_embeds = self.type_embedder(types)
-            for i, ty in enumerate(types):
+        if plan.types.len() > 0:
+            types_embeds = self.type_embedder(plan.types)
+            for i, ty in enumerate(plan.types.roots()):
                 cache[ty.hash()] = types_embeds[i].unsqueeze(0)
+                if type_embeds is not None:
+                    type_embeds[ty.hash()] = cache[ty.hash()]
+
+        if plan.len() == 0:
+            return torch.zeros(0, self.hidden_size).to(self.device)
 
-        if len(tokens) > 0:
+        if len(plan.tokens) > 0:
             tokens_embeds = self.term_token_embedder(
-                torch.tensor(tokens, dtype=torch.int64).to(self.device),
+                torch.tensor(
+                    plan.tokens, dtype=torch.int64,
+                ).to(self.device),
             )
-            for i, v in enumerate(tokens):
+            for i, v in enumerate(plan.tokens):
                 cache[v] = tokens_embeds[i].unsqueeze(0)
 
         def embedder(values):
@@ -146,7 +182,7 @@ class TermEmbedder(nn.Module):
                     embeds[idx] = cache[v]
             return torch.cat(embeds, dim=0)
 
-        h, _ = self.tree_lstm.batch(terms, embedder)
+        h, _ = self.tree_lstm.batch(plan, embedder)
         return h
 
 
@@ -171,11 +207,23 @@ class E(nn.Module):
         self.tree_lstm = BinaryTreeLSTM(self.hidden_size)
         self.tree_lstm.to(self.device)
 
+        # LRU of the plans of single action sequences, keyed by the hashes of
+        # their actions (see `plan`).
+        self._plan_cache_size = \
+            config.get('prooftrace_embedder_plan_cache_size')
+        self._plans = collections.OrderedDict()
+
+        self.tree_lstm.cache_enable(
+            config.get('prooftrace_embedder_cache_mb') * 1024 * 1024 // 3,
+        )
+
+    @staticmethod
     def extract_values(
-            self,
             actions: typing.List[Action],
-    ) -> typing.List[Term]:
-        seen = {}
+            seen: typing.Dict = None,
+    ) -> typing.Tuple[typing.List[Term], typing.List[Type]]:
+        if seen is None:
+            seen = {}
 
         def dfs(action):
             if action.hash() in seen:
@@ -217,30 +265,63 @@ class E(nn.Module):
     ):
         return sum(p.numel() for p in self.parameters() if p.requires_grad)
 
-    def forward(
+    def plan(
             self,
             actions: typing.List[
                 typing.List[Action],
             ]
-    ):
-        flat = []
+    ) -> 'ActionPlan':
+        """ Compiles the ActionPlan of a batch of action sequences
+
+        The plans of single sequences are cached, the plan of the batch is
+        their merge, so that training epochs over the same traces do not
+        walk their trees again. In eval mode with the states caches enabled,
+        plans skip the cached subtrees instead (and are not cached).
+        """
+        known = self.tree_lstm.known()
+        if known is not None:
+            return ActionPlan(
+                actions,
+                known,
+                self.term_embedder.tree_lstm.known(),
+                self.term_embedder.type_embedder.tree_lstm.known(),
+            )
+
+        if self._plan_cache_size == 0:
+            return ActionPlan(actions)
+
+        plan = ActionPlan()
         for a in actions:
-            flat += a
+            key = tuple(action.hash() for action in a)
+            if key in self._plans:
+                self._plans.move_to_end(key)
+            else:
+                self._plans[key] = ActionPlan([a])
+                if len(self._plans) > self._plan_cache_size:
+                    self._plans.popitem(last=False)
+            plan.absorb(self._plans[key])
 
-        cache = {}
+        return plan
+
+    def forward(
+            self,
+            actions: typing.Union[typing.List[
+                typing.List[Action],
+            ], 'ActionPlan'],
+    ):
+        plan = actions
+        if not isinstance(plan, ActionPlan):
+            plan = self.plan(actions)
 
-        terms, types = self.extract_values(flat)
+        cache = {}
 
-        if len(terms) > 0:
-            terms_embeds = self.term_embedder(terms)
-            for i, tm in enumerate(terms):
+        # The types carried by actions share their plan with the types of the
+        # terms, so that they are all embedded in a single batch.
+        if plan.terms.len() > 0 or plan.types.len() > 0:
+            terms_embeds = self.term_embedder(plan.terms, cache)
+            for i, tm in enumerate(plan.terms.roots()):
                 cache[tm.hash()] = terms_embeds[i].unsqueeze(0)
 
-        if len(types) > 0:
-            types_embeds = self.term_embedder.type_embedder(types)
-            for i, ty in enumerate(types):
-                cache[ty.hash()] = types_embeds[i].unsqueeze(0)
-
         tokens_embeds = self.action_token_embedder(
             torch.tensor(
                 list(PROOFTRACE_TOKENS.values()),
@@ -261,10 +342,349 @@ class E(nn.Module):
                     embeds[idx] = cache[v]
             return torch.cat(embeds, dim=0)
 
-        h, _ = self.tree_lstm.batch(flat, embedder)
+        h, _ = self.tree_lstm.batch(plan, embedder)
 
         # This assumes that all received action lists have equal size.
         return torch.cat(
-            [t.unsqueeze(0) for t in torch.chunk(h, len(actions), dim=0)],
+            [t.unsqueeze(0) for t in torch.chunk(h, plan.sequences, dim=0)],
             dim=0,
         )
+
+    def cache_stats(
+            self,
+            reset: bool = False,
+    ) -> typing.Dict[str, int]:
+        """ Aggregated stats of the states caches of the three TreeLSTMs
+        """
+        stats = {
+            'hits': 0,
+            'misses': 0,
+            'entries': 0,
+            'bytes': 0,
+        }
+        for m in [
+                self.tree_lstm,
+                self.term_embedder.tree_lstm,
+                self.term_embedder.type_embedder.tree_lstm,
+        ]:
+            if m.cache is not None:
+                for k, v in m.cache.stats(reset).items():
+                    if k in stats:
+                        stats[k] += v
+
+        return stats
+
+    def joint(
+            self,
+            actions: typing.List[
+                typing.List[Action],
+            ],
+            arguments: typing.List[
+                typing.List[Action],
+            ],
+    ) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        """ Embeds actions and arguments in a single planned pass
+
+        Arguments mostly point to the actions of their sequence, planning
+        them together embeds their shared subtrees (and terms and types)
+        once. All sequences are expected to have equal lengths.
+        """
+        embeds = self.forward(self.plan(actions + arguments))
+
+        return embeds[:len(actions)], embeds[len(actions):]
+
+
+def extract_seen(
+        plan: BatchPlan,
+) -> typing.Mapping:
+    """ Values seen by the extraction of a plan, including its known nodes
+    whose subtrees are not walked.
+    """
+    if plan._known is None:
+        return plan._seen
+    return collections.ChainMap(plan._seen, plan._known)
+
+
+class TermPlan(BatchPlan):
+    """ BatchPlan of terms along with the plan of their types and their token
+    values, which are embedded directly.
+    """
+    def __init__(
+            self,
+            terms: typing.List[Term] = (),
+            known: typing.Mapping = None,
+            types_known: typing.Mapping = None,
+    ) -> None:
+        self.types = BatchPlan(known=types_known)
+        self.tokens = []
+        self._seen = {}
+
+        super(TermPlan, self).__init__(terms, known)
+
+    def extend(
+            self,
+            terms: typing.List[Term],
+    ):
+        types, tokens = TermEmbedder.extract_values(terms, extract_seen(self))
+        self.types.extend(types)
+        self.tokens += tokens
+
+        return super(TermPlan, self).extend(terms)
+
+    def absorb(
+            self,
+            other,
+    ):
+        self.types.absorb(other.types)
+        self.tokens += [t for t in other.tokens if t not in self._seen]
+        self._seen.update(other._seen)
+
+        return super(TermPlan, self).absorb(other)
+
+    def copy(
+            self,
+    ):
+        plan = super(TermPlan, self).copy()
+
+        plan.types = self.types.copy()
+        plan.tokens = list(self.tokens)
+        plan._seen = dict(self._seen)
+
+        return plan
+
+
+class ActionPlan(BatchPlan):
+    """ BatchPlan of action sequences along with the plans of the terms and
+    types they carry.
+
+    Sequences are flattened, `sequences` counts them to split the
+    embeddings back (they are expected to have equal lengths). The types
+    carried by actions are planned along with the types of the terms.
+    """
+    def __init__(
+            self,
+            actions: typing.List[
+                typing.List[Action],
+            ] = (),
+            known: typing.Mapping = None,
+            terms_known: typing.Mapping = None,
+            types_known: typing.Mapping = None,
+    ) -> None:
+        self.terms = TermPlan(known=terms_known, types_known=types_known)
+        self.types = self.terms.types
+        self.sequences = len(actions)
+        self._seen = {}
+
+        flat = []
+        for a in actions:
+            flat += a
+
+        super(ActionPlan, self).__init__(flat, known)
+
+    def extend(
+            self,
+            actions: typing.List[Action],
+    ):
+        terms, types = E.extract_values(actions, extract_seen(self))
+        self.terms.extend(terms)
+        self.types.extend(types)
+
+        return super(ActionPlan, self).extend(actions)
+
+    def absorb(
+            self,
+            other,
+    ):
+        self.terms.absorb(other.terms)
+        self.sequences += other.sequences
+        self._seen.update(other._seen)
+
+        return super(ActionPlan, self).absorb(other)
+
+    def copy(
+            self,
+    ):
+        plan = super(ActionPlan, self).copy()
+
+        plan.terms = self.terms.copy()
+        plan.types = plan.terms.types
+        plan._seen = dict(self._seen)
+
+        return plan
+
+
+def bench():
+    """ Benchmark of the vectorized `BinaryTreeLSTM.batch` against its legacy
+    implementation on batches of extracted traces, in eval mode (forward
+    only) and in train mode (forward and backward, comparing gradients).
+    """
+    parser = argparse.ArgumentParser(description="")
+
+    parser.add_argument(
+        'config_path',
+        type=str, help="path to the config file",
+    )
+    parser.add_argument(
+        '--dataset_size',
+        type=str, help="config override",
+    )
+    parser.add_argument(
+        '--device',
+        type=str, help="config override",
+    )
+    parser.add_argument(
+        '--limit',
+        type=int, default=32, help="number of traces to embed",
+    )
+
+    args = parser.parse_args()
+
+    config = Config.from_file(args.config_path)
+
+    if args.dataset_size is not None:
+        config.override(
+            'prooftrace_dataset_size',
+            args.dataset_size,
+        )
+    if args.device is not None:
+        config.override('device', args.device)
+
+    dataset_dir = os.path.join(
+        os.path.expanduser(config.get('prooftrace_dataset_dir')),
+        config.get('prooftrace_dataset_size'),
+        'train_traces'
+    )
+    files = TraceAliases.load(
+        os.path.dirname(dataset_dir),
+    ).trace_files(dataset_dir)[:args.limit]
+
+    # Batches are padded as in the LM dataset, with EXTRACT actions and EMPTY
+    # arguments.
+    sequence_length = config.get('prooftrace_sequence_length')
+    batch_size = config.get('prooftrace_lm_batch_size')
+
+    ptras = [ProofTraceActions.load(p) for p in files]
+    batches = []
+    for i in range(0, len(ptras), batch_size):
+        chunk = ptras[i:i+batch_size]
+        length = min(max(p.len() for p in chunk), sequence_length)
+
+        actions = []
+        arguments = []
+        for ptra in chunk:
+            empty = ptra.actions()[1]
+            extract = Action.from_action('EXTRACT', empty, empty)
+            act = ptra.actions()[:length]
+            arg = ptra.arguments()[:length]
+            actions.append(act + [extract] * (length - len(act)))
+            arguments.append(arg + [empty] * (length - len(arg)))
+        batches.append((actions, arguments))
+
+    # The states caches would serve the second run from the first one.
+    config.override('prooftrace_embedder_cache_mb', 0)
+
+    model = E(config).to(torch.device(config.get('device')))
+    model.eval()
+
+    tree_lstms = [
+        model.tree_lstm,
+        model.term_embedder.tree_lstm,
+        model.term_embedder.type_embedder.tree_lstm,
+    ]
+
+    def run():
+        embeds = []
+        counters = {
+            'cache_hits': 0,
+            'compute_steps': 0,
+        }
+        start = time.time()
+        with torch.no_grad():
+            for actions, arguments in batches:
+                for sequences in [actions, arguments]:
+                    embeds.append(model(sequences))
+                    for m in tree_lstms:
+                        for k in counters:
+                            counters[k] += m.counters[k]
+        return embeds, counters, time.time() - start
+
+    results = {}
+    for vectorized in [False, True]:
+        batch_vectorize_enable(vectorized)
+        embeds, counters, duration = run()
+        results[vectorized] = embeds
+        Log.out("TreeLSTM batch benchmark", {
+            "vectorized": vectorized,
+            "traces_count": len(ptras),
+            "batches_count": len(batches),
+            "compute_steps": counters['compute_steps'],
+            "cache_hits": counters['cache_hits'],
+            "time": "{:.2f}".format(duration),
+            "batches_per_second": "{:.2f}".format(len(batches) / duration),
+        })
+
+    batch_vectorize_enable(True)
+
+    max_diff = 0.0
+    for legacy, vectorized in zip(results[False], results[True]):
+        max_diff = max(max_diff, (legacy - vectorized).abs().max().item())
+
+    Log.out("TreeLSTM batch equality", {
+        "max_abs_diff": "{:.3e}".format(max_diff),
+    })
+
+    # Training runs forward and backward passes with gradients enabled, where
+    # `batch` does not use its shared buffer. Gradients of `batch_routed` are
+    # compared against `batch_legacy`, the default training path.
+    model.train()
+
+    def run_train():
+        model.zero_grad()
+        embeds = []
+        start = time.time()
+        for actions, arguments in batches:
+            loss = 0.0
+            for sequences in [actions, arguments]:
+                embed = model(sequences)
+                embeds.append(embed.detach())
+                loss = loss + embed.sum()
+            loss.backward()
+        grads = {}
+        for name, p in model.named_parameters():
+            if p.grad is not None:
+                grads[name] = p.grad.clone()
+        return embeds, grads, time.time() - start
+
+    results = {}
+    for routed in [False, True]:
+        batch_routed_enable(routed)
+        embeds, grads, duration = run_train()
+        results[routed] = (embeds, grads)
+        Log.out("TreeLSTM train batch benchmark", {
+            "routed": routed,
+            "traces_count": len(ptras),
+            "batches_count": len(batches),
+            "time": "{:.2f}".format(duration),
+            "batches_per_second": "{:.2f}".format(len(batches) / duration),
+        })
+
+    batch_routed_enable(False)
+
+    max_diff = 0.0
+    for legacy, routed in zip(results[False][0], results[True][0]):
+        max_diff = max(max_diff, (legacy - routed).abs().max().item())
+
+    legacy_grads, grads = results[False][1], results[True][1]
+    assert legacy_grads.keys() == grads.keys()
+    grad_max_diff = 0.0
+    for name in grads:
+        grad_max_diff = max(
+            grad_max_diff,
+            (legacy_grads[name] - grads[name]).abs().max().item(),
+        )
+
+    Log.out("TreeLSTM train batch equality", {
+        "max_abs_diff": "{:.3e}".format(max_diff),
+        "grad_max_abs_diff": "{:.3e}".format(grad_max_diff),
+        "grad_count": len(grads),
+    })
@@ -121,8 +121,7 @@ class LModel:
     ) -> typing.Tuple[
         torch.Tensor, torch.Tensor, torch.Tensor,
     ]:
-        action_embeds = self._modules['pE'](act)
-        argument_embeds = self._modules['pE'](arg)
+        action_embeds, argument_embeds = self._modules['pE'].joint(act, arg)
 
         hiddens = self._modules['pT'](action_embeds, argument_embeds)
 
@@ -1,21 +1,30 @@
 import argparse
 import base64
+import collections
 import concurrent.futures
-import copy
 import gzip
 import json
+import multiprocessing
 import os
 import pickle
+import random
 import re
+import resource
 import shutil
+import struct
 import sys
+import threading
+import time
 import typing
 import xxhash
 
-from generic.tree_lstm import BVT
+from generic.tree_lstm import \
+    BVT, intern, intern_tree, hash_version, hash_version_set, rehash_all, \
+    flatten, unflatten
 
 from utils.config import Config
 from utils.log import Log
+from utils.str2bool import str2bool
 
 TEST_FILTER = [
     'IRRATIONAL_SQRT_NONSQUARE',
@@ -86,7 +95,48 @@ class TypeException(Exception):
     pass
 
 
+# Side table of the string tokens of Term and Type nodes. Nodes only store
+# the small integer id of their token, which is process-local: tokens are
+# always pickled as strings.
+_TOKENS = [None]
+_TOKEN_IDS = {None: 0}
+_TOKENS_LOCK = threading.Lock()
+
+
+def token_id(
+        token: str,
+) -> int:
+    idx = _TOKEN_IDS.get(token)
+    if idx is None:
+        with _TOKENS_LOCK:
+            idx = _TOKEN_IDS.get(token)
+            if idx is None:
+                idx = len(_TOKENS)
+                _TOKENS.append(token)
+                _TOKEN_IDS[token] = idx
+    return idx
+
+
+# Whether Term/Type string renderings are memoized on the nodes. Only meant
+# to be disabled for benchmarking.
+_string_cache = True
+
+
+def string_cache_enable(
+        enabled: bool = True,
+) -> None:
+    global _string_cache
+    _string_cache = enabled
+
+
+# Marker pushed on rendering stacks to memoize the string rendered since a
+# given output offset on a node.
+_STORE = object()
+
+
 class Type(BVT):
+    __slots__ = ('_token', '_string')
+
     def __init__(
             self,
             value: typing.Any,
@@ -97,55 +147,114 @@ class Type(BVT):
         super(Type, self).__init__(
             value, left, right
         )
-        # `self._token` stores the associated string token so that we can
-        # reconstruct type strings directly from their BVT.
-        self._token = token
+        # `self._token` stores the id of the associated string token so that
+        # we can reconstruct type strings directly from their BVT.
+        self._token = token_id(token)
+        # `self._string` memoizes the rendering of the type (without infix
+        # context and leading ':').
+        self._string = None
+
+    def __getstate__(
+            self,
+    ):
+        state = super(Type, self).__getstate__()
+        state['_token'] = self.token()
+        del state['_string']
+        return state
+
+    def __setstate__(
+            self,
+            state,
+    ):
+        self._string = None
+        super(Type, self).__setstate__(state)
+        self._token = token_id(self._token)
 
     def token(
             self,
     ) -> str:
-        return self._token
+        return _TOKENS[self._token]
+
+    def key(
+            self,
+    ):
+        return super(Type, self).key() + (self._token,)
 
     def type_string(
             self,
     ) -> str:
         """ `type_string` formats the Type BVT as a HOL Light type string
+
+        Rendering uses an explicit stack of pending pieces (strings or
+        `(type, infix)` pairs to expand) so that it is not bound by the
+        recursion limit. Renderings without infix context are memoized on the
+        nodes and reused by the types that contain them.
         """
-        def dump(typ, ifx):
+        if self._string is not None:
+            return ':' + self._string
+
+        out = []
+        stack = [(self, None)]
+        while len(stack) > 0:
+            item = stack.pop()
+            if type(item) is str:
+                out.append(item)
+                continue
+            if item[0] is _STORE:
+                _, typ, start = item
+                string = ''.join(out[start:])
+                del out[start:]
+                out.append(string)
+                typ._string = string
+                continue
+
+            typ, ifx = item
             assert typ.left is not None
+
+            if ifx is None:
+                if typ._string is not None:
+                    out.append(typ._string)
+                    continue
+                if _string_cache:
+                    stack.append((_STORE, typ, len(out)))
+
             if typ.token() == '__v':
                 token = typ.left.token()
                 if token[0] == '?':
-                    return '(_?_'+token[1:] + ')'
+                    out.append('(_?_' + token[1:] + ')')
                 else:
-                    return token
-            if typ.token() == '__a':
+                    out.append(token)
+            elif typ.token() == '__a':
                 if typ.right is None:
                     assert ifx is None
-                    return dump(typ.left, None)
-                elif ifx is not None:
-                    return dump(typ.left, None) + ifx + dump(typ.right, None)
+                    stack.append((typ.left, None))
                 else:
-                    return dump(typ.left, None) + "," + dump(typ.right, None)
-            if typ.token() == '__c':
+                    stack.append((typ.right, None))
+                    stack.append(ifx if ifx is not None else ',')
+                    stack.append((typ.left, None))
+            elif typ.token() == '__c':
                 token = typ.left.token()
-                if token == 'fun':
-                    if typ.right is None:
-                        raise TypeException()
-                    return "(" + dump(typ.right, "->") + ")"
-                if token == 'prod':
+                if token == 'fun' or token == 'prod':
                     if typ.right is None:
                         raise TypeException()
-                    return "(" + dump(typ.right, "#") + ")"
-                if typ.right is None:
-                    return token
+                    stack.append(')')
+                    stack.append((typ.right, '->' if token == 'fun' else '#'))
+                    stack.append('(')
+                elif typ.right is None:
+                    out.append(token)
                 else:
-                    return "(" + dump(typ.right, None) + ")" + token
+                    stack.append(')' + token)
+                    stack.append((typ.right, None))
+                    stack.append('(')
+            else:
+                assert False
 
-        return ':' + dump(self, None)
+        return ':' + ''.join(out)
 
 
 class Term(BVT):
+    __slots__ = ('_token', '_strings')
+
     def __init__(
             self,
             value: typing.Any,
@@ -156,14 +265,38 @@ class Term(BVT):
         super(Term, self).__init__(
             value, left, right
         )
-        # `self._token` stores the associated string token so that we can
-        # reconstruct term strings directly from their BVT.
-        self._token = token
+        # `self._token` stores the id of the associated string token so that
+        # we can reconstruct term strings directly from their BVT.
+        self._token = token_id(token)
+        # `self._strings` memoizes the renderings of the term keyed by
+        # `(de_bruijn, skip_type)` (lazily allocated).
+        self._strings = None
+
+    def __getstate__(
+            self,
+    ):
+        state = super(Term, self).__getstate__()
+        state['_token'] = self.token()
+        del state['_strings']
+        return state
+
+    def __setstate__(
+            self,
+            state,
+    ):
+        self._strings = None
+        super(Term, self).__setstate__(state)
+        self._token = token_id(self._token)
 
     def token(
             self,
     ) -> str:
-        return self._token
+        return _TOKENS[self._token]
+
+    def key(
+            self,
+    ):
+        return super(Term, self).key() + (self._token,)
 
     def term_string(
             self,
@@ -171,8 +304,21 @@ class Term(BVT):
             skip_type: bool = False,
     ) -> str:
         """ `term_string` formats the Term BVT as a HOL Light term string
+
+        Rendering uses an explicit stack of pending pieces (strings or
+        `(term, bounded)` pairs to expand) so that it is not bound by the
+        recursion limit. Applications are expanded by walking down their left
+        spine to collect their arguments.
+
+        Renderings that do not depend on enclosing binders (all of them unless
+        `de_bruijn`, only closed contexts otherwise) are memoized on the nodes
+        per `(de_bruijn, skip_type)` and reused by the terms that contain them.
         """
-        def v_term(term, bounded=[]):
+        key = (de_bruijn, skip_type)
+        if self._strings is not None and key in self._strings:
+            return self._strings[key]
+
+        def v_term(term, bounded):
             assert term.token() == '__v'
             if skip_type:
                 return term.left.token()
@@ -189,68 +335,112 @@ class Term(BVT):
                         return '(b' + str(i) + typ + ')'
             return tm
 
-        def dump(term, args, bounded):
-            if term.token() == '__C':
-                right = dump(term.right, [], bounded)
-                return dump(term.left, [right] + args, bounded)
+        out = []
+        stack = [(self, ())]
+        while len(stack) > 0:
+            item = stack.pop()
+            if type(item) is str:
+                out.append(item)
+                continue
+            if item[0] is _STORE:
+                _, term, start = item
+                string = ''.join(out[start:])
+                del out[start:]
+                out.append(string)
+                if term._strings is None:
+                    term._strings = {}
+                term._strings[key] = string
+                continue
+
+            term, bounded = item
+
+            if len(bounded) == 0:
+                if term._strings is not None and key in term._strings:
+                    out.append(term._strings[key])
+                    continue
+                if _string_cache:
+                    stack.append((_STORE, term, len(out)))
+
+            args = []
+            while term.token() == '__C':
+                args.append((term.right, bounded))
+                term = term.left
+            args.reverse()
+
+            # Pieces of the rendered term in output order.
+            pieces = []
+
             if term.token() == '__A':
                 assert term.left.token() == '__v'
-                left = dump(term.left, [], [])
-                right = dump(term.right, [], bounded+[left])
-                left = dump(term.left, [], bounded+[left])
+                left = v_term(term.left, ())
+                # Binders only matter for de Bruijn renderings, keeping
+                # `bounded` empty otherwise lets all subterms be memoized.
+                inner = bounded + (left,) if de_bruijn else ()
+                left = v_term(term.left, inner)
                 if len(args) == 0:
-                    return '(\\' + left + '. ' + right + ')'
+                    pieces = ['(\\' + left + '. ', (term.right, inner), ')']
                 else:
-                    tm = '((\\' + left + '. ' + right + ')'
+                    pieces = ['((\\' + left + '. ', (term.right, inner), ')']
                     for a in args:
-                        tm += ' ' + a
-                    tm += ')'
-                    return tm
-            if term.token() == '__c':
+                        pieces += [' ', a]
+                    pieces += [')']
+            elif term.token() == '__c':
                 assert type(term.right.value) is Type
 
                 if len(args) == 0:
                     if skip_type:
-                        return '(' + term.left.token() + ')'
+                        pieces = ['(' + term.left.token() + ')']
                     else:
-                        return '((' + term.left.token() + ')' + \
+                        pieces = [
+                            '((' + term.left.token() + ')' +
                             term.right.value.type_string() + ')'
+                        ]
+                # This is an attempt at simplyfing terms as much as possible
+                # to make them readable.
+                elif term.left.token() in [
+                        "=", "==>", "/\\", "\\/",
+                ] and len(args) == 2:
+                    pieces = [
+                        '(', args[0],
+                        ' ' + term.left.token() + ' ',
+                        args[1], ')',
+                    ]
                 else:
-                    # This is an attempt at simplyfing terms as much as
-                    # possible to make them readable.
-                    if term.left.token() in [
-                            "=", "==>", "/\\", "\\/",
-                    ] and len(args) == 2:
-                        tm = '(' + args[0] + ' ' + \
-                            term.left.token() + \
-                            ' ' + args[1] + ')'
-                        return tm
+                    if skip_type:
+                        pieces = ['((' + term.left.token() + ')']
                     else:
-                        if skip_type:
-                            tm = '((' + term.left.token() + ')'
-                        else:
-                            tm = '(((' + term.left.token() + ')' + \
-                                term.right.value.type_string() + ')'
-                        for a in args:
-                            tm += ' ' + a
-                        tm += ')'
-                        return tm
-            if term.token() == '__v':
+                        pieces = [
+                            '(((' + term.left.token() + ')' +
+                            term.right.value.type_string() + ')'
+                        ]
+                    for a in args:
+                        pieces += [' ', a]
+                    pieces += [')']
+            elif term.token() == '__v':
                 assert type(term.right.value) is Type
 
                 if len(args) == 0:
-                    return v_term(term, bounded)
+                    pieces = [v_term(term, bounded)]
                 else:
-                    tm = '(' + v_term(term, bounded)
+                    pieces = ['(' + v_term(term, bounded)]
                     for a in args:
-                        tm += ' ' + a
-                    tm += ')'
-                    return tm
+                        pieces += [' ', a]
+                    pieces += [')']
+            else:
+                assert False
+
+            for p in reversed(pieces):
+                stack.append(p)
+
+        return ''.join(out)
 
-        return dump(self, [], [])
+
+HYPOTHESIS_SEED = xxhash.xxh3_64_intdigest(b'HYPOTHESIS')
 
 
 class Action(BVT):
+    __slots__ = ('_index',)
+
     def __init__(
             self,
             value: typing.Any,
@@ -266,30 +456,70 @@ class Action(BVT):
         # action for REPL/Fusion.
         self._index = index
 
-    def hash(
+    def key(
             self,
     ):
-        # Compute a hash that is not order dependent for HYPOTHESIS.
+        # Actions are mutable (`_index` gets updated by the REPL) and are
+        # therefore never interned.
+        return None
+
+    def hypothesis_terms(
+            self,
+    ) -> typing.List[BVT]:
+        """ Term actions under a HYPOTHESIS action, in walk order.
+        """
+        terms = []
+        stack = [self]
+        while len(stack) > 0:
+            h = stack.pop()
+            if h is None:
+                continue
+            if type(h.value) is Term:
+                terms.append(h)
+            stack.append(h.right)
+            stack.append(h.left)
+        return terms
+
+    def hash_children(
+            self,
+    ) -> typing.List[BVT]:
         if self.value == PROOFTRACE_TOKENS['HYPOTHESIS'] and \
-                self._hash is None:
-            hashes = [b'HYPOTHESIS']
+                hash_version() == 1:
+            return self.hypothesis_terms()
+        return super(Action, self).hash_children()
 
-            def walk(h):
-                if h is None:
-                    return
-                if type(h.value) is Term:
-                    hashes.append(h.hash())
-                walk(h.left)
-                walk(h.right)
+    def hash_node(
+            self,
+    ) -> bytes:
+        # Compute a hash that is not order dependent for HYPOTHESIS.
+        if self.value == PROOFTRACE_TOKENS['HYPOTHESIS'] and \
+                hash_version() > 1:
+            # The digest of a HYPOTHESIS chain is the sum (mod 2^64) of the
+            # mixed digests of its terms offset by `HYPOTHESIS_SEED`. Sums
+            # commute, and the sum of the rest of the chain is recovered from
+            # the digest of `self.right`, so each node is hashed in O(1).
+            acc = HYPOTHESIS_SEED
+            if self.left is not None:
+                acc += xxhash.xxh3_64_intdigest(self.left._hash)
+            if self.right is not None:
+                if self.right.value == PROOFTRACE_TOKENS['HYPOTHESIS']:
+                    acc += int.from_bytes(self.right._hash, 'big') - \
+                        HYPOTHESIS_SEED
+                else:
+                    acc += xxhash.xxh3_64_intdigest(self.right._hash)
+            return (acc % (1 << 64)).to_bytes(8, 'big')
 
-            walk(self)
+        if self.value == PROOFTRACE_TOKENS['HYPOTHESIS']:
+            hashes = [b'HYPOTHESIS']
+            for t in self.hypothesis_terms():
+                hashes.append(t._hash)
 
             h = xxhash.xxh64()
             for hh in sorted(hashes):
                 h.update(hh)
-            self._hash = h.digest()
+            return h.digest()
 
-        return super(Action, self).hash()
+        return super(Action, self).hash_node()
 
     def index(
             self,
@@ -322,37 +552,36 @@ class Action(BVT):
             yield 'right', None
 
         def hypothesis(a):
-            if a is None:
-                return []
-            else:
-                return [a.left.value.term_string()] + hypothesis(a.right)
+            hyp = []
+            while a is not None:
+                hyp.append(a.left.value.term_string())
+                a = a.right
+            return hyp
 
         def term(a):
             return a.value.term_string()
 
         def subst(a):
-            if a is None:
-                return []
-            else:
+            pairs = []
+            while a is not None:
                 if a.left is not None:
-                    return [
-                        [a.left.left.value.term_string(),
-                         a.left.right.value.term_string()],
-                    ] + subst(a.right)
-                else:
-                    return [] + subst(a.right)
+                    pairs.append([
+                        a.left.left.value.term_string(),
+                        a.left.right.value.term_string(),
+                    ])
+                a = a.right
+            return pairs
 
         def subst_type(a):
-            if a is None:
-                return []
-            else:
+            pairs = []
+            while a is not None:
                 if a.left is not None:
-                    return [
-                        [a.left.left.value.type_string(),
-                         a.left.right.value.type_string()],
-                    ] + subst_type(a.right)
-                else:
-                    return [] + subst_type(a.right)
+                    pairs.append([
+                        a.left.left.value.type_string(),
+                        a.left.right.value.type_string(),
+                    ])
+                a = a.right
+            return pairs
 
         if INV_PROOFTRACE_TOKENS[self.value] == 'SUBST':
             yield 'subst', subst(self)
@@ -384,10 +613,42 @@ class Action(BVT):
         return Action(term)
 
 
+BRACKETS = re.compile(r"[\(\)\[\]]")
+
+
+def bracket_matches(
+        t: str,
+) -> typing.Dict[int, int]:
+    """ Maps the index of each opening bracket of `t` to its closing bracket.
+
+    Parentheses and square brackets are matched independently, as `split`
+    does, and unmatched closing brackets are ignored.
+    """
+    matches = {}
+    parens = []
+    squares = []
+    for m in BRACKETS.finditer(t):
+        i = m.start()
+        c = t[i]
+        if c == '(':
+            parens.append(i)
+        elif c == '[':
+            squares.append(i)
+        elif c == ')':
+            if parens:
+                matches[parens.pop()] = i
+        elif squares:
+            matches[squares.pop()] = i
+    return matches
+
+
 class ProofTraceTokenizer():
     def __init__(
             self,
+            cache_size: int = 65536,
     ) -> None:
+        self.cache_init(cache_size)
+
         self._type_tokens = {
             '__c': 0,
             '__v': 1,
@@ -404,6 +665,72 @@ class ProofTraceTokenizer():
             '=': 5,
         }
 
+    def __getstate__(
+            self,
+    ):
+        # The parse cache is local to the process.
+        state = dict(self.__dict__)
+        state['_cache'] = None
+        return state
+
+    def __setstate__(
+            self,
+            state,
+    ):
+        self.__dict__.update(state)
+        self.cache_init(state.get('_cache_size', 65536))
+
+    def cache_init(
+            self,
+            cache_size: int,
+    ) -> None:
+        """ Initializes the LRU parse cache of term and type strings.
+
+        Cached trees are shared by all the trees parsed after them. Term and
+        type encodings can't collide (`v(` vs `v[`) so they share the cache.
+        """
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._cache_evictions = 0
+
+    def cache_stats(
+            self,
+    ) -> typing.Dict[str, int]:
+        return {
+            'size': len(self._cache),
+            'hits': self._cache_hits,
+            'misses': self._cache_misses,
+            'evictions': self._cache_evictions,
+        }
+
+    def cache_get(
+            self,
+            key: str,
+    ) -> typing.Optional[BVT]:
+        if self._cache_size == 0:
+            return None
+        tree = self._cache.get(key)
+        if tree is None:
+            self._cache_misses += 1
+        else:
+            self._cache_hits += 1
+            self._cache.move_to_end(key)
+        return tree
+
+    def cache_put(
+            self,
+            key: str,
+            tree: BVT,
+    ) -> None:
+        if self._cache_size == 0 or tree is None:
+            return
+        self._cache[key] = tree
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+            self._cache_evictions += 1
+
     def split(
             self,
             t,
@@ -418,6 +745,153 @@ class ProofTraceTokenizer():
                 if len(stack) == 0:
                     yield t[start + 1: i]
 
+    def groups(
+            self,
+            t: str,
+            matches: typing.Dict[int, int],
+            start: int,
+            end: int,
+            sep: str,
+    ) -> typing.List[typing.Tuple[int, int]]:
+        """ Index ranges of the top-level `sep` groups of `t[start:end]`.
+
+        Equivalent to `split` on the slice, using `matches` (see
+        `bracket_matches`) to jump over the groups.
+        """
+        groups = []
+        i = t.find(sep, start, end)
+        while i != -1:
+            groups.append((i + 1, matches[i]))
+            i = t.find(sep, matches[i] + 1, end)
+        return groups
+
+    def parse(
+            self,
+            t: str,
+            is_type: bool,
+    ) -> BVT:
+        """ Single-pass stack-based parser for term and type strings.
+
+        Brackets are matched once for the whole string and the trees are built
+        bottom-up from index ranges, so parsing is linear in the length of `t`
+        and not bound by the recursion limit.
+
+        Whole strings and type subtrees (which repeat heavily within terms)
+        are memoized in the parse cache.
+        """
+        tree = self.cache_get(t)
+        if tree is not None:
+            return tree
+
+        matches = bracket_matches(t)
+
+        out = []
+        stack = [('ty' if is_type else 'tm', 0, len(t))]
+        while len(stack) > 0:
+            item = stack.pop()
+            op = item[0]
+
+            if op == 'ty':
+                _, start, end = item
+                if self._cache_size > 0 and (start > 0 or end < len(t)):
+                    key = t[start:end]
+                    tree = self.cache_get(key)
+                    if tree is not None:
+                        out.append(tree)
+                        continue
+                    stack.append(('put', key))
+
+                if t[start] == 'v':
+                    chld = self.groups(t, matches, start, end, '[')
+                    assert len(chld) == 1
+                    token = t[chld[0][0]:chld[0][1]]
+                    assert token in self._type_tokens
+                    out.append(intern(Type(
+                        self._type_tokens['__v'],
+                        intern(Type(
+                            self._type_tokens[token], None, None, token,
+                        )),
+                        None,
+                        '__v',
+                    )))
+                elif t[start] == 'c':
+                    chld = self.groups(t, matches, start, end, '[')
+                    assert len(chld) == 2
+                    token = t[chld[0][0]:chld[0][1]]
+                    assert token in self._type_tokens
+                    args = self.groups(t, matches, chld[1][0], chld[1][1], '[')
+                    stack.append(('ty_c', token, len(args)))
+                    for a in reversed(args):
+                        stack.append(('ty', a[0], a[1]))
+                else:
+                    out.append(None)
+
+            elif op == 'put':
+                self.cache_put(item[1], out[-1])
+
+            elif op == 'ty_c':
+                _, token, count = item
+                args = None
+                for _ in range(count):
+                    args = intern(Type(
+                        self._type_tokens['__a'],
+                        out.pop(),
+                        args,
+                        '__a',
+                    ))
+                out.append(intern(Type(
+                    self._type_tokens['__c'],
+                    intern(Type(
+                        self._type_tokens[token], None, None, token,
+                    )),
+                    args,
+                    '__c',
+                )))
+
+            elif op == 'tm':
+                _, start, end = item
+                kind = t[start]
+                if kind == 'C' or kind == 'A':
+                    chld = self.groups(t, matches, start, end, '(')
+                    assert len(chld) == 2
+                    stack.append(('tm_' + kind,))
+                    stack.append(('tm', chld[1][0], chld[1][1]))
+                    stack.append(('tm', chld[0][0], chld[0][1]))
+                elif kind == 'c' or kind == 'v':
+                    chld = self.groups(t, matches, start, end, '(')
+                    assert len(chld) == 2
+                    token = t[chld[0][0]:chld[0][1]]
+                    assert token in self._term_tokens
+                    stack.append(('tm_' + kind, token))
+                    stack.append(('ty', chld[1][0], chld[1][1]))
+                else:
+                    out.append(None)
+
+            elif op == 'tm_C' or op == 'tm_A':
+                right = out.pop()
+                left = out.pop()
+                token = '__' + op[-1]
+                out.append(intern(Term(
+                    self._term_tokens[token], left, right, token,
+                )))
+
+            else:
+                token = '__' + op[-1]
+                typ = out.pop()
+                out.append(intern(Term(
+                    self._term_tokens[token],
+                    intern(Term(
+                        self._term_tokens[item[1]], None, None, item[1],
+                    )),
+                    intern(Term(typ, None, None, None)),
+                    token,
+                )))
+
+        assert len(out) == 1
+        self.cache_put(t, out[0])
+
+        return out[0]
+
     def type(
             self,
             ty: str,
@@ -426,16 +900,37 @@ class ProofTraceTokenizer():
 
         Tokenizes constants appearing in types using self._type_tokens.
         """
+        return self.parse(ty, True)
+
+    def term(
+            self,
+            tm: str,
+    ) -> Term:
+        """ Construct a Term BVT from a term string.
+
+        Tokenizes constants appearing in terms using self._term_tokens.
+        """
+        return self.parse(tm, False)
+
+    def type_recursive(
+            self,
+            ty: str,
+    ) -> Type:
+        """ Reference recursive implementation of `type` based on `split`.
+
+        Quadratic in the length of the type string, only kept to check `type`
+        against it (see `test_tokenizer`).
+        """
         def build_args(args):
             if len(args) == 0:
                 return None
             else:
-                return Type(
+                return intern(Type(
                     self._type_tokens['__a'],
                     args[0],
                     build_args(args[1:]),
                     '__a',
-                )
+                ))
 
         def construct(t):
             if t[0] == 'v':
@@ -444,12 +939,14 @@ class ProofTraceTokenizer():
                 assert chld[0] in self._type_tokens
                 # if chld[0] not in self._type_tokens:
                 #     self._type_tokens[chld[0]] = len(self._type_tokens)
-                return Type(
+                return intern(Type(
                     self._type_tokens['__v'],
-                    Type(self._type_tokens[chld[0]], None, None, chld[0]),
+                    intern(Type(
+                        self._type_tokens[chld[0]], None, None, chld[0],
+                    )),
                     None,
                     '__v',
-                )
+                ))
             if t[0] == 'c':
                 chld = list(self.split(t, ['[', ']']))
                 assert len(chld) == 2
@@ -457,69 +954,80 @@ class ProofTraceTokenizer():
                 # if chld[0] not in self._type_tokens:
                 #     self._type_tokens[chld[0]] = len(self._type_tokens)
                 args = [
-                    self.type(ty)
+                    self.type_recursive(ty)
                     for ty in list(self.split(chld[1], ['[', ']']))
                 ]
-                return Type(
+                return intern(Type(
                     self._type_tokens['__c'],
-                    Type(self._type_tokens[chld[0]], None, None, chld[0]),
+                    intern(Type(
+                        self._type_tokens[chld[0]], None, None, chld[0],
+                    )),
                     build_args(args),
                     '__c',
-                )
+                ))
 
         return construct(ty)
 
-    def term(
+    def term_recursive(
             self,
             tm: str,
     ) -> Term:
-        """ Construct a Term BVT from a term string.
+        """ Reference recursive implementation of `term` based on `split`.
 
-        Tokenizes constants appearing in terms using self._term_tokens.
+        Quadratic in the length of the term string, only kept to check `term`
+        against it (see `test_tokenizer`).
         """
         def construct(t):
             if t[0] == 'C':
                 chld = list(self.split(t, ['(', ')']))
                 assert len(chld) == 2
-                return Term(
+                return intern(Term(
                     self._term_tokens['__C'],
                     construct(chld[0]),
                     construct(chld[1]),
                     '__C',
-                )
+                ))
             if t[0] == 'A':
                 chld = list(self.split(t, ['(', ')']))
                 assert len(chld) == 2
-                return Term(
+                return intern(Term(
                     self._term_tokens['__A'],
                     construct(chld[0]),
                     construct(chld[1]),
                     '__A',
-                )
+                ))
             if t[0] == 'c':
                 chld = list(self.split(t, ['(', ')']))
                 assert len(chld) == 2
                 assert chld[0] in self._term_tokens
                 # if chld[0] not in self._term_tokens:
                 #     self._term_tokens[chld[0]] = len(self._term_tokens)
-                return Term(
+                return intern(Term(
                     self._term_tokens['__c'],
-                    Term(self._term_tokens[chld[0]], None, None, chld[0]),
-                    Term(self.type(chld[1]), None, None, None),
+                    intern(Term(
+                        self._term_tokens[chld[0]], None, None, chld[0],
+                    )),
+                    intern(Term(
+                        self.type_recursive(chld[1]), None, None, None,
+                    )),
                     '__c',
-                )
+                ))
             if t[0] == 'v':
                 chld = list(self.split(t, ['(', ')']))
                 assert len(chld) == 2
                 assert chld[0] in self._term_tokens
                 # if chld[0] not in self._term_tokens:
                 #     self._term_tokens[chld[0]] = len(self._term_tokens)
-                return Term(
+                return intern(Term(
                     self._term_tokens['__v'],
-                    Term(self._term_tokens[chld[0]], None, None, chld[0]),
-                    Term(self.type(chld[1]), None, None, None),
+                    intern(Term(
+                        self._term_tokens[chld[0]], None, None, chld[0],
+                    )),
+                    intern(Term(
+                        self.type_recursive(chld[1]), None, None, None,
+                    )),
                     '__v',
-                )
+                ))
 
         return construct(tm)
 
@@ -548,6 +1056,25 @@ class ProofTraceKernel():
 
         assert os.path.isdir(dataset_dir)
 
+        from prooftrace.arena import kernel_cache_path, map_kernel_cache
+        cache_path = kernel_cache_path(self._dataset_dir)
+        if cache_path is not None:
+            # Theorems and proofs are decoded lazily from the mapped cache,
+            # names are mutated during extraction and decoded upfront.
+            sections = map_kernel_cache(cache_path)
+            self._theorems = sections['theorems']
+            self._proofs = sections['proofs']
+            self._names = dict(sections['names'].items())
+
+            Log.out(
+                "Mapped ProofTrace kernel cache", {
+                    'path': cache_path,
+                    'theorems': len(self._theorems),
+                    'proofs': len(self._proofs),
+                    'names': len(self._names),
+                })
+            return
+
         self.process_theorems()
         Log.out(
             "Processed ProofTrace theorems", {
@@ -637,6 +1164,175 @@ class ProofTraceKernel():
             del self._shared[index]
 
 
+def frontier_cut(
+        start: int,
+        children: typing.Callable[[int], typing.List[int]],
+        min_size: int,
+        max_size: int,
+) -> typing.List[int]:
+    """ Breadth-first min-cut of the steps reachable from `start`
+
+    Among the BFS prefixes of `min_size` to `max_size` steps, picks the
+    smallest one whose frontier is within 2 of the smallest frontier, and
+    returns its frontier. Prefixes are only tracked by the number of pops and
+    pushes they span, the frontier being rebuilt from the push log.
+    """
+    seen = set()
+    queue = collections.deque([start])
+    pushed = [start]
+    pops = 0
+
+    # Distinct frontier entries (the queue can hold duplicates).
+    counts = {start: 1}
+
+    candidates = []
+    low = None
+    best = None
+
+    while len(queue) > 0:
+        idx = queue.popleft()
+        pops += 1
+        counts[idx] -= 1
+        if counts[idx] == 0:
+            del counts[idx]
+
+        if idx in seen:
+            continue
+        seen.add(idx)
+
+        for child in children(idx):
+            if child not in seen:
+                queue.append(child)
+                pushed.append(child)
+                counts[child] = counts.get(child, 0) + 1
+
+        if len(seen) > max_size:
+            break
+        if len(seen) < min_size:
+            continue
+
+        candidates.append((len(counts), pops, len(pushed)))
+
+        if low is None or len(counts) < low:
+            low = len(counts)
+            if best is None:
+                best = len(candidates) - 1
+            while candidates[best][0] > low + 2:
+                best += 1
+
+    assert best is not None
+
+    _, pops, pushes = candidates[best]
+    return sorted(set(pushed[pops:pushes]))
+
+
+class ProofTraceDAG():
+    """ Index-level view of the kernel proof DAG
+
+    Records the referenced steps and the term, subst and subst type payload of
+    every proof once, so that the steps, premises and length of the
+    ProofTrace rooted at any named index can be computed under the current
+    kernel names and shared steps without building it.
+    """
+    def __init__(
+            self,
+            kernel: ProofTraceKernel,
+    ) -> None:
+        self._kernel = kernel
+
+        self._children = {}
+        self._payloads = {}
+
+        for index in kernel._proofs:
+            step = kernel._proofs[index]
+
+            children = ()
+            payload = None
+
+            if step[0] in ['REFL', 'BETA', 'ASSUME']:
+                payload = ('term', step[1])
+            elif step[0] in [
+                    'TRANS', 'MK_COMB', 'EQ_MP', 'DEDUCT_ANTISYM_RULE',
+            ]:
+                children = (step[1], step[2])
+            elif step[0] == 'ABS':
+                children = (step[1],)
+                payload = ('term', step[2])
+            elif step[0] == 'INST':
+                children = (step[1],)
+                payload = ('subst', tuple((s[0], s[1]) for s in step[2]))
+            elif step[0] == 'INST_TYPE':
+                children = (step[1],)
+                payload = (
+                    'subst_type', tuple((s[0], s[1]) for s in step[2]),
+                )
+            elif step[0] in ['AXIOM', 'DEFINITION', 'TYPE_DEFINITION']:
+                children = None
+            else:
+                assert False
+
+            self._children[index] = children
+            self._payloads[index] = payload
+
+    def walk(
+            self,
+            root: int,
+            cuts: typing.AbstractSet[int] = frozenset(),
+    ) -> typing.Tuple[typing.Set[int], typing.Dict[int, bool], int]:
+        """ Steps, premises (in walk order) and `ProofTrace.len` of the
+        ProofTrace rooted at `root`, `cuts` being treated as named.
+        """
+        kernel = self._kernel
+
+        steps = set()
+        premises = {}
+        payloads = set()
+
+        stack = [root]
+        while len(stack) > 0:
+            index = stack.pop()
+            if index in steps:
+                continue
+
+            if index != root and (
+                    index in kernel._names or
+                    index in kernel._shared or
+                    index in cuts
+            ):
+                premises[index] = True
+                continue
+
+            children = self._children[index]
+            if children is None:
+                premises[index] = True
+                continue
+
+            steps.add(index)
+            if self._payloads[index] is not None:
+                payloads.add(self._payloads[index])
+            for child in reversed(children):
+                stack.append(child)
+
+        return steps, premises, len(steps) + len(premises) + len(payloads)
+
+    def min_cut(
+            self,
+            root: int,
+            min_size: int,
+            max_size: int,
+            cuts: typing.AbstractSet[int] = frozenset(),
+    ) -> typing.List[int]:
+        """ `ProofTrace.min_cut` of the ProofTrace rooted at `root`.
+        """
+        steps, _, _ = self.walk(root, cuts)
+
+        return frontier_cut(
+            root,
+            lambda idx: [c for c in self._children[idx] if c in steps],
+            min_size, max_size,
+        )
+
+
 class ProofTraceActions():
     def __init__(
             self,
@@ -649,14 +1345,86 @@ class ProofTraceActions():
         self._arguments = arguments
         self._hashes = None
 
+        # Position indices of arguments, by identity and by hash (first
+        # occurrence, as `list.index`), and cached `prepare_len`. They are
+        # maintained by `append` and not pickled.
+        self._positions = None
+        self._hash_positions = None
+        self._prepare_len = None
+
+    def __getstate__(
+            self,
+    ):
+        # Actions and arguments are pickled as a flat node table (see
+        # `flatten`) so that deep terms don't hit the recursion limit, they
+        # are replaced by the positions of their roots in the table.
+        table, roots = flatten(self._actions + self._arguments)
+
+        state = dict(self.__dict__)
+        state['_positions'] = None
+        state['_hash_positions'] = None
+        state['_hash_version'] = hash_version()
+        state['_table'] = table
+        state['_actions'] = roots[:len(self._actions)]
+        state['_arguments'] = roots[len(self._actions):]
+        return state
+
+    def __setstate__(
+            self,
+            state,
+    ):
+        # The hashes of the actions are discarded by BVT when their scheme
+        # differs from the current one, so must be the `hashes` set.
+        version = state.pop('_hash_version', None)
+
+        # Pickles written before node tables hold the actions directly.
+        if '_table' in state:
+            nodes = unflatten(state.pop('_table'))
+            state['_actions'] = [nodes[i] for i in state['_actions']]
+            state['_arguments'] = [nodes[i] for i in state['_arguments']]
+
+        self._positions = None
+        self._hash_positions = None
+        self._prepare_len = None
+        self.__dict__.update(state)
+
+        if version != hash_version():
+            self._hashes = None
+
     def dump(
             self,
             path,
+            columnar: bool = False,
     ) -> None:
-        with gzip.open(path, 'wb') as f:
-            pickle.dump(
-                self, f, protocol=pickle.HIGHEST_PROTOCOL,
-            )
+        if columnar:
+            from prooftrace.arena import save_columnar
+            save_columnar(self, path)
+            return
+
+        # Written to a temporary path first so that a failure never leaves a
+        # partial file behind.
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(TraceHeader.from_ptra(self).pack())
+            with gzip.GzipFile(fileobj=f, mode='wb') as g:
+                pickle.dump(
+                    self, g, protocol=pickle.HIGHEST_PROTOCOL,
+                )
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def load(
+            path,
+    ):
+        """ Loads a ProofTraceActions from a gzip pickle or a columnar file.
+
+        Columnar files are memory-mapped (see `prooftrace.arena`).
+        """
+        from prooftrace.arena import is_columnar, MappedProofTraceActions
+        if is_columnar(path):
+            return MappedProofTraceActions(path)
+
+        return TraceHeader.load_pickle(path)
 
     def len(
             self,
@@ -667,13 +1435,15 @@ class ProofTraceActions():
     def prepare_len(
             self,
     ) -> int:
-        prepare_len = 0
-        for a in self._actions:
-            if a.value in INV_PREPARE_TOKENS:
-                prepare_len += 1
-            else:
-                break
-        return prepare_len
+        if self._prepare_len is None:
+            prepare_len = 0
+            for a in self._actions:
+                if a.value in INV_PREPARE_TOKENS:
+                    prepare_len += 1
+                else:
+                    break
+            self._prepare_len = prepare_len
+        return self._prepare_len
 
     def action_len(
             self,
@@ -714,11 +1484,51 @@ class ProofTraceActions():
                 self._hashes[argument.hash()] = i
         return self._hashes
 
+    def positions(
+            self,
+    ) -> typing.Dict[int, int]:
+        """ Index from argument identity to its (first) position.
+        """
+        if self._positions is None:
+            self._positions = {}
+            for i, argument in enumerate(self._arguments):
+                self._positions.setdefault(id(argument), i)
+        return self._positions
+
+    def position_of(
+            self,
+            argument: Action,
+    ) -> int:
+        """ Position of `argument` in `arguments()`.
+
+        Equivalent to `arguments().index(argument)` when `argument` belongs
+        to this ProofTraceActions, falls back to the first argument with the
+        same hash otherwise. Raises ValueError if there is none.
+        """
+        position = self.positions().get(id(argument))
+        if position is not None:
+            return position
+
+        if self._hash_positions is None:
+            self._hash_positions = {}
+            for i, a in enumerate(self._arguments):
+                self._hash_positions.setdefault(a.hash(), i)
+        position = self._hash_positions.get(argument.hash())
+        if position is None:
+            raise ValueError("argument not in ProofTraceActions")
+
+        return position
+
     def append(
             self,
             action: Action,
             argument: Action,
     ) -> None:
+        if self._prepare_len is not None and \
+                self._prepare_len == len(self._actions) and \
+                action.value in INV_PREPARE_TOKENS:
+            self._prepare_len += 1
+
         self._actions.append(action)
         self._arguments.append(argument)
 
@@ -727,6 +1537,13 @@ class ProofTraceActions():
         self._hashes[action.hash()] = len(self._actions) - 1
         self._hashes[argument.hash()] = len(self._arguments) - 1
 
+        if self._positions is not None:
+            self._positions.setdefault(id(argument), len(self._arguments) - 1)
+        if self._hash_positions is not None:
+            self._hash_positions.setdefault(
+                argument.hash(), len(self._arguments) - 1,
+            )
+
     def build_argument(
             self,
             conclusion: Term,
@@ -734,14 +1551,12 @@ class ProofTraceActions():
             index: int,
     ) -> Action:
         def build_hypothesis(hypotheses):
-            if len(hypotheses) == 0:
-                return None
-            else:
-                return Action.from_action(
-                    'HYPOTHESIS',
-                    Action.from_term(hypotheses[0]),
-                    build_hypothesis(hypotheses[1:]),
+            hypothesis = None
+            for h in reversed(hypotheses):
+                hypothesis = Action.from_action(
+                    'HYPOTHESIS', Action.from_term(h), hypothesis,
                 )
+            return hypothesis
 
         return Action.from_action(
             'THEOREM',
@@ -756,6 +1571,49 @@ class ProofTraceActions():
     ) -> bool:
         return a.hash() in self.hashes()
 
+    def rehash(
+            self,
+    ):
+        """ Recomputes the hashes of actions and arguments with the current
+        hashing scheme.
+        """
+        rehash_all(self._actions + self._arguments)
+        self._hashes = None
+        self._hash_positions = None
+
+        return self
+
+    def content_hash(
+            self,
+    ) -> str:
+        """ Digest of the action and argument sequences, independent of the
+        trace name, used to deduplicate traces at extraction.
+        """
+        h = xxhash.xxh3_64()
+        for sequence in [self._actions, self._arguments]:
+            h.update(struct.pack('<I', len(sequence)))
+            for a in sequence:
+                h.update(a.hash())
+
+        return h.hexdigest()
+
+    def intern(
+            self,
+    ):
+        """ Interns the Terms and Types of actions and arguments in place.
+
+        No-op unless the process-wide BVT interning table is enabled.
+        """
+        # Actions share most of their nodes, the memo is shared so that each
+        # node is visited once.
+        memo = {}
+        for a in self._actions:
+            intern_tree(a, memo)
+        for a in self._arguments:
+            intern_tree(a, memo)
+
+        return self
+
     def copy(
             self,
     ):
@@ -764,8 +1622,13 @@ class ProofTraceActions():
             self._actions.copy(),
             self._arguments.copy(),
         )
-        if ptra._hashes is not None:
+        if self._hashes is not None:
             ptra._hashes = dict(self._hashes)
+        if self._positions is not None:
+            ptra._positions = dict(self._positions)
+        if self._hash_positions is not None:
+            ptra._hash_positions = dict(self._hash_positions)
+        ptra._prepare_len = self._prepare_len
 
         return ptra
 
@@ -776,8 +1639,8 @@ class ProofTraceActions():
         summary = "["
         for i, a in enumerate(self._actions):
             if a.value not in INV_PREPARE_TOKENS and i >= offset:
-                left = self._arguments.index(a.left)
-                right = self._arguments.index(a.right)
+                left = self.position_of(a.left)
+                right = self.position_of(a.right)
                 summary += \
                     "(" + \
                     str(a.value) + "," + str(left) + "," + str(right) + \
@@ -786,8 +1649,265 @@ class ProofTraceActions():
         return summary
 
 
-class ProofTrace():
-    def __init__(
+TRACE_HEADER_MAGIC = b'PTRAHDR1'
+TRACE_HEADER_SIZE = 512
+# Version 2 headers record the hashing scheme of `target_hash` (and of the
+# hashes stored in the file) before the name length.
+TRACE_HEADER_VERSION = 2
+TRACE_HEADER_STRUCT = struct.Struct('<8sHBBIIIII8sBH')
+TRACE_HEADER_STRUCT_V1 = struct.Struct('<8sHBBIIIII8sH')
+
+TRACE_HEADER_ACTIONS = 0
+TRACE_HEADER_ROLLOUT = 1
+
+
+class TraceHeader():
+    """ Fixed-size header prepended to `.actions` and `.rollout` files.
+
+    It carries the metadata needed to scan datasets (lengths, counts, hash of
+    the target theorem) so that it can be read without deserializing the rest
+    of the file. Files written before headers were introduced have none and
+    `read` returns None for them.
+
+    For rollouts, `len`, `prepare_len` and `premise_count` are those of the
+    shortest positive (or of the first negative if there is none).
+
+    `hash_version` is None for version 1 headers, which did not record it.
+    """
+    def __init__(
+            self,
+            kind: int,
+            columnar: bool,
+            name: str,
+            length: int,
+            prepare_len: int,
+            premise_count: int,
+            positive_count: int = 0,
+            negative_count: int = 0,
+            target_hash: bytes = b'',
+            hash_version: int = None,
+    ) -> None:
+        self.kind = kind
+        self.columnar = columnar
+        self.name = name
+        self.len = length
+        self.prepare_len = prepare_len
+        self.premise_count = premise_count
+        self.positive_count = positive_count
+        self.negative_count = negative_count
+        self.target_hash = target_hash
+        self.hash_version = hash_version
+
+    def pack(
+            self,
+    ) -> bytes:
+        # Names are truncated to fit in the header, the full name is stored
+        # in the file itself.
+        name = self.name.encode('utf-8')[
+            :TRACE_HEADER_SIZE - TRACE_HEADER_STRUCT.size
+        ]
+        data = TRACE_HEADER_STRUCT.pack(
+            TRACE_HEADER_MAGIC, TRACE_HEADER_VERSION,
+            self.kind, 1 if self.columnar else 0,
+            self.len, self.prepare_len, self.premise_count,
+            self.positive_count, self.negative_count,
+            self.target_hash, self.hash_version, len(name),
+        ) + name
+        return data + b'\0' * (TRACE_HEADER_SIZE - len(data))
+
+    @staticmethod
+    def unpack(
+            data: bytes,
+    ):
+        if len(data) < TRACE_HEADER_SIZE or \
+                data[:len(TRACE_HEADER_MAGIC)] != TRACE_HEADER_MAGIC:
+            return None
+
+        _, version = struct.unpack_from('<8sH', data)
+        if version == 1:
+            header_struct = TRACE_HEADER_STRUCT_V1
+            _, _, kind, columnar, length, prepare_len, premise_count, \
+                positive_count, negative_count, target_hash, name_len = \
+                header_struct.unpack_from(data)
+            hash_version = None
+        else:
+            assert version == TRACE_HEADER_VERSION
+            header_struct = TRACE_HEADER_STRUCT
+            _, _, kind, columnar, length, prepare_len, premise_count, \
+                positive_count, negative_count, target_hash, hash_version, \
+                name_len = header_struct.unpack_from(data)
+
+        start = header_struct.size
+        return TraceHeader(
+            kind, columnar == 1,
+            data[start:start+name_len].decode('utf-8', 'ignore'),
+            length, prepare_len, premise_count,
+            positive_count, negative_count,
+            target_hash, hash_version,
+        )
+
+    @staticmethod
+    def read(
+            path: str,
+    ):
+        """ Reads the header of a file, None if it has none.
+        """
+        with open(path, 'rb') as f:
+            return TraceHeader.unpack(f.read(TRACE_HEADER_SIZE))
+
+    @staticmethod
+    def load_pickle(
+            path: str,
+    ):
+        """ Unpickles the gzip payload of a file, with or without header.
+        """
+        with open(path, 'rb') as f:
+            if TraceHeader.unpack(f.read(TRACE_HEADER_SIZE)) is None:
+                f.seek(0)
+            with gzip.GzipFile(fileobj=f, mode='rb') as g:
+                return pickle.load(g)
+
+    @staticmethod
+    def from_ptra(
+            ptra: ProofTraceActions,
+            columnar: bool = False,
+            kind: int = TRACE_HEADER_ACTIONS,
+    ):
+        target_hash = b''
+        if ptra.len() > 0:
+            target_hash = ptra.actions()[0].hash()
+
+        premise_count = 0
+        for a in ptra.actions()[:ptra.prepare_len()]:
+            if a.value == PROOFTRACE_TOKENS['PREMISE']:
+                premise_count += 1
+
+        return TraceHeader(
+            kind, columnar, ptra.name(),
+            ptra.len(), ptra.prepare_len(), premise_count,
+            target_hash=target_hash,
+            hash_version=hash_version(),
+        )
+
+
+def trace_lengths(
+        path: str,
+) -> typing.Optional[typing.Tuple[int, int]]:
+    """ Returns the `len` and `prepare_len` of an `.actions` file.
+
+    Reads the header if present, falls back to the file name otherwise.
+    """
+    header = TraceHeader.read(path)
+    if header is not None:
+        return header.len, header.prepare_len
+
+    match = re.search("_(\\d+)_(\\d+)\\.actions$", path)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+TRACE_ALIASES_FILE = 'traces.aliases'
+
+
+def trace_name(
+        path: str,
+) -> typing.Optional[str]:
+    """ Returns the trace name of an `.actions` file from its file name.
+    """
+    match = re.search("^(.*)_\\d+_\\d+\\.actions$", os.path.basename(path))
+    if match is None:
+        return None
+    return match.group(1)
+
+
+class TraceAliases():
+    """ Alias to canonical name table of the traces deduplicated at extraction
+
+    Traces with the same `ProofTraceActions.content_hash` in a split are only
+    written once, under the name of the first one. Consumers go through the
+    table to skip aliases, notably in rollout directories bootstrapped before
+    deduplication. The table is stored as JSON in the dataset directory.
+    """
+    def __init__(
+            self,
+            aliases: typing.Dict[str, str] = None,
+    ) -> None:
+        self._aliases = {}
+        if aliases is not None:
+            self._aliases = aliases
+
+    def add(
+            self,
+            alias: str,
+            name: str,
+    ) -> None:
+        self._aliases[alias] = name
+
+    def canonical(
+            self,
+            name: str,
+    ) -> str:
+        return self._aliases.get(name, name)
+
+    def is_alias(
+            self,
+            name: str,
+    ) -> bool:
+        return name in self._aliases
+
+    def len(
+            self,
+    ) -> int:
+        return len(self._aliases)
+
+    def trace_files(
+            self,
+            traces_dir: str,
+    ) -> typing.List[str]:
+        """ Canonical `.actions` files of `traces_dir`.
+        """
+        return sorted([
+            os.path.join(traces_dir, f)
+            for f in os.listdir(traces_dir)
+            if re.search("\\.actions$", f) and
+            os.path.isfile(os.path.join(traces_dir, f)) and
+            not self.is_alias(trace_name(f))
+        ])
+
+    def dump(
+            self,
+            dataset_dir: str,
+    ) -> None:
+        path = os.path.join(dataset_dir, TRACE_ALIASES_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self._aliases, f, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    @staticmethod
+    def load(
+            dataset_dir: str,
+    ):
+        """ Loads the table of a dataset, empty if it has none.
+        """
+        path = os.path.join(dataset_dir, TRACE_ALIASES_FILE)
+        if not os.path.isfile(path):
+            return TraceAliases()
+
+        with open(path, 'r') as f:
+            return TraceAliases(json.load(f))
+
+
+# Local variables and type variables renamed by `ProofTrace.localize` along
+# with the other variable and constant tokens, in a single alternation.
+LOCALIZE_PATTERN = re.compile(
+    r"(?P<term>v\(_[0-9]+\))|(?P<type>v\[\?[0-9]+\])|"
+    r"(?P<token>[vc]\([^\(\)]+\)|[vc]\[[^\[\]]+\])"
+)
+
+
+class ProofTrace():
+    def __init__(
             self,
             kernel: ProofTraceKernel,
             proof_index: int,
@@ -804,6 +1924,9 @@ class ProofTrace():
         self._theorems = {}
         self._sequence = []
 
+        # Tokens collected by `localize`.
+        self._tokens = None
+
         self._name = str(self._index) + '_' + kernel._names[self._index]
 
         self.walk(self._index, kernel)
@@ -900,6 +2023,27 @@ class ProofTrace():
             self,
             index,
             kernel: ProofTraceKernel,
+    ):
+        """ Walk the proof of `index` and record its steps in post-order
+
+        Proofs routinely nest deeper than the interpreter recursion limit so
+        each step is a generator yielding the premises it depends on, driven
+        from an explicit stack. Steps are visited in exactly the order a
+        recursive walk would visit them.
+        """
+        stack = [self.walk_step(index, kernel)]
+        while len(stack) > 0:
+            try:
+                premise = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+                continue
+            stack.append(self.walk_step(premise, kernel))
+
+    def walk_step(
+            self,
+            index,
+            kernel: ProofTraceKernel,
     ):
         if index in self._steps:
             return
@@ -920,15 +2064,15 @@ class ProofTrace():
             step[1] = self.record_term(step[1])
 
         elif step[0] == 'TRANS':
-            self.walk(step[1], kernel)
-            self.walk(step[2], kernel)
+            yield step[1]
+            yield step[2]
 
         elif step[0] == 'MK_COMB':
-            self.walk(step[1], kernel)
-            self.walk(step[2], kernel)
+            yield step[1]
+            yield step[2]
 
         elif step[0] == 'ABS':
-            self.walk(step[1], kernel)
+            yield step[1]
             step[2] = self.record_term(step[2])
 
         elif step[0] == 'BETA':
@@ -938,19 +2082,19 @@ class ProofTrace():
             step[1] = self.record_term(step[1])
 
         elif step[0] == 'EQ_MP':
-            self.walk(step[1], kernel)
-            self.walk(step[2], kernel)
+            yield step[1]
+            yield step[2]
 
         elif step[0] == 'DEDUCT_ANTISYM_RULE':
-            self.walk(step[1], kernel)
-            self.walk(step[2], kernel)
+            yield step[1]
+            yield step[2]
 
         elif step[0] == 'INST':
-            self.walk(step[1], kernel)
+            yield step[1]
             step[2] = self.record_subst(step[2])
 
         elif step[0] == 'INST_TYPE':
-            self.walk(step[1], kernel)
+            yield step[1]
             step[2] = self.record_subst_type(step[2])
 
         elif step[0] == 'AXIOM':
@@ -1001,47 +2145,45 @@ class ProofTrace():
         # arguments even for right arguments of unary actions.
         empty = Action.from_action('EMPTY', None, None)
 
-        # Recursive function used to build theorems hypotheses used for THEOREM
-        # actions.
+        # Builds theorems hypotheses used for THEOREM actions as a right-nested
+        # HYPOTHESIS list. Terms are tokenized front to back, then the list is
+        # folded from its tail so that long lists don't recurse.
         def build_hypothesis(hypotheses):
-            if len(hypotheses) == 0:
-                return None
-            else:
-                return Action.from_action(
-                    'HYPOTHESIS',
-                    Action.from_term(t.term(hypotheses[0])),
-                    build_hypothesis(hypotheses[1:]),
+            terms = [Action.from_term(t.term(h)) for h in hypotheses]
+            hypothesis = None
+            for term in reversed(terms):
+                hypothesis = Action.from_action(
+                    'HYPOTHESIS', term, hypothesis,
                 )
+            return hypothesis
 
-        # Recursive function used to build instantiations substitutions
+        # Builds instantiations substitutions (same folding as above).
         def build_subst(subst):
-            if len(subst) == 0:
-                return Action.from_action('SUBST', None, None)
-            else:
-                return Action.from_action(
-                    'SUBST',
-                    Action.from_action(
-                        'SUBST_PAIR',
-                        Action.from_term(t.term(subst[0][0])),
-                        Action.from_term(t.term(subst[0][1])),
-                    ),
-                    build_subst(subst[1:]),
-                )
-
-        # Recursive function used to build type instantiations substitutions
+            pairs = [
+                Action.from_action(
+                    'SUBST_PAIR',
+                    Action.from_term(t.term(s[0])),
+                    Action.from_term(t.term(s[1])),
+                ) for s in subst
+            ]
+            action = Action.from_action('SUBST', None, None)
+            for pair in reversed(pairs):
+                action = Action.from_action('SUBST', pair, action)
+            return action
+
+        # Builds type instantiations substitutions (same folding as above).
         def build_subst_type(subst_type):
-            if len(subst_type) == 0:
-                return Action.from_action('SUBST_TYPE', None, None)
-            else:
-                return Action.from_action(
-                    'SUBST_TYPE',
-                    Action.from_action(
-                        'SUBST_PAIR',
-                        Action.from_term(t.type(subst_type[0][0])),
-                        Action.from_term(t.type(subst_type[0][1])),
-                    ),
-                    build_subst_type(subst_type[1:]),
-                )
+            pairs = [
+                Action.from_action(
+                    'SUBST_PAIR',
+                    Action.from_term(t.type(s[0])),
+                    Action.from_term(t.type(s[1])),
+                ) for s in subst_type
+            ]
+            action = Action.from_action('SUBST_TYPE', None, None)
+            for pair in reversed(pairs):
+                action = Action.from_action('SUBST_TYPE', pair, action)
+            return action
 
         # Start by recording the target theorem (TARGET action).
         target = Action.from_action(
@@ -1230,170 +2372,286 @@ class ProofTrace():
             min_size: int,
             max_size: int,
     ) -> typing.List[int]:
-        candidates = []
-        seen, queue = set(), [self._sequence[-1]]
-
-        def add_step(idx):
-            if idx not in self._premises and idx not in seen:
-                queue.append(idx)
-
-        while len(queue) > 0:
-            idx = queue.pop(0)
-
-            if idx in seen:
-                continue
-            seen.add(idx)
+        def children(idx):
             step = self._steps[idx]
 
-            if step[0] == 'REFL':
-                pass
-            elif step[0] == 'TRANS':
-                add_step(step[1])
-                add_step(step[2])
-            elif step[0] == 'MK_COMB':
-                add_step(step[1])
-                add_step(step[2])
-            elif step[0] == 'ABS':
-                add_step(step[1])
-            elif step[0] == 'BETA':
-                pass
-            elif step[0] == 'ASSUME':
-                pass
-            elif step[0] == 'EQ_MP':
-                add_step(step[1])
-                add_step(step[2])
-            elif step[0] == 'DEDUCT_ANTISYM_RULE':
-                add_step(step[1])
-                add_step(step[2])
-            elif step[0] == 'INST':
-                add_step(step[1])
-            elif step[0] == 'INST_TYPE':
-                add_step(step[1])
-
-            elif step[0] == 'AXIOM':
-                assert False
-            elif step[0] == 'DEFINITION':
-                assert False
-            elif step[0] == 'TYPE_DEFINITION':
+            if step[0] in [
+                    'TRANS', 'MK_COMB', 'EQ_MP', 'DEDUCT_ANTISYM_RULE',
+            ]:
+                refs = [step[1], step[2]]
+            elif step[0] in ['ABS', 'INST', 'INST_TYPE']:
+                refs = [step[1]]
+            elif step[0] in ['REFL', 'BETA', 'ASSUME']:
+                refs = []
+            else:
                 assert False
 
-            if len(seen) >= min_size and len(seen) <= max_size:
-                candidates.append((set(seen), set(queue)))
-
-        candidates = sorted(candidates, key=lambda c: len(c[1]))
-        candidates = [
-            c for c in candidates if len(c[1]) <= len(candidates[0][1]) + 2
-        ]
-        candidates = sorted(candidates, key=lambda c: len(c[0]))
-
-        assert len(candidates) > 0
+            return [c for c in refs if c not in self._premises]
 
-        return sorted(list(candidates[0][1]))
+        return frontier_cut(self._sequence[-1], children, min_size, max_size)
 
     def localize(
             self,
-    ) -> None:
-        cache = {
-            '_term_index': 0,
-            '_type_index': 0,
-        }
-
-        term_pattern = re.compile(r"v\(_[0-9]+\)")
-        type_pattern = re.compile(r"v\[\?[0-9]+\]")
-
-        def localize_blob(blob):
-            replacements = {}
-
-            for m in re.findall(term_pattern, blob):
-                if m not in cache:
-                    cache[m] = "v(_" + str(cache['_term_index']) + ")"
-                    cache['_term_index'] += 1
-                if m not in replacements:
-                    replacements[m] = cache[m]
-            for m in re.findall(type_pattern, blob):
-                if m not in cache:
-                    cache[m] = "v[?" + str(cache['_type_index']) + "]"
-                    cache['_type_index'] += 1
-                if m not in replacements:
-                    replacements[m] = cache[m]
+    ) -> int:
+        """ Renames the local variables and type variables of the trace in
+        order of appearance, returns the number of blobs processed.
 
-            for old in replacements:
-                blob = blob.replace(old, replacements[old])
+        Blobs are rewritten in a single LOCALIZE_PATTERN scan which also
+        collects the tokens of the localized theorems (see `tokens`).
+        """
+        cache = {}
+        counts = {'term': 0, 'type': 0}
+        blobs = [0]
+
+        def localize_blob(blob, tokens=None):
+            blobs[0] += 1
+
+            out = []
+            last = 0
+            for m in LOCALIZE_PATTERN.finditer(blob):
+                kind = m.lastgroup
+                if kind == 'token':
+                    if tokens is not None:
+                        tokens.append(m.group())
+                    continue
+
+                v = m.group()
+                if v not in cache:
+                    if kind == 'term':
+                        cache[v] = "v(_" + str(counts['term']) + ")"
+                    else:
+                        cache[v] = "v[?" + str(counts['type']) + "]"
+                    counts[kind] += 1
+                if tokens is not None:
+                    tokens.append(cache[v])
 
-            return blob
+                out.append(blob[last:m.start()])
+                out.append(cache[v])
+                last = m.end()
 
-        def localize_term(term):
-            return localize_blob(term)
+            if last == 0:
+                return blob
+            out.append(blob[last:])
+            return ''.join(out)
 
         def localize_subst(subst):
-            new = copy.deepcopy(subst)
-            for i in range(len(subst)):
-                assert len(subst[i]) == 2
-                new[i][0] = localize_blob(subst[i][0])
-                new[i][1] = localize_blob(subst[i][1])
+            new = []
+            for s in subst:
+                assert len(s) == 2
+                new.append([localize_blob(s[0]), localize_blob(s[1])])
             return new
 
-        def localize_subst_type(subst_type):
-            new = copy.deepcopy(subst_type)
-            for i in range(len(subst_type)):
-                assert len(subst_type[i]) == 2
-                new[i][0] = localize_blob(subst_type[i][0])
-                new[i][1] = localize_blob(subst_type[i][1])
+        def localize_theorem(th, tokens=None):
+            new = dict(th)
+            new['cc'] = localize_blob(th['cc'], tokens)
+            new['hy'] = [localize_blob(hy, tokens) for hy in th['hy']]
             return new
 
-        def localize_theorem(th):
-            new = copy.deepcopy(th)
-            new['cc'] = localize_blob(th['cc'])
-            for i in range(len(th['hy'])):
-                new['hy'][i] = localize_blob(th['hy'][i])
-            return new
+        theorem_tokens = {}
+        premise_tokens = {}
 
         self._target = localize_theorem(self._target)
         for idx in self._premises:
-            self._premises[idx] = localize_theorem(self._premises[idx])
+            premise_tokens[idx] = []
+            self._premises[idx] = localize_theorem(
+                self._premises[idx], premise_tokens[idx],
+            )
         for idx in self._theorems:
-            self._theorems[idx] = localize_theorem(self._theorems[idx])
+            theorem_tokens[idx] = []
+            self._theorems[idx] = localize_theorem(
+                self._theorems[idx], theorem_tokens[idx],
+            )
         for h in self._terms:
-            self._terms[h] = localize_term(self._terms[h])
+            self._terms[h] = localize_blob(self._terms[h])
         for h in self._substs:
             self._substs[h] = localize_subst(self._substs[h])
         for h in self._subst_types:
-            self._subst_types[h] = localize_subst_type(self._subst_types[h])
+            self._subst_types[h] = localize_subst(self._subst_types[h])
+
+        self._tokens = self.split_tokens(
+            [theorem_tokens[idx] for idx in self._theorems] +
+            [premise_tokens[idx] for idx in self._premises]
+        )
+
+        return blobs[0]
+
+    @staticmethod
+    def split_tokens(
+            matches: typing.List[typing.List[str]],
+    ) -> typing.Tuple[typing.List[str], typing.List[str]]:
+        term_tokens = {}
+        type_tokens = {}
+
+        for blob_matches in matches:
+            for m in blob_matches:
+                if m[1] == '[':
+                    type_tokens[m[2:-1]] = True
+                else:
+                    term_tokens[m[2:-1]] = True
+
+        return list(term_tokens.keys()), list(type_tokens.keys())
+
+    def tokens(
+            self,
+    ) -> typing.Tuple[typing.List[str], typing.List[str]]:
+        """ Term and type tokens of the trace in first-seen order
+
+        Merging the per-trace lists in trace order yields the same token ids
+        as tokenizing the traces sequentially. Localized traces reuse the
+        tokens collected by `localize`.
+        """
+        if self._tokens is not None:
+            return self._tokens
+
+        def theorem_matches(th):
+            return [
+                m.group() for blob in [th['cc']] + th['hy']
+                for m in LOCALIZE_PATTERN.finditer(blob)
+            ]
+
+        return self.split_tokens(
+            [theorem_matches(self._theorems[idx]) for idx in self._theorems] +
+            [theorem_matches(self._premises[idx]) for idx in self._premises]
+        )
 
     def tokenize(
             self,
             tokenizer: ProofTraceTokenizer,
     ):
-        token_pattern = re.compile(r"[vc]\([^\(\)]+\)|[vc]\[[^\[\]]+\]")
+        term_tokens, type_tokens = self.tokens()
+        merge_tokens(tokenizer, term_tokens, type_tokens)
 
-        def tokenize_blob(blob):
-            for m in re.findall(token_pattern, blob):
-                token = m[2:-1]
-                if m[1] == '[':
-                    if token not in tokenizer._type_tokens:
-                        tokenizer._type_tokens[token] = \
-                            len(tokenizer._type_tokens)
-                if m[1] == '(':
-                    if token not in tokenizer._term_tokens:
-                        tokenizer._term_tokens[token] = \
-                            len(tokenizer._term_tokens)
-
-        def tokenize_theorem(th):
-            tokenize_blob(th['cc'])
-            for i in range(len(th['hy'])):
-                tokenize_blob(th['hy'][i])
 
-        for idx in self._theorems:
-            tokenize_theorem(self._theorems[idx])
-        for idx in self._premises:
-            tokenize_theorem(self._premises[idx])
+def merge_tokens(
+        tokenizer: ProofTraceTokenizer,
+        term_tokens: typing.List[str],
+        type_tokens: typing.List[str],
+) -> None:
+    for token in type_tokens:
+        if token not in tokenizer._type_tokens:
+            tokenizer._type_tokens[token] = len(tokenizer._type_tokens)
+    for token in term_tokens:
+        if token not in tokenizer._term_tokens:
+            tokenizer._term_tokens[token] = len(tokenizer._term_tokens)
+
+
+"""
+Extraction workers are forked from the extraction process and inherit the
+kernel, tokenizer and final traces from `_extract_state` instead of receiving
+them pickled with each task. The kernel is mutated between phases so each
+phase forks a fresh pool.
+"""
+_extract_state = {
+    'config': None,
+    'kernel': None,
+    'dag': None,
+    'tokenizer': None,
+    'traces': None,
+}
+
+
+def extract_map(
+        fn,
+        args: typing.List,
+        workers: int,
+) -> typing.List:
+    if workers <= 1 or len(args) <= 1:
+        return [fn(a) for a in args]
+
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('fork'),
+    )
+    try:
+        return list(executor.map(
+            fn, args, chunksize=max(1, len(args) // (4 * workers)),
+        ))
+    finally:
+        executor.shutdown()
+
+
+def trace_steps(
+        index: int,
+) -> typing.List[int]:
+    steps, _, _ = _extract_state['dag'].walk(index)
+    return list(steps)
+
+
+def trace_premises(
+        index: int,
+) -> typing.List[int]:
+    _, premises, _ = _extract_state['dag'].walk(index)
+    return list(premises.keys())
+
+
+def trace_lens(
+        index: int,
+) -> typing.Tuple[typing.List[int], int]:
+    steps, _, tr_len = _extract_state['dag'].walk(index)
+    return list(steps), tr_len
+
+
+def trace_cut(
+        index: int,
+) -> typing.List[int]:
+    """ Cut premises splitting the trace in excess at `index`, along with the
+    traces cut from it, until none of them is in excess.
+    """
+    config = _extract_state['config']
+    dag = _extract_state['dag']
+
+    max_length = config.get('prooftrace_max_demo_length')
+
+    cuts = set()
+    excess = [index]
+    while len(excess) > 0:
+        cut = []
+        for root in excess:
+            cut += dag.min_cut(root, max_length * 1/8, max_length * 1/2, cuts)
+        cuts.update(cut)
+
+        refresh = excess + cut
+        excess = []
+        for root in refresh:
+            steps, _, tr_len = dag.walk(root, cuts)
+            if len(steps) > 0 and tr_len > max_length * 4/5:
+                excess.append(root)
+
+    return sorted(cuts)
+
+
+def trace_final(
+        index: int,
+) -> typing.Optional[typing.Tuple[ProofTrace, int]]:
+    """ Localized trace and the number of blobs localized, None if the trace
+    is empty
+    """
+    tr = ProofTrace(_extract_state['kernel'], index)
+    if len(tr._steps) == 0:
+        return None
+
+    blobs = tr.localize()
+
+    return tr, blobs
+
+
+def trace_tokens(
+        idx: int,
+) -> typing.Tuple[typing.List[str], typing.List[str]]:
+    return _extract_state['traces'][idx].tokens()
 
 
 def dump_trace(
-        args
+        idx: int,
 ):
-    config, tokenizer, tr, idx, total = args
+    config = _extract_state['config']
+    tokenizer = _extract_state['tokenizer']
+    tr = _extract_state['traces'][idx]
+    total = len(_extract_state['traces'])
+
+    before = tokenizer.cache_stats()
     ptra = tr.actions(tokenizer)
+    after = tokenizer.cache_stats()
 
     test = False
     for nm in TEST_FILTER:
@@ -1419,58 +2677,155 @@ def dump_trace(
         'index': idx,
         'total': total,
     })
-    ptra.dump(ptra_path)
+
+    # Deduplicated traces are written to a temporary path and only moved in
+    # place by `extract_dump` if they are the first of their content.
+    content_hash = None
+    if config.get('prooftrace_dataset_dedupe'):
+        content_hash = ptra.content_hash()
+        ptra.dump(
+            ptra_path + '.tmp', config.get('prooftrace_dataset_columnar'),
+        )
+    else:
+        ptra.dump(ptra_path, config.get('prooftrace_dataset_columnar'))
 
     length = ptra.len()
+    name = ptra.name()
     del ptra
 
-    return length
+    return length, {
+        k: after[k] - before[k] for k in ['hits', 'misses', 'evictions']
+    }, ptra_path, name, content_hash
 
 
-def extract():
-    parser = argparse.ArgumentParser(description="")
-    parser.add_argument(
-        'config_path',
-        type=str, help="path to the config file",
-    )
-    parser.add_argument(
-        '--dataset_size',
-        type=str, help="config override",
+""" Extraction phases
+
+Each phase persists the state it produces under `extract/` in the dataset
+directory so that `prooftrace_extract --resume_from=<phase>` can restore it
+and skip the phases already done:
+
+    kernel:             loads the kernel (nothing persisted)
+    cross_steps:        kernel names and shared steps
+    shared_premises:    kernel names and shared steps
+    cuts:               kernel names after min-cuts and stitching
+    localize:           final localized ProofTraces
+    tokenize:           tokenizer
+    dump:               ProofTraceActions (nothing persisted)
+"""
+EXTRACT_PHASES = [
+    'kernel',
+    'cross_steps',
+    'shared_premises',
+    'cuts',
+    'localize',
+    'tokenize',
+    'dump',
+]
+
+
+def extract_dir(
+        config: Config,
+) -> str:
+    return os.path.join(
+        os.path.expanduser(config.get('prooftrace_dataset_dir')),
+        config.get('prooftrace_dataset_size'),
     )
 
-    args = parser.parse_args()
 
-    config = Config.from_file(args.config_path)
+def extract_checkpoint_save(
+        config: Config,
+        phase: str,
+) -> None:
+    kernel = _extract_state['kernel']
 
-    if args.dataset_size is not None:
-        config.override(
-            'prooftrace_dataset_size',
-            args.dataset_size,
-        )
+    state = None
+    if phase in ['cross_steps', 'shared_premises', 'cuts']:
+        state = {
+            'names': kernel._names,
+            'shared': kernel._shared,
+        }
+    if phase == 'localize':
+        state = {
+            'traces': _extract_state['traces'],
+        }
+    if phase == 'tokenize':
+        state = {
+            'tokenizer': _extract_state['tokenizer'],
+        }
+    if state is None:
+        return
+
+    path = os.path.join(extract_dir(config), 'extract')
+    if not os.path.isdir(path):
+        os.mkdir(path)
+    path = os.path.join(path, phase + '.checkpoint')
+
+    with gzip.open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(path + '.tmp', path)
+
+
+def extract_checkpoint_load(
+        config: Config,
+        phase: str,
+) -> None:
+    path = os.path.join(
+        extract_dir(config), 'extract', phase + '.checkpoint',
+    )
+    assert os.path.isfile(path)
+
+    with gzip.open(path, 'rb') as f:
+        state = pickle.load(f)
+
+    if 'names' in state:
+        _extract_state['kernel']._names = state['names']
+        _extract_state['kernel']._shared = state['shared']
+    if 'traces' in state:
+        _extract_state['traces'] = state['traces']
+    if 'tokenizer' in state:
+        _extract_state['tokenizer'] = state['tokenizer']
+
+    Log.out("Restored extraction checkpoint", {
+        'phase': phase,
+        'path': path,
+    })
 
-    sys.setrecursionlimit(4096)
 
+def extract_kernel(
+        config: Config,
+) -> int:
     kernel = ProofTraceKernel(
         os.path.expanduser(config.get('prooftrace_dataset_dir')),
         config.get('prooftrace_dataset_size'),
     )
-    tokenizer = ProofTraceTokenizer()
 
-    Log.out("Starting cross steps detection")
+    _extract_state['kernel'] = kernel
+    _extract_state['dag'] = ProofTraceDAG(kernel)
+
+    return len(kernel._proofs)
 
-    traces = [ProofTrace(kernel, k) for k in kernel._names.keys()]
+
+def extract_cross_steps(
+        config: Config,
+) -> int:
+    kernel = _extract_state['kernel']
+
+    indices = list(kernel._names.keys())
+    steps = extract_map(
+        trace_steps, indices, config.get('prooftrace_extract_workers'),
+    )
 
     Log.out("Prooftraces computed", {
-        "traces_count": len(traces),
+        "traces_count": len(indices),
     })
 
+    # Each trace lists a step at most once, so appending never duplicates.
     cross_steps = {}
-    for tr in traces:
-        for th in tr._steps.keys():
+    for index, tr_steps in zip(indices, steps):
+        for th in tr_steps:
             if th not in cross_steps:
                 cross_steps[th] = []
-            if tr._index not in cross_steps[th]:
-                cross_steps[th].append(tr._index)
+            cross_steps[th].append(index)
 
     cross_step_count = 0
     for th in cross_steps:
@@ -1482,17 +2837,26 @@ def extract():
         "cross_step_count": cross_step_count,
     })
 
-    Log.out("Starting shared premises detection")
+    return len(indices)
+
 
-    traces = [ProofTrace(kernel, k) for k in kernel._names.keys()]
+def extract_shared_premises(
+        config: Config,
+) -> int:
+    kernel = _extract_state['kernel']
+
+    indices = list(kernel._names.keys())
+    premises = extract_map(
+        trace_premises, indices, config.get('prooftrace_extract_workers'),
+    )
 
     Log.out("Prooftraces computed", {
-        "traces_count": len(traces),
+        "traces_count": len(indices),
     })
 
     shared_premise_count = 0
-    for tr in traces:
-        for th in tr._premises.keys():
+    for tr_premises in premises:
+        for th in tr_premises:
             if kernel.name_shared_premise(th):
                 shared_premise_count += 1
 
@@ -1500,95 +2864,128 @@ def extract():
         "shared_premise_count": shared_premise_count,
     })
 
-    Log.out("Starting min_cut operations")
+    return len(indices)
+
+
+def extract_cuts(
+        config: Config,
+) -> int:
+    kernel = _extract_state['kernel']
+    workers = config.get('prooftrace_extract_workers')
 
     kernel._shared = {}
-    traces = [ProofTrace(kernel, k) for k in kernel._names.keys()]
-    traces = [tr for tr in traces if len(tr._steps) > 0]
 
-    excess = [
-        tr for tr in traces
-        if tr.len() > config.get('prooftrace_max_demo_length') * 4/5
-    ]
+    # Steps count and length of each trace, along with a reverse index from
+    # steps to the traces walking through them. Naming a cut premise only
+    # changes the traces walking through it, all others are reused up to the
+    # stitching phase.
+    lens = {}
+    step_traces = {}
+
+    def refresh_lens(indices):
+        for index, (tr_steps, tr_len) in zip(
+                indices, extract_map(trace_lens, indices, workers),
+        ):
+            lens[index] = (len(tr_steps), tr_len)
+            for th in tr_steps:
+                if th not in step_traces:
+                    step_traces[th] = set()
+                step_traces[th].add(index)
+
+    def in_excess(index):
+        steps_len, tr_len = lens[index]
+        return steps_len > 0 and \
+            tr_len > config.get('prooftrace_max_demo_length') * 4/5
+
+    indices = list(kernel._names.keys())
+    refresh_lens(indices)
+
+    excess = [index for index in indices if in_excess(index)]
     Log.out("Min-cut initialization", {
         'excess': len(excess),
     })
 
+    # Each excess trace is cut along with the traces cut from it in a single
+    # batched task, rounds only repeat if cuts of separate traces interact.
+    min_cut_start = time.time()
+    min_cut_rounds = 0
+    min_cut_count = 0
+
     while len(excess) > 0:
-        orig = []
+        orig = excess
         cut = []
 
-        for tr in excess:
-            orig.append(tr._index)
-            cut += tr.min_cut(
-                config.get('prooftrace_max_demo_length') * 1/8,
-                config.get('prooftrace_max_demo_length') * 1/2,
-            )
+        for tr_cut in extract_map(trace_cut, orig, workers):
+            for idx in tr_cut:
+                if kernel.name_cut_premise(idx):
+                    cut.append(idx)
 
+        refresh = orig + cut
+        stale = set(refresh)
         for idx in cut:
-            kernel.name_cut_premise(idx)
+            for index in step_traces.get(idx, []):
+                if index not in stale:
+                    stale.add(index)
+                    refresh.append(index)
 
-        refresh = orig + cut
-        traces = [ProofTrace(kernel, k) for k in refresh]
-        excess = [
-            tr for tr in traces
-            if tr.len() > config.get('prooftrace_max_demo_length') * 4/5
-        ]
+        refresh_lens(refresh)
+        excess = [index for index in refresh if in_excess(index)]
+
+        min_cut_rounds += 1
+        min_cut_count += len(cut)
 
         Log.out("Min-cut processing loop", {
             'excess': len(excess),
             'orig': len(orig),
             'cut': len(cut),
+            'refresh': len(refresh),
         })
 
-    Log.out("Stitching small prooftraces")
+    Log.out("Min-cut done", {
+        'rounds': min_cut_rounds,
+        'cut': min_cut_count,
+        'time': "{:.2f}".format(time.time() - min_cut_start),
+    })
 
-    traces = [ProofTrace(kernel, k) for k in kernel._names.keys()]
-    traces = [tr for tr in traces if len(tr._steps) > 0]
+    Log.out("Stitching small prooftraces")
 
-    for tr in traces:
-        if tr.len() < 32:
+    for index in list(kernel._names.keys()):
+        steps_len, tr_len = lens[index]
+        if steps_len > 0 and tr_len < 32:
             # Log.out("Remove small prooftrace", {
-            #     'name': tr.name(),
-            #     'index': tr._index,
+            #     'index': index,
             # })
-            kernel.remove_premise(tr._index)
+            kernel.remove_premise(index)
 
-    Log.out("Starting final prooftraces generation")
+    return len(lens)
 
-    traces = [ProofTrace(kernel, k) for k in kernel._names.keys()]
-    traces = [tr for tr in traces if len(tr._steps) > 0]
-    traces = sorted(traces, key=lambda tr: tr._index)
 
-    # Finally we localize the resulting traces.
-    for tr in traces:
-        tr.localize()
+def extract_localize(
+        config: Config,
+) -> int:
+    kernel = _extract_state['kernel']
 
-    Log.out("Prooftraces computed, filtered, localized and sorted", {
-        "traces_count": len(traces),
-    })
+    localize_start = time.time()
 
-    for tr in traces:
-        tr.tokenize(tokenizer)
-
-    Log.out("Pre-tokenized prooftraces", {
-        "term_token_count": len(tokenizer._term_tokens),
-        "type_token_count": len(tokenizer._type_tokens),
-    })
+    traces = []
+    blobs = 0
+    for final in extract_map(
+            trace_final,
+            sorted(kernel._names.keys()),
+            config.get('prooftrace_extract_workers'),
+    ):
+        if final is None:
+            continue
+        traces.append(final[0])
+        blobs += final[1]
+    _extract_state['traces'] = traces
 
-    with gzip.open(
-            os.path.join(
-                os.path.expanduser(config.get('prooftrace_dataset_dir')),
-                config.get('prooftrace_dataset_size'),
-                'traces.tokenizer',
-            ), 'wb') as f:
-        pickle.dump(
-            tokenizer, f, protocol=pickle.HIGHEST_PROTOCOL
-        )
+    localize_time = time.time() - localize_start
 
-    Log.out("Dumped tokenizer", {
-        "term_token_count": len(tokenizer._term_tokens),
-        "type_token_count": len(tokenizer._type_tokens),
+    Log.out("Prooftraces computed, filtered, localized and sorted", {
+        "traces_count": len(traces),
+        "blobs": blobs,
+        "blobs_per_sec": "{:.2f}".format(blobs / max(localize_time, 1e-6)),
     })
 
     Log.histogram(
@@ -1627,18 +3024,57 @@ def extract():
         buckets=[64, 128, 256, 512, 1024, 2048, 4096],
         labels=["0064", "0128", "0256", "0512", "1024", "2048", "4096"]
     )
-    Log.out("Starting action generation")
 
-    traces_path_train = os.path.join(
-        os.path.expanduser(config.get('prooftrace_dataset_dir')),
-        config.get('prooftrace_dataset_size'),
-        "train_traces",
-    )
-    traces_path_test = os.path.join(
-        os.path.expanduser(config.get('prooftrace_dataset_dir')),
-        config.get('prooftrace_dataset_size'),
-        "test_traces",
+    return len(kernel._names)
+
+
+def extract_tokenize(
+        config: Config,
+) -> int:
+    traces = _extract_state['traces']
+    tokenizer = ProofTraceTokenizer(
+        config.get('prooftrace_extract_parse_cache_size'),
     )
+    _extract_state['tokenizer'] = tokenizer
+
+    # Tokens are merged in trace index order so that token ids do not depend
+    # on scheduling.
+    for term_tokens, type_tokens in extract_map(
+            trace_tokens,
+            list(range(len(traces))),
+            config.get('prooftrace_extract_workers'),
+    ):
+        merge_tokens(tokenizer, term_tokens, type_tokens)
+
+    Log.out("Pre-tokenized prooftraces", {
+        "term_token_count": len(tokenizer._term_tokens),
+        "type_token_count": len(tokenizer._type_tokens),
+    })
+
+    with gzip.open(
+            os.path.join(extract_dir(config), 'traces.tokenizer'), 'wb',
+    ) as f:
+        pickle.dump(
+            tokenizer, f, protocol=pickle.HIGHEST_PROTOCOL
+        )
+
+    Log.out("Dumped tokenizer", {
+        "term_token_count": len(tokenizer._term_tokens),
+        "type_token_count": len(tokenizer._type_tokens),
+    })
+
+    return len(traces)
+
+
+def extract_dump(
+        config: Config,
+) -> int:
+    traces = _extract_state['traces']
+
+    Log.out("Starting action generation")
+
+    traces_path_train = os.path.join(extract_dir(config), "train_traces")
+    traces_path_test = os.path.join(extract_dir(config), "test_traces")
 
     if os.path.isdir(traces_path_train):
         shutil.rmtree(traces_path_train)
@@ -1647,15 +3083,51 @@ def extract():
         shutil.rmtree(traces_path_test)
     os.mkdir(traces_path_test)
 
-    executor = concurrent.futures.ProcessPoolExecutor(max_workers=8)
+    trace_lengths = []
+    cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    aliases = TraceAliases()
+    canonicals = {}
+    dedupe_bytes = 0
 
-    map_args = []
-    for i, tr in enumerate(traces):
-        map_args.append([config, tokenizer, tr, i, len(traces)])
+    for l, stats, ptra_path, name, content_hash in extract_map(
+            dump_trace,
+            list(range(len(traces))),
+            config.get('prooftrace_extract_workers'),
+    ):
+        for k in cache_stats:
+            cache_stats[k] += stats[k]
 
-    trace_lengths = [
-        l for l in executor.map(dump_trace, map_args, chunksize=8)
-    ]
+        if content_hash is None:
+            trace_lengths.append(l)
+            continue
+
+        # Results come in trace index order, the first trace of each content
+        # in a split is kept.
+        key = (os.path.dirname(ptra_path), content_hash)
+        if key in canonicals:
+            aliases.add(name, canonicals[key])
+            dedupe_bytes += os.path.getsize(ptra_path + '.tmp')
+            os.remove(ptra_path + '.tmp')
+        else:
+            canonicals[key] = name
+            os.rename(ptra_path + '.tmp', ptra_path)
+            trace_lengths.append(l)
+
+    # A table left by a previous extraction would hide traces.
+    if config.get('prooftrace_dataset_dedupe'):
+        aliases.dump(extract_dir(config))
+
+        Log.out("Deduplicated traces", {
+            "trace_count": len(traces),
+            "unique_count": len(canonicals),
+            "alias_count": aliases.len(),
+            "saved_bytes": dedupe_bytes,
+        })
+    elif os.path.isfile(
+            os.path.join(extract_dir(config), TRACE_ALIASES_FILE),
+    ):
+        os.remove(os.path.join(extract_dir(config), TRACE_ALIASES_FILE))
 
     Log.histogram(
         "ProofTraces Length",
@@ -1667,9 +3139,132 @@ def extract():
     Log.out("Dumped all traces", {
         "traces_path_train": traces_path_train,
         "traces_path_test": traces_path_test,
-        "trace_count": len(traces),
+        "trace_count": len(trace_lengths),
+    })
+
+    Log.out("Parse cache", {
+        "cache_size": config.get('prooftrace_extract_parse_cache_size'),
+        "hits": cache_stats['hits'],
+        "misses": cache_stats['misses'],
+        "evictions": cache_stats['evictions'],
+        "hit_rate": "{:.4f}".format(
+            cache_stats['hits'] /
+            max(cache_stats['hits'] + cache_stats['misses'], 1)
+        ),
     })
 
+    if config.get('prooftrace_dataset_store'):
+        from prooftrace.arena import build_store
+        build_store(
+            sorted([
+                os.path.join(d, f)
+                for d in [traces_path_train, traces_path_test]
+                for f in os.listdir(d) if re.search("\\.actions$", f)
+            ]),
+            os.path.join(extract_dir(config), 'traces.store'),
+        )
+
+    return len(traces)
+
+
+def extract():
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument(
+        'config_path',
+        type=str, help="path to the config file",
+    )
+    parser.add_argument(
+        '--dataset_size',
+        type=str, help="config override",
+    )
+    parser.add_argument(
+        '--workers',
+        type=int, help="config override",
+    )
+    parser.add_argument(
+        '--resume_from', '--resume-from',
+        type=str, choices=EXTRACT_PHASES,
+        help="phase to resume extraction from",
+    )
+
+    args = parser.parse_args()
+
+    config = Config.from_file(args.config_path)
+
+    if args.dataset_size is not None:
+        config.override(
+            'prooftrace_dataset_size',
+            args.dataset_size,
+        )
+    if args.workers is not None:
+        config.override(
+            'prooftrace_extract_workers',
+            args.workers,
+        )
+
+    hash_version_set(config.get('prooftrace_hash_version'))
+
+    _extract_state['config'] = config
+
+    phases = {
+        'kernel': extract_kernel,
+        'cross_steps': extract_cross_steps,
+        'shared_premises': extract_shared_premises,
+        'cuts': extract_cuts,
+        'localize': extract_localize,
+        'tokenize': extract_tokenize,
+        'dump': extract_dump,
+    }
+
+    start = 0
+    if args.resume_from is not None:
+        start = EXTRACT_PHASES.index(args.resume_from)
+
+    # The kernel is reloaded when resuming a phase that needs it, then the
+    # latest checkpoint of each kind of state preceding `start` is restored.
+    run = EXTRACT_PHASES[start:]
+    if 0 < start <= EXTRACT_PHASES.index('localize'):
+        run = ['kernel'] + run
+
+    kernel_restore = [
+        phase for phase in ['cuts', 'shared_premises', 'cross_steps']
+        if EXTRACT_PHASES.index(phase) < start
+    ][:1]
+    for phase in ['localize', 'tokenize']:
+        if EXTRACT_PHASES.index(phase) < start:
+            extract_checkpoint_load(config, phase)
+
+    for phase in run:
+        Log.out("Starting extraction phase", {
+            'phase': phase,
+            'workers': config.get('prooftrace_extract_workers'),
+        })
+
+        phase_start = time.time()
+        items = phases[phase](config)
+        phase_time = time.time() - phase_start
+
+        if phase == 'kernel':
+            for p in kernel_restore:
+                extract_checkpoint_load(config, p)
+        else:
+            extract_checkpoint_save(config, phase)
+
+        # ru_maxrss is in kilobytes on Linux, RUSAGE_CHILDREN reports the
+        # largest of the terminated workers.
+        Log.out("Extraction phase done", {
+            'phase': phase,
+            'time': "{:.2f}".format(phase_time),
+            'items': items,
+            'items_per_sec': "{:.2f}".format(items / max(phase_time, 1e-6)),
+            'peak_rss_mb': "{:.1f}".format(resource.getrusage(
+                resource.RUSAGE_SELF,
+            ).ru_maxrss / 1024),
+            'workers_peak_rss_mb': "{:.1f}".format(resource.getrusage(
+                resource.RUSAGE_CHILDREN,
+            ).ru_maxrss / 1024),
+        })
+
     # small: term_token_count=427 type_token_count=70
     # small[1024]: term_token_count=338 type_token_count=70
     # small[1024 min_cut]: term_token_count=427 type_token_count=70
@@ -1687,6 +3282,149 @@ def extract():
 #         'extract_profile()', globals(), locals(), 'extract.profile'
 #     )
 
+class _LegacyBVT():
+    pass
+
+
+def footprint(
+        ptra: ProofTraceActions,
+) -> typing.Tuple[int, int, int]:
+    """ Estimates the memory footprint of the BVTs of a ProofTraceActions
+
+    Returns the number of distinct nodes, their size in bytes with the current
+    `__slots__` representation and the size they would take with the previous
+    `__dict__` based representation (which also carried one token string per
+    Term/Type node). Shared payloads (values, hashes) are not accounted for.
+    """
+    legacy_sizes = {}
+
+    def legacy_size(node):
+        attrs = tuple(node.__getstate__().keys())
+        if attrs not in legacy_sizes:
+            o = _LegacyBVT()
+            for a in attrs:
+                setattr(o, a, None)
+            legacy_sizes[attrs] = sys.getsizeof(o) + sys.getsizeof(o.__dict__)
+        size = legacy_sizes[attrs]
+        if type(node) is Term or type(node) is Type:
+            if node.token() is not None:
+                size += sys.getsizeof(node.token())
+        return size
+
+    count = 0
+    compact = 0
+    legacy = 0
+
+    seen = set()
+    stack = ptra.actions() + ptra.arguments()
+    while len(stack) > 0:
+        node = stack.pop()
+        if node is None or id(node) in seen:
+            continue
+        seen.add(id(node))
+
+        count += 1
+        compact += sys.getsizeof(node)
+        legacy += legacy_size(node)
+
+        if isinstance(node.value, BVT):
+            stack.append(node.value)
+        stack.append(node.left)
+        stack.append(node.right)
+
+    return count, compact, legacy
+
+
+def load_trace(
+        args,
+) -> typing.Optional[typing.Tuple[
+    str, typing.Optional[ProofTraceActions], typing.Dict[str, int],
+]]:
+    """ Decodes one `.actions` file and measures it (process pool worker)
+
+    Returns None for files that are not extracted traces. The decoded
+    ProofTraceActions is only returned if `keep` is set, which `load_traces`
+    never asks of its workers.
+    """
+    path, keep = args
+
+    lengths = trace_lengths(path)
+    if lengths is None:
+        return None
+    ptra_len, prepare_len = lengths
+
+    ptra = ProofTraceActions.load(path)
+    nodes, compact, legacy = footprint(ptra)
+
+    stats = {
+        'prepare_length': prepare_len,
+        'length': ptra_len,
+        'file_bytes': os.path.getsize(path),
+        'nodes': nodes,
+        'bytes': compact,
+        'legacy_bytes': legacy,
+    }
+
+    if not keep:
+        ptra = None
+
+    return path, ptra, stats
+
+
+def load_traces(
+        files: typing.List[str],
+        workers: int,
+        keep: bool = True,
+) -> typing.Iterator[typing.Tuple[
+    str, typing.Optional[ProofTraceActions], typing.Dict[str, int],
+]]:
+    """ Streams `(path, ptra, stats)` for the traces in `files`, in order
+
+    Decoding and measurement are spread over a process pool of `workers`
+    processes. At most `4 * workers` files are in flight, so memory stays
+    bounded when the caller does not hold on to the traces.
+
+    Workers only send back their stats: shipping decoded traces through the
+    pool would pickle them once more and have the caller unpickle them
+    anyway. If `keep` is set the traces are loaded again by the caller
+    (columnar files are only memory-mapped).
+    """
+    if workers <= 1:
+        for path in files:
+            loaded = load_trace((path, keep))
+            if loaded is not None:
+                yield loaded
+        return
+
+    def collect(future):
+        loaded = future.result()
+        if loaded is None or not keep:
+            return loaded
+        path, _, stats = loaded
+        return path, ProofTraceActions.load(path), stats
+
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('fork'),
+    )
+    try:
+        pending = collections.deque()
+        for path in files:
+            pending.append(executor.submit(load_trace, (path, False)))
+            if len(pending) >= 4 * workers:
+                loaded = collect(pending.popleft())
+                if loaded is not None:
+                    yield loaded
+        while len(pending) > 0:
+            loaded = collect(pending.popleft())
+            if loaded is not None:
+                yield loaded
+    finally:
+        for f in pending:
+            f.cancel()
+        executor.shutdown()
+
+
 def load_all():
     parser = argparse.ArgumentParser(description="")
 
@@ -1698,6 +3436,26 @@ def load_all():
         '--dataset_size',
         type=str, help="config override",
     )
+    parser.add_argument(
+        '--workers',
+        type=int, help="config override",
+    )
+    parser.add_argument(
+        '--limit',
+        type=int, help="only load the first `limit` traces",
+    )
+    parser.add_argument(
+        '--sample',
+        type=int, help="only load `sample` traces drawn at random",
+    )
+    parser.add_argument(
+        '--seed',
+        type=int, default=0, help="seed used by `--sample`",
+    )
+    parser.add_argument(
+        '--stream',
+        type=str2bool, help="do not keep the loaded traces in memory",
+    )
 
     args = parser.parse_args()
 
@@ -1708,6 +3466,13 @@ def load_all():
             'prooftrace_dataset_size',
             args.dataset_size,
         )
+    if args.workers is not None:
+        config.override(
+            'prooftrace_load_workers',
+            args.workers,
+        )
+
+    hash_version_set(config.get('prooftrace_hash_version'))
 
     dataset_dir = os.path.join(
         os.path.expanduser(config.get('prooftrace_dataset_dir')),
@@ -1716,35 +3481,424 @@ def load_all():
     )
 
     assert os.path.isdir(dataset_dir)
-    files = [
+    files = sorted([
         os.path.join(dataset_dir, f)
         for f in os.listdir(dataset_dir)
         if os.path.isfile(os.path.join(dataset_dir, f))
-    ]
+    ])
+    available = len(files)
+
+    if args.sample is not None and args.sample < len(files):
+        files = sorted(random.Random(args.seed).sample(files, args.sample))
+    if args.limit is not None:
+        files = files[:args.limit]
+
+    workers = config.get('prooftrace_load_workers')
+    stream = args.stream is not None and args.stream
+
+    Log.out("Loading extracted ProofTraces", {
+        'files': len(files),
+        'available': available,
+        'workers': workers,
+        'stream': stream,
+    })
 
     ptras = []
+    totals = collections.Counter()
 
+    start = time.time()
     processed = 0
-    for p in files:
-        match = re.search("_(\\d+)_(\\d+)\\.actions$", p)
-        if match is None:
-            continue
-        ptra_len = int(match.group(1))
-        prepare_len = int(match.group(2))
-
-        with gzip.open(p, 'rb') as f:
-            ptra = pickle.load(f)
-        ptras.append(ptra)
-        Log.out("Loaded ProofTrace", {
-            'name': ptra.name(),
-            'prepare_length': prepare_len,
-            'length': ptra_len,
-            'processed': processed,
-            'all': len(files),
-        })
+    for path, ptra, stats in load_traces(files, workers, keep=not stream):
+        if not stream:
+            ptras.append(ptra)
+        totals.update(stats)
         processed += 1
 
+        if processed % 1000 == 0:
+            Log.out("Loading ProofTraces", {
+                'processed': processed,
+                'all': len(files),
+                'files_per_sec': "{:.2f}".format(
+                    processed / max(time.time() - start, 1e-6),
+                ),
+            })
+    load_time = time.time() - start
+
+    def per_trace(key):
+        return totals[key] // max(processed, 1)
+
+    # Projections to the whole split assume the loaded files are
+    # representative of it, which `--sample` is meant to ensure. Decoding
+    # happens in the pool workers (reaped once `load_traces` is exhausted),
+    # `peak_rss_mb` only covers the parent process and `workers_peak_rss_mb`
+    # is the peak of the largest worker.
     Log.out(
         "Loaded extracted ProofTraces LM Dataset", {
             'processed': processed,
+            'time': "{:.2f}".format(load_time),
+            'files_per_sec': "{:.2f}".format(
+                processed / max(load_time, 1e-6),
+            ),
+            'mb_per_sec': "{:.2f}".format(
+                totals['file_bytes'] / (1024 * 1024) / max(load_time, 1e-6),
+            ),
+            'length_per_trace': per_trace('length'),
+            'file_bytes_per_trace': per_trace('file_bytes'),
+            'nodes_per_trace': per_trace('nodes'),
+            'bytes_per_trace': per_trace('bytes'),
+            'legacy_bytes_per_trace': per_trace('legacy_bytes'),
+            'projected_mb': "{:.1f}".format(
+                per_trace('bytes') * available / (1024 * 1024),
+            ),
+            'peak_rss_mb': "{:.1f}".format(resource.getrusage(
+                resource.RUSAGE_SELF,
+            ).ru_maxrss / 1024),
+            'workers_peak_rss_mb': "{:.1f}".format(resource.getrusage(
+                resource.RUSAGE_CHILDREN,
+            ).ru_maxrss / 1024),
         })
+
+
+def test_tokenizer():
+    """ Differential test of `ProofTraceTokenizer.term` against its reference
+    recursive implementation over all the theorems of a dataset.
+    """
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument(
+        'config_path',
+        type=str, help="path to the config file",
+    )
+    parser.add_argument(
+        '--dataset_size',
+        type=str, help="config override",
+    )
+
+    args = parser.parse_args()
+
+    config = Config.from_file(args.config_path)
+
+    if args.dataset_size is not None:
+        config.override(
+            'prooftrace_dataset_size',
+            args.dataset_size,
+        )
+
+    kernel = ProofTraceKernel(
+        os.path.expanduser(config.get('prooftrace_dataset_dir')),
+        config.get('prooftrace_dataset_size'),
+    )
+    tokenizer = ProofTraceTokenizer()
+
+    token_pattern = re.compile(r"[vc]\([^\(\)]+\)|[vc]\[[^\[\]]+\]")
+
+    def register(blob):
+        for m in re.findall(token_pattern, blob):
+            token = m[2:-1]
+            if m[1] == '[' and token not in tokenizer._type_tokens:
+                tokenizer._type_tokens[token] = len(tokenizer._type_tokens)
+            if m[1] == '(' and token not in tokenizer._term_tokens:
+                tokenizer._term_tokens[token] = len(tokenizer._term_tokens)
+
+    def equal(a, b):
+        stack = [(a, b)]
+        while len(stack) > 0:
+            x, y = stack.pop()
+            if x is None or y is None:
+                if x is not y:
+                    return False
+                continue
+            if type(x) is not type(y) or x.token() != y.token():
+                return False
+            if isinstance(x.value, BVT):
+                stack.append((x.value, y.value))
+            elif x.value != y.value:
+                return False
+            stack.append((x.left, y.left))
+            stack.append((x.right, y.right))
+        return True
+
+    blobs = 0
+    chars = 0
+    deep = 0
+    linear_time = 0.0
+    recursive_time = 0.0
+    for idx in kernel._theorems:
+        th = kernel._theorems[idx]
+        for blob in [th['cc']] + th['hy']:
+            register(blob)
+
+            start = time.time()
+            linear = tokenizer.term(blob)
+            linear_time += time.time() - start
+
+            # The reference implementation is bound by the recursion limit,
+            # deeper terms are only parsed linearly.
+            start = time.time()
+            try:
+                recursive = tokenizer.term_recursive(blob)
+            except RecursionError:
+                deep += 1
+                continue
+            recursive_time += time.time() - start
+
+            if not equal(linear, recursive):
+                Log.out("Mismatch", {
+                    'theorem': idx,
+                    'blob': blob,
+                })
+                assert False
+
+            blobs += 1
+            chars += len(blob)
+
+    Log.out("Tokenizer differential test", {
+        'blob_count': blobs,
+        'char_count': chars,
+        'deep_count': deep,
+        'linear_time': "{:.2f}".format(linear_time),
+        'recursive_time': "{:.2f}".format(recursive_time),
+    })
+
+
+def test_hashing():
+    """ Differential test of the iterative BVT `hash`, `depth`, `term_string`
+    and `type_string` against reference recursive implementations over a
+    random sample of the theorems of a dataset.
+
+    Theorems too deep for the references are still hashed and rendered but
+    only counted.
+    """
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument(
+        'config_path',
+        type=str, help="path to the config file",
+    )
+    parser.add_argument(
+        '--dataset_size',
+        type=str, help="config override",
+    )
+    parser.add_argument(
+        '--sample',
+        type=int, default=3000, help="number of theorems to check",
+    )
+    parser.add_argument(
+        '--seed',
+        type=int, default=0, help="sampling seed",
+    )
+
+    args = parser.parse_args()
+
+    config = Config.from_file(args.config_path)
+
+    if args.dataset_size is not None:
+        config.override(
+            'prooftrace_dataset_size',
+            args.dataset_size,
+        )
+
+    hash_version_set(config.get('prooftrace_hash_version'))
+
+    kernel = ProofTraceKernel(
+        os.path.expanduser(config.get('prooftrace_dataset_dir')),
+        config.get('prooftrace_dataset_size'),
+    )
+    tokenizer = ProofTraceTokenizer()
+
+    def nodes(tree):
+        seen = {}
+        stack = [tree]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node is None or id(node) in seen:
+                continue
+            seen[id(node)] = node
+            if isinstance(node.value, BVT):
+                stack.append(node.value)
+            stack.append(node.left)
+            stack.append(node.right)
+        return list(seen.values())
+
+    def reset(tree):
+        for node in nodes(tree):
+            node._hash = None
+            node._depth = None
+            if type(node) is Term:
+                node._strings = None
+            if type(node) is Type:
+                node._string = None
+
+    # Both references memoize on the nodes, as BVT did before its traversals
+    # were made iterative, so that shared subtrees are only visited once.
+    def hash_recursive(node):
+        if node._hash is None:
+            for child in node.hash_children():
+                hash_recursive(child)
+            node._hash = node.hash_node()
+        return node._hash
+
+    def depth_recursive(node):
+        if node is None:
+            return -1
+        if node._depth is None:
+            node._depth = 1 + max(
+                depth_recursive(node.left), depth_recursive(node.right),
+            )
+        return node._depth
+
+    def type_recursive(typ, ifx):
+        if typ.token() == '__v':
+            token = typ.left.token()
+            if token[0] == '?':
+                return '(_?_' + token[1:] + ')'
+            return token
+        if typ.token() == '__a':
+            if typ.right is None:
+                return type_recursive(typ.left, None)
+            return type_recursive(typ.left, None) + \
+                (ifx if ifx is not None else ',') + \
+                type_recursive(typ.right, None)
+        if typ.token() == '__c':
+            token = typ.left.token()
+            if token == 'fun':
+                return '(' + type_recursive(typ.right, '->') + ')'
+            if token == 'prod':
+                return '(' + type_recursive(typ.right, '#') + ')'
+            if typ.right is None:
+                return token
+            return '(' + type_recursive(typ.right, None) + ')' + token
+        assert False
+
+    def term_recursive(term, args, bounded, de_bruijn, skip_type):
+        def v_term(term, bounded):
+            if skip_type:
+                return term.left.token()
+            typ = ':' + type_recursive(term.right.value, None)
+            tm = '(' + term.left.token() + typ + ')'
+            if de_bruijn and tm in bounded:
+                for i in reversed(range(len(bounded))):
+                    if tm == bounded[i]:
+                        return '(b' + str(i) + typ + ')'
+            return tm
+
+        def applied(tm):
+            if len(args) == 0:
+                return tm
+            return '(' + tm + ''.join([' ' + a for a in args]) + ')'
+
+        if term.token() == '__C':
+            right = term_recursive(
+                term.right, [], bounded, de_bruijn, skip_type,
+            )
+            return term_recursive(
+                term.left, [right] + args, bounded, de_bruijn, skip_type,
+            )
+        if term.token() == '__A':
+            left = v_term(term.left, [])
+            right = term_recursive(
+                term.right, [], bounded + [left], de_bruijn, skip_type,
+            )
+            left = v_term(term.left, bounded + [left])
+            return applied('(\\' + left + '. ' + right + ')')
+        if term.token() == '__c':
+            token = term.left.token()
+            if token in ["=", "==>", "/\\", "\\/"] and len(args) == 2:
+                return '(' + args[0] + ' ' + token + ' ' + args[1] + ')'
+            if skip_type:
+                return applied('(' + token + ')')
+            return applied(
+                '((' + token + ')' +
+                ':' + type_recursive(term.right.value, None) + ')'
+            )
+        if term.token() == '__v':
+            return applied(v_term(term, bounded))
+        assert False
+
+    def iterative(action, terms, types):
+        reset(action)
+        out = [action.hash()]
+        for term in terms:
+            out += [term.hash(), term.depth()]
+            for key in [(False, False), (True, False), (False, True)]:
+                # The second rendering is served from the memoized strings.
+                out += [term.term_string(*key), term.term_string(*key)]
+        for typ in types:
+            out += [typ.depth(), typ.type_string(), typ.type_string()]
+        return out
+
+    def recursive(action, terms, types):
+        reset(action)
+        out = [hash_recursive(action)]
+        for term in terms:
+            out += [hash_recursive(term), depth_recursive(term)]
+            for key in [(False, False), (True, False), (False, True)]:
+                tm = term_recursive(term, [], [], *key)
+                out += [tm, tm]
+        for typ in types:
+            tp = ':' + type_recursive(typ, None)
+            out += [depth_recursive(typ), tp, tp]
+        return out
+
+    indices = sorted(kernel._theorems.keys())
+    random.Random(args.seed).shuffle(indices)
+
+    theorems = 0
+    terms_count = 0
+    types_count = 0
+    deep = 0
+    iterative_time = 0.0
+    recursive_time = 0.0
+    for idx in indices[:args.sample]:
+        th = kernel._theorems[idx]
+        blobs = [th['cc']] + th['hy']
+        merge_tokens(tokenizer, *ProofTrace.split_tokens([
+            [m.group() for m in LOCALIZE_PATTERN.finditer(blob)]
+            for blob in blobs
+        ]))
+
+        terms = [tokenizer.term(blob) for blob in blobs]
+        hypothesis = None
+        for term in reversed(terms[1:]):
+            hypothesis = Action.from_action(
+                'HYPOTHESIS', Action.from_term(term), hypothesis,
+            )
+        action = Action.from_action(
+            'THEOREM', hypothesis, Action.from_term(terms[0]),
+        )
+        types = {}
+        for term in terms:
+            for node in nodes(term):
+                if type(node.value) is Type:
+                    types[id(node.value)] = node.value
+        types = list(types.values())
+
+        start = time.time()
+        linear = iterative(action, terms, types)
+        iterative_time += time.time() - start
+
+        start = time.time()
+        try:
+            reference = recursive(action, terms, types)
+        except RecursionError:
+            deep += 1
+            continue
+        recursive_time += time.time() - start
+
+        if linear != reference:
+            Log.out("Mismatch", {
+                'theorem': idx,
+            })
+            assert False
+
+        theorems += 1
+        terms_count += len(terms)
+        types_count += len(types)
+
+    Log.out("Hashing differential test", {
+        'hash_version': hash_version(),
+        'theorem_count': theorems,
+        'term_count': terms_count,
+        'type_count': types_count,
+        'deep_count': deep,
+        'iterative_time': "{:.2f}".format(iterative_time),
+        'recursive_time': "{:.2f}".format(recursive_time),
+    })
@@ -5,13 +5,14 @@ import gzip
 import os
 import pickle
 import random
-import re
 import torch
 import typing
 
+from generic.tree_lstm import hash_version_set
+
 from prooftrace.prooftrace import \
     PROOFTRACE_TOKENS, PREPARE_TOKENS, INV_PROOFTRACE_TOKENS, INV_PREPARE_TOKENS, \
-    Action, ProofTraceActions, TypeException
+    Action, ProofTraceActions, TraceAliases, TypeException, trace_lengths
 
 from prooftrace.repl.fusion import FusionException
 from prooftrace.repl.repl import REPL, REPLException
@@ -32,6 +33,10 @@ class Env:
 
         self._device = torch.device(config.get('device'))
 
+        # Envs can be used standalone, outside of an entry point setting the
+        # hashing scheme.
+        hash_version_set(config.get('prooftrace_hash_version'))
+
         if test:
             dataset_dir = os.path.join(
                 os.path.expanduser(config.get('prooftrace_dataset_dir')),
@@ -46,12 +51,15 @@ class Env:
             )
         assert os.path.isdir(dataset_dir)
 
-        self._trace_files = [
-            os.path.join(dataset_dir, f)
-            for f in os.listdir(dataset_dir)
-            if (os.path.isfile(os.path.join(dataset_dir, f)) and
-                re.search("\\.actions$", f) is not None)
-        ]
+        aliases = TraceAliases.load(os.path.dirname(dataset_dir))
+
+        # Trace lengths are read from the file headers once so that `reset`
+        # only samples among traces that fit the sequence length.
+        self._trace_files = []
+        for path in aliases.trace_files(dataset_dir):
+            lengths = trace_lengths(path)
+            if lengths is not None and lengths[0] <= self._sequence_length:
+                self._trace_files.append(path)
 
         with gzip.open(
                 os.path.join(
@@ -66,6 +74,7 @@ class Env:
         self._repl = None
         self._target = None
         self._alpha = 0
+        self._oracle_start = 0
 
     def reset(
             self,
@@ -81,19 +90,13 @@ class Env:
 
         self._match_count = 0
 
-        while self._ground is None:
-            path = random.choice(self._trace_files)
-
-            match = re.search("_(\\d+)_(\\d+)\\.actions$", path)
-            ptra_len = int(match.group(1))
-
-            if ptra_len <= self._sequence_length:
-                with gzip.open(path, 'rb') as f:
-                    self._ground = pickle.load(f)
-                # Log.out("Selecting trace", {
-                #     "trace": self._ground.name(),
-                #     'length': self._ground.len(),
-                # })
+        path = random.choice(self._trace_files)
+        self._ground = ProofTraceActions.load(path)
+        self._oracle_start = self._ground.prepare_len()
+        # Log.out("Selecting trace", {
+        #     "trace": self._ground.name(),
+        #     'length': self._ground.len(),
+        # })
 
         self._run = ProofTraceActions(
             'REPL-{}-{}'.format(
@@ -169,7 +172,14 @@ class Env:
             self,
     ) -> typing.Tuple[torch.Tensor, int]:
         self._alpha += 1
-        for i in range(self._ground.prepare_len(), self._ground.len()):
+
+        # Ground actions already seen by the run stay seen, skip them once
+        # and for all.
+        while self._oracle_start < self._ground.len() and \
+                self._run.seen(self._ground.actions()[self._oracle_start]):
+            self._oracle_start += 1
+
+        for i in range(self._oracle_start, self._ground.len()):
             a = self._ground.actions()[i]
             if (not self._run.seen(a)) and \
                     self._run.seen(a.left) and \
@@ -178,8 +188,8 @@ class Env:
                 assert a.value < len(PROOFTRACE_TOKENS)
                 actions = torch.tensor([[
                     a.value - len(PREPARE_TOKENS),
-                    self._run.hashes()[a.left.hash()],
-                    self._run.hashes()[a.right.hash()],
+                    self._run.position_of(a.left),
+                    self._run.position_of(a.right),
                 ]], dtype=torch.int64).to(self._device)
                 return actions, 0
 
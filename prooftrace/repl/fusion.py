@@ -8,6 +8,8 @@ from prooftrace.prooftrace import \
     ProofTraceKernel, ProofTraceTokenizer, \
     Type, Term
 
+from generic.tree_lstm import intern
+
 from utils.config import Config
 from utils.log import Log
 
@@ -91,7 +93,7 @@ class Fusion():
             token,
     ) -> Type:
         if token == '=':
-            return Term(5, None, None, '=')
+            return intern(Term(5, None, None, '='))
         assert False
 
     def token_type(
@@ -99,9 +101,9 @@ class Fusion():
             token,
     ) -> Type:
         if token == 'fun':
-            return Type(4, None, None, 'fun')
+            return intern(Type(4, None, None, 'fun'))
         if token == 'bool':
-            return Type(3, None, None, 'fun')
+            return intern(Type(3, None, None, 'fun'))
         assert False
 
     def fun_type(
@@ -109,22 +111,24 @@ class Fusion():
             left: Type,
             right: Type,
     ) -> Type:
-        return Type(
+        return intern(Type(
             0,
             self.token_type('fun'),
-            Type(2, left, Type(2, right, None, '__a'), '__a'),
+            intern(Type(
+                2, left, intern(Type(2, right, None, '__a')), '__a',
+            )),
             '__c',
-        )
+        ))
 
     def bool_type(
             self,
     ) -> Type:
-        return Type(
+        return intern(Type(
             0,
             self.token_type('bool'),
             None,
             '__c',
-        )
+        ))
 
     def type_of(
             self,
@@ -160,20 +164,20 @@ class Fusion():
     ) -> Term:
         ty = self.type_of(left)
 
-        return Term(
+        return intern(Term(
             0,
-            Term(
-                0, Term(
+            intern(Term(
+                0, intern(Term(
                     2, self.token_term('='),
-                    Term(
+                    intern(Term(
                         self.fun_type(
                             ty,
                             self.fun_type(ty, self.bool_type()),
                         ), None, None, None,
-                    ), '__c'
-                ), left, '__C',
-            ), right, '__C',
-        )
+                    )), '__c'
+                )), left, '__C',
+            )), right, '__C',
+        ))
 
     def term_union(
             self,
@@ -278,7 +282,7 @@ class Fusion():
 
         return self._theorem(
             self.term_union(thm1.hyp(), thm2.hyp()),
-            Term(0, eql, r, '__C'),
+            intern(Term(0, eql, r, '__C')),
             fake,
         )
 
@@ -329,8 +333,8 @@ class Fusion():
         return self._theorem(
             self.term_union(thm1.hyp(), thm2.hyp()),
             self.safe_mk_eq(
-                Term(0, l1, l2, '__C'),
-                Term(0, r1, r2, '__C'),
+                intern(Term(0, l1, l2, '__C')),
+                intern(Term(0, r1, r2, '__C')),
             ),
             fake,
         )
@@ -363,8 +367,8 @@ class Fusion():
         return self._theorem(
             thm1.hyp(),
             self.safe_mk_eq(
-                Term(1, v, l1, '__A'),
-                Term(1, v, r1, '__A'),
+                intern(Term(1, v, l1, '__A')),
+                intern(Term(1, v, r1, '__A')),
             ),
             fake,
         )
@@ -524,9 +528,9 @@ class Fusion():
 
         return self.variant(
             avoid,
-            Term(3, Term(
+            intern(Term(3, intern(Term(
                 self._t._term_tokens[token], None, None, token
-            ), v.right, '__v'),
+            )), v.right, '__v')),
         )
 
     def subst(
@@ -556,7 +560,7 @@ class Fusion():
                         rtm.hash() == tm.right.hash():
                     return tm
                 else:
-                    return Term(0, ltm, rtm, '__C')
+                    return intern(Term(0, ltm, rtm, '__C'))
             if tm.token() == '__A':
                 v = tm.left
                 fsubst = list(filter(
@@ -572,10 +576,10 @@ class Fusion():
                         fsubst,
                 ))) > 0:
                     vv = self.variant([b], v)
-                    return Term(1, vv, vsubst(
+                    return intern(Term(1, vv, vsubst(
                         tm.right, fsubst + [[v, vv]]
-                    ), '__A')
-                return Term(1, v, b, '__A')
+                    ), '__A'))
+                return intern(Term(1, v, b, '__A'))
 
         return vsubst(tm, subst)
 
@@ -620,12 +624,12 @@ class Fusion():
                 if lty.hash() == ty.left.hash() and \
                         (ty.right is None or rty.hash() == ty.right.hash()):
                     return ty
-                return Type(2, lty, rty, '__a')
+                return intern(Type(2, lty, rty, '__a'))
             if ty.token() == '__c':
                 rty = tsubst(ty.right, subst_type)
                 if ty.right is None or rty.hash() == ty.right.hash():
                     return ty
-                return Type(0, ty.left, rty, '__c')
+                return intern(Type(0, ty.left, rty, '__c'))
 
         class Clash(Exception):
             def __init__(
@@ -637,7 +641,9 @@ class Fusion():
         def inst(tm, subst_type, env):
             if tm.token() == '__v':
                 ty = tsubst(tm.right.value, subst_type)
-                stm = Term(3, tm.left, Term(ty, None, None, None), '__v')
+                stm = intern(Term(
+                    3, tm.left, intern(Term(ty, None, None, None)), '__v',
+                ))
                 if ty.hash() == tm.right.value.hash():
                     stm = tm
                 ttm = tm
@@ -651,7 +657,9 @@ class Fusion():
                 ty = tsubst(tm.right.value, subst_type)
                 if ty.hash() == tm.right.value.hash():
                     return tm
-                return Term(2, tm.left, Term(ty, None, None, None), '__c')
+                return intern(Term(
+                    2, tm.left, intern(Term(ty, None, None, None)), '__c',
+                ))
             if tm.token() == '__C':
                 ltm = inst(tm.left, subst_type, env)
                 rtm = inst(tm.right, subst_type, env)
@@ -659,7 +667,7 @@ class Fusion():
                         rtm.hash() == tm.right.hash():
                     return tm
                 else:
-                    return Term(0, ltm, rtm, '__C')
+                    return intern(Term(0, ltm, rtm, '__C'))
             if tm.token() == '__A':
                 v = inst(tm.left, subst_type, [])
                 try:
@@ -668,7 +676,7 @@ class Fusion():
                             b.hash() == tm.right.hash():
                         return tm
                     else:
-                        return Term(1, v, b, '__A')
+                        return intern(Term(1, v, b, '__A'))
                 except Clash as e:
                     assume(e.term.term_string() == v.term_string())
                     frees = [inst(v, subst_type, [])
@@ -676,11 +684,11 @@ class Fusion():
                     vv = self.variant(frees, v)
                     assume(vv.token() == '__v')
                     assume(v.token() == '__v')
-                    z = Term(3, vv.left, tm.left.right, '__v')
+                    z = intern(Term(3, vv.left, tm.left.right, '__v'))
                     return inst(
-                        Term(1, z, self.subst(
+                        intern(Term(1, z, self.subst(
                             tm.right, [[tm.left, z]]
-                        ), '__A'),
+                        ), '__A')),
                         subst_type,
                         env,
                     )
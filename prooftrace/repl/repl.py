@@ -3,10 +3,12 @@ import gzip
 import os
 import pickle
 import re
+import time
 
 from prooftrace.prooftrace import \
     PROOFTRACE_TOKENS, INV_PROOFTRACE_TOKENS, INV_ACTION_TOKENS, \
-    ProofTraceTokenizer, Action, ProofTraceActions, TypeException
+    ProofTraceTokenizer, Action, ProofTraceActions, TypeException, \
+    string_cache_enable
 
 from prooftrace.repl.fusion import Fusion, Thm, FusionException
 
@@ -267,15 +269,16 @@ def test():
             ), 'rb') as f:
         tokenizer = pickle.load(f)
 
-    dataset_dir = "./data/prooftrace/{}/train_traces".format(
-        config.get("prooftrace_dataset_size"),
+    dataset_dir = os.path.join(
+        os.path.expanduser(config.get('prooftrace_dataset_dir')),
+        config.get('prooftrace_dataset_size'),
+        'train_traces',
     )
     files = [os.path.join(dataset_dir, f) for f in os.listdir(dataset_dir)]
     for p in files:
         if re.search("\\.actions$", p) is None:
             continue
-        with gzip.open(p, 'rb') as f:
-            ptra = pickle.load(f)
+        ptra = ProofTraceActions.load(p)
 
         Log.out("Replaying ProofTraceActions", {
             "path": p,
@@ -285,3 +288,77 @@ def test():
         repl = REPL(tokenizer)
         repl.prepare(ptra)
         repl.replay(ptra)
+
+
+def bench():
+    parser = argparse.ArgumentParser(description="")
+
+    parser.add_argument(
+        'config_path',
+        type=str, help="path to the config file",
+    )
+    parser.add_argument(
+        '--dataset_size',
+        type=str, help="config override",
+    )
+    parser.add_argument(
+        '--limit',
+        type=int, default=32, help="number of traces to replay",
+    )
+
+    args = parser.parse_args()
+
+    config = Config.from_file(args.config_path)
+
+    if args.dataset_size is not None:
+        config.override(
+            'prooftrace_dataset_size',
+            args.dataset_size,
+        )
+
+    with gzip.open(
+            os.path.join(
+                os.path.expanduser(config.get('prooftrace_dataset_dir')),
+                config.get('prooftrace_dataset_size'),
+                'traces.tokenizer',
+            ), 'rb') as f:
+        tokenizer = pickle.load(f)
+
+    dataset_dir = os.path.join(
+        os.path.expanduser(config.get('prooftrace_dataset_dir')),
+        config.get('prooftrace_dataset_size'),
+        'train_traces',
+    )
+    files = sorted([
+        os.path.join(dataset_dir, f)
+        for f in os.listdir(dataset_dir)
+        if re.search("\\.actions$", f) is not None
+    ])[:args.limit]
+
+    def run():
+        # Traces are reloaded for each run so that each run replays fresh
+        # objects (term string caches are not serialized). Loading is not
+        # timed.
+        traces = [ProofTraceActions.load(p) for p in files]
+
+        actions = 0
+        start = time.time()
+        for ptra in traces:
+            repl = REPL(tokenizer)
+            repl.prepare(ptra)
+            repl.replay(ptra)
+            actions += ptra.len()
+        return actions, time.time() - start
+
+    for enabled in [False, True]:
+        string_cache_enable(enabled)
+        actions, duration = run()
+        Log.out("REPL replay benchmark", {
+            "string_cache": enabled,
+            "traces_count": len(files),
+            "actions_count": actions,
+            "time": "{:.2f}".format(duration),
+            "actions_per_second": "{:.2f}".format(actions / duration),
+        })
+
+    string_cache_enable(True)
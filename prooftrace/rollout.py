@@ -8,7 +8,10 @@ import random
 import re
 import typing
 
-from prooftrace.prooftrace import ProofTraceActions
+from generic.tree_lstm import hash_version_set
+
+from prooftrace.prooftrace import \
+    ProofTraceActions, TraceAliases, TraceHeader, TRACE_HEADER_ROLLOUT
 
 from utils.config import Config
 from utils.log import Log
@@ -54,6 +57,40 @@ class Rollout():
 
         return self
 
+    def header(
+            self,
+    ) -> TraceHeader:
+        if len(self._positives) > 0:
+            ptra = min(self._positives, key=lambda p: p.len())
+        else:
+            ptra = self._negatives[0]
+
+        header = TraceHeader.from_ptra(ptra, kind=TRACE_HEADER_ROLLOUT)
+        header.name = self._name
+        header.positive_count = len(self._positives)
+        header.negative_count = len(self._negatives)
+
+        return header
+
+    def dump(
+            self,
+            path: str,
+    ) -> None:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.header().pack())
+            with gzip.GzipFile(fileobj=f, mode='wb') as g:
+                pickle.dump(
+                    self, g, protocol=pickle.HIGHEST_PROTOCOL,
+                )
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def load(
+            path: str,
+    ):
+        return TraceHeader.load_pickle(path)
+
     def positive(
             self,
     ) -> ProofTraceActions:
@@ -84,8 +121,7 @@ def translate(
 ):
     config, test, path, idx = args
 
-    with gzip.open(path, 'rb') as f:
-        ptra = pickle.load(f)
+    ptra = ProofTraceActions.load(path)
 
     rollout = Rollout(ptra.name(), [ptra], [])
 
@@ -112,10 +148,7 @@ def translate(
     tmp_path = os.path.join(rdir, "{}_{}.tmp".format(now, rnd))
     fnl_path = os.path.join(rdir, "{}_{}.rollout".format(now, rnd))
 
-    with gzip.open(tmp_path, 'wb') as f:
-        pickle.dump(
-            rollout, f, protocol=pickle.HIGHEST_PROTOCOL
-        )
+    rollout.dump(tmp_path)
     os.rename(tmp_path, fnl_path)
 
     Log.out("Writing Rollout", {
@@ -166,6 +199,8 @@ def bootstrap():
             args.dataset_size,
         )
 
+    hash_version_set(config.get('prooftrace_hash_version'))
+
     test = False
     if args.test is not None:
         test = args.test
@@ -184,11 +219,9 @@ def bootstrap():
         )
 
     assert os.path.isdir(dataset_dir)
-    files = [
-        os.path.join(dataset_dir, f)
-        for f in os.listdir(dataset_dir)
-        if os.path.isfile(os.path.join(dataset_dir, f))
-    ]
+    files = TraceAliases.load(
+        os.path.dirname(dataset_dir),
+    ).trace_files(dataset_dir)
 
     Log.out('Processing prooftraces', {
         'count': len(files),
@@ -239,16 +272,18 @@ def read(
         for f in os.listdir(rdir) if re.search(".rollout$", f)
     ], reverse=True)
 
-    with gzip.open(rfiles[0], 'rb') as f:
-        rollout = pickle.load(f)
+    header = TraceHeader.read(rfiles[0])
+    if header is None:
+        rollout = Rollout.load(rfiles[0])
+        header = rollout.header()
 
     Log.out("Rollout", {
         'rdir': rdir,
-        'positives': len(rollout._positives),
-        'negatives': len(rollout._negatives),
+        'positives': header.positive_count,
+        'negatives': header.negative_count,
     })
 
-    return (len(rollout._positives), len(rollout._negatives))
+    return (header.positive_count, header.negative_count)
 
 
 def inspect():
@@ -282,6 +317,8 @@ def inspect():
             args.dataset_size,
         )
 
+    hash_version_set(config.get('prooftrace_hash_version'))
+
     rollout_dir = os.path.join(
         os.path.expanduser(config.get('prooftrace_rollout_dir')),
         config.get('prooftrace_dataset_size'),
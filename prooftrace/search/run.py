@@ -4,11 +4,13 @@ import gzip
 import pickle
 import os
 import random
-import re
 import time
 
+from generic.tree_lstm import intern_enable, hash_version_set
+
 from prooftrace.models.model import LModel
-from prooftrace.prooftrace import INV_PREPARE_TOKENS, ProofTraceActions
+from prooftrace.prooftrace import \
+    INV_PREPARE_TOKENS, ProofTraceActions, trace_lengths
 from prooftrace.repl.repl import REPL
 from prooftrace.search.beam import Beam
 # from prooftrace.search.mcts import MCTS
@@ -98,26 +100,29 @@ def search():
         tokenizer = pickle.load(f)
 
     for p in files:
-        match = re.search("_(\\d+)_(\\d+)\\.actions$", p)
-        if match is None:
+        lengths = trace_lengths(p)
+        if lengths is None:
             continue
-        ptra_len = int(match.group(1))
-        cases.append((p, ptra_len))
+        cases.append((p, lengths[0]))
 
     Log.out(
         "Loaded ProofTraceActions", {
             'cases': len(cases),
         })
 
+    if config.get('prooftrace_intern_table') is not None:
+        intern_enable(config.get('prooftrace_intern_table') == 'weak')
+    hash_version_set(config.get('prooftrace_hash_version'))
+
     l_model = LModel(config).load()
+    l_model.eval()
     # v_model = VModel(config).load()
 
     cases = sorted(cases, key=lambda c: c[1])
 
     for i in range(len(cases)):
         c = cases[i][0]
-        with gzip.open(c, 'rb') as f:
-            ground = pickle.load(f)
+        ground = ProofTraceActions.load(c).intern()
 
         ptra = ProofTraceActions(
             'SEARCH-{}-{}'.format(
@@ -197,11 +202,14 @@ def search():
             done, ptra, proved = search.step(offset, conclusion)
             step_end = time.time()
 
+            cache = l_model.modules()['pE'].cache_stats(True)
             Log.out('STEP', {
                 'i': i,
                 'done': done,
                 'proved': proved,
                 'time': "{:.2f}".format(step_end - step_start),
+                'cache_hits': cache['hits'],
+                'cache_misses': cache['misses'],
                 'summary': ptra.summary(offset),
             })
             if done:
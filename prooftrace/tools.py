@@ -1,13 +1,17 @@
 import argparse
-import gzip
-import pickle
 import os
 import random
+import re
 import sys
 import torch
 import typing
 
-from prooftrace.prooftrace import PROOFTRACE_TOKENS, ProofTraceActions
+from generic.tree_lstm import HASH_VERSION, hash_version_set
+
+from prooftrace.arena import is_columnar, build_store, build_kernel_cache
+from prooftrace.prooftrace import \
+    PROOFTRACE_TOKENS, ProofTraceActions, TraceHeader
+from prooftrace.rollout import Rollout
 
 from utils.config import Config
 from utils.log import Log
@@ -65,8 +69,7 @@ def search_ptra(
     if path is None:
         return None, None
 
-    with gzip.open(path, 'rb') as f:
-        ptra = pickle.load(f)
+    ptra = ProofTraceActions.load(path)
 
     return path, ptra
 
@@ -197,3 +200,190 @@ def generate_testset():
     testset = random.sample(files, args.count)
     for p in testset:
         print("mv {} {}/".format(p, test_dataset_dir))
+
+
+def rehash():
+    """ Rewrites `.actions` and `.rollout` pickles in place with the hashes of
+    their BVTs recomputed using the requested hashing scheme.
+    """
+    parser = argparse.ArgumentParser(description="")
+
+    parser.add_argument(
+        'paths',
+        type=str, nargs='+', help="files or directories to rehash",
+    )
+    parser.add_argument(
+        '--hash_version',
+        type=int, default=HASH_VERSION, help="target hashing scheme",
+    )
+
+    args = parser.parse_args()
+
+    hash_version_set(args.hash_version)
+
+    files = []
+    for path in args.paths:
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files += [os.path.join(root, n) for n in names]
+        else:
+            files.append(path)
+    files = sorted([
+        p for p in files if re.search("\\.(actions|rollout)$", p)
+    ])
+
+    for i, p in enumerate(files):
+        if is_columnar(p):
+            ptra = ProofTraceActions.load(p).rehash()
+            ptra.dump(p, True)
+            ptras = [ptra]
+        else:
+            obj = TraceHeader.load_pickle(p)
+
+            if isinstance(obj, Rollout):
+                ptras = obj._positives + obj._negatives
+            else:
+                assert isinstance(obj, ProofTraceActions)
+                ptras = [obj]
+
+            for ptra in ptras:
+                ptra.rehash()
+
+            # Rewriting also adds headers to files that had none.
+            obj.dump(p)
+
+        Log.out("Rehashed", {
+            'path': p,
+            'ptra_count': len(ptras),
+            'hash_version': args.hash_version,
+            'progress': "{}/{}".format(i + 1, len(files)),
+        })
+
+
+def columnar():
+    """ Converts `.actions` files between gzip pickles and the columnar format
+    in place.
+    """
+    parser = argparse.ArgumentParser(description="")
+
+    parser.add_argument(
+        'paths',
+        type=str, nargs='+', help="files or directories to convert",
+    )
+    parser.add_argument(
+        '--to_pickle',
+        action='store_true', help="convert back to gzip pickles",
+    )
+
+    args = parser.parse_args()
+
+    files = []
+    for path in args.paths:
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files += [os.path.join(root, n) for n in names]
+        else:
+            files.append(path)
+    files = sorted([p for p in files if re.search("\\.actions$", p)])
+
+    converted = 0
+    for i, p in enumerate(files):
+        if is_columnar(p) != args.to_pickle:
+            continue
+
+        src_size = os.path.getsize(p)
+        ptra = ProofTraceActions.load(p)
+        if args.to_pickle:
+            # Mapped traces are pickled as regular ProofTraceActions.
+            ptra.dump(p)
+        else:
+            ptra.dump(p, True)
+        converted += 1
+
+        Log.out("Converted", {
+            'path': p,
+            'columnar': not args.to_pickle,
+            'src_size': src_size,
+            'dst_size': os.path.getsize(p),
+            'progress': "{}/{}".format(i + 1, len(files)),
+        })
+
+    Log.out("Conversion done", {
+        'file_count': len(files),
+        'converted_count': converted,
+    })
+
+
+def store():
+    """ Rewrites the traces of a dataset as columnar files backed by a shared
+    dataset-level store of their Terms and Types.
+    """
+    parser = argparse.ArgumentParser(description="")
+
+    parser.add_argument(
+        'config_path',
+        type=str, help="path to the config file",
+    )
+    parser.add_argument(
+        '--dataset_size',
+        type=str, help="config override",
+    )
+
+    args = parser.parse_args()
+
+    config = Config.from_file(args.config_path)
+
+    if args.dataset_size is not None:
+        config.override(
+            'prooftrace_dataset_size',
+            args.dataset_size,
+        )
+
+    dataset_dir = os.path.join(
+        os.path.expanduser(config.get('prooftrace_dataset_dir')),
+        config.get('prooftrace_dataset_size'),
+    )
+
+    files = []
+    for target in ['train_traces', 'test_traces']:
+        d = os.path.join(dataset_dir, target)
+        if os.path.isdir(d):
+            files += [
+                os.path.join(d, f) for f in os.listdir(d)
+                if re.search("\\.actions$", f)
+            ]
+
+    build_store(sorted(files), os.path.join(dataset_dir, 'traces.store'))
+
+
+def kernel_cache():
+    """ Converts the JSONL kernel dumps of a dataset into the binary indexed
+    kernel cache memory-mapped by ProofTraceKernel.
+    """
+    parser = argparse.ArgumentParser(description="")
+
+    parser.add_argument(
+        'config_path',
+        type=str, help="path to the config file",
+    )
+    parser.add_argument(
+        '--dataset_size',
+        type=str, help="config override",
+    )
+
+    args = parser.parse_args()
+
+    config = Config.from_file(args.config_path)
+
+    if args.dataset_size is not None:
+        config.override(
+            'prooftrace_dataset_size',
+            args.dataset_size,
+        )
+
+    build_kernel_cache(os.path.join(
+        os.path.expanduser(config.get('prooftrace_dataset_dir')),
+        config.get('prooftrace_dataset_size'),
+    ))
@@ -16,12 +16,20 @@ setup(
             'prooftrace_extract=prooftrace.prooftrace:extract',
             'prooftrace_load_all=prooftrace.prooftrace:load_all',
             'prooftrace_dump=prooftrace.tools:dump',
+            'prooftrace_rehash=prooftrace.tools:rehash',
+            'prooftrace_columnar=prooftrace.tools:columnar',
+            'prooftrace_store=prooftrace.tools:store',
+            'prooftrace_kernel_cache=prooftrace.tools:kernel_cache',
             'prooftrace_generate_testset=prooftrace.tools:generate_testset',
 
             'generic_test_tree_lstm=generic.tree_lstm:test',
 
             'prooftrace_test_embedder=prooftrace.models.embedder:test',
+            'prooftrace_bench_tree_lstm=prooftrace.models.embedder:bench',
+            'prooftrace_test_tokenizer=prooftrace.prooftrace:test_tokenizer',
+            'prooftrace_test_hashing=prooftrace.prooftrace:test_hashing',
             'prooftrace_test_repl=prooftrace.repl.repl:test',
+            'prooftrace_bench_repl=prooftrace.repl.repl:bench',
             'prooftrace_test_fusion=prooftrace.repl.fusion:test',
             'prooftrace_test_repl_env=prooftrace.repl.env:test',
 